@@ -2,6 +2,8 @@ from fastapi import FastAPI
 
 from modules.fastknowledge.routers_knowledge_base_chat import router as knowledge_base_chat_router
 from modules.fastknowledge.routers_llm_chat import router as llm_chat_router
+from modules.fastknowledge.routers_metrics import router as metrics_router
+from modules.fastknowledge.routers_search_cache import router as search_cache_router
 
 
 def register_routes(app: FastAPI):
@@ -11,3 +13,5 @@ def register_routes(app: FastAPI):
 
     app.include_router(knowledge_base_chat_router, prefix="/chat", tags=["Chat"])
     app.include_router(llm_chat_router, prefix="/chat", tags=["Chat"])
+    app.include_router(search_cache_router, prefix="/knowledge_base", tags=["Knowledge Base"])
+    app.include_router(metrics_router, tags=["Metrics"])
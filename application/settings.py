@@ -37,7 +37,21 @@ WORKERS = 1
 # middleware will be applied in the order given, and in the response
 # phase the middleware will be applied in reverse order.
 MIDDLEWARES = [
+    "modules.fastknowledge.compression.register_compression_middleware",
     "xiaoapi.middleware.register_request_log_middleware",
+    "modules.fastknowledge.metrics.register_server_timing_middleware",
+]
+
+
+############
+# LIFESPAN #
+############
+# 生命周期事件，服务启动时以status=True调用，关闭时以status=False调用
+EVENTS = [
+    "modules.fastknowledge.events.connect_search_server",
+    "modules.fastknowledge.events.check_llm_backends",
+    "modules.fastknowledge.events.close_llm_clients",
+    "modules.fastknowledge.events.cleanup_conversations",
 ]
 
 
@@ -49,10 +63,85 @@ LLM_MODELS = ["cyou-api"]
 
 HISTORY_LEN = 3
 
+# 服务端历史对话的token预算，按模型名称配置，未配置的模型使用default
+# 超出预算时从最近的消息开始保留，不受客户端传入的历史长度影响
+HISTORY_TOKEN_BUDGET = {
+    "default": 2048,
+}
+# 是否将超出预算的较早消息压缩为摘要（需额外调用一次LLM，摘要按对话内容缓存）
+HISTORY_SUMMARY_ENABLE = False
+# 摘要最多生成的token数，会从历史对话预算中预留
+HISTORY_SUMMARY_MAX_TOKENS = 256
+# 生成摘要的超时时间（秒），超时后只保留最近的消息，不影响本次请求
+HISTORY_SUMMARY_TIMEOUT = 3
+# 摘要缓存过期时间（秒）
+HISTORY_SUMMARY_CACHE_TTL = 3600
+# 摘要最大缓存条目数
+HISTORY_SUMMARY_CACHE_MAX_ENTRIES = 1000
+# 摘要最大缓存内存占用（字节）
+HISTORY_SUMMARY_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# 服务端会话存储：请求传入 conversation_id 时从存储读取历史对话，回答完成后由服务端追加本轮问答
+# 存储类，可替换为实现了 modules.fastknowledge.conversation.ConversationStore 接口的其他存储
+CONVERSATION_STORE = "modules.fastknowledge.conversation.SQLiteConversationStore"
+# 作为关键字参数传给存储类
+CONVERSATION_STORE_OPTIONS = {
+    "path": os.path.join(BASE_DIR, "data", "conversations.db"),
+}
+# 每次读取的最近消息数，读取后再按 HISTORY_TOKEN_BUDGET 裁剪
+CONVERSATION_HISTORY_LIMIT = 20
+# 会话最后一次更新后保留的时间（秒），过期的会话被定时清理
+CONVERSATION_TTL = 7 * 24 * 3600
+# 清理过期会话的间隔（秒）
+CONVERSATION_CLEANUP_INTERVAL = 3600
+
+# LLM执行路径：langchain 通过LLMChain调用；direct 直接渲染消息并通过共享的异步客户端调用接口，
+# 不经过LangChain的chain和回调，每个请求的CPU开销更小
+LLM_ENGINE = "langchain"
+
 MAX_TOKENS = 2048
 
 TEMPERATURE = 0.7
 
+# 批量知识库对话默认并发数
+BATCH_CONCURRENCY = 4
+# 批量知识库对话允许的最大并发数
+BATCH_MAX_CONCURRENCY = 32
+# 批量知识库对话单次最多请求数
+BATCH_MAX_ITEMS = 1000
+
+# 准入控制：按模型限制同时处理的对话请求数，超出的请求排队等待，队列满时返回429，排队超时返回503
+ADMISSION_ENABLE = True
+# 每个模型同时处理的请求数，未配置的模型使用default
+ADMISSION_MAX_CONCURRENCY = {
+    "default": 32,
+}
+# 每个模型最多排队等待的请求数，未配置的模型使用default
+ADMISSION_MAX_QUEUE = {
+    "default": 64,
+}
+# 排队等待的超时时间（秒）
+ADMISSION_QUEUE_TIMEOUT = 30
+
+# 请求的时间预算（秒），包括检索和LLM生成；请求可通过 timeout 字段或 X-Request-Timeout 请求头指定
+REQUEST_TIMEOUT = 120
+# 请求可指定的最大时间预算（秒）
+REQUEST_TIMEOUT_MAX = 600
+# 检索可使用的时间占总预算的比例，超时后不使用知识库内容（使用empty模板）继续回答，并在响应中标记 degraded
+RETRIEVAL_TIMEOUT_RATIO = 0.25
+
+# 客户端断开连接时取消进行中的检索和LLM生成
+CANCEL_ON_DISCONNECT = True
+
+# 响应压缩：按 Accept-Encoding 协商 br（需安装brotli）或 gzip，只压缩非流式响应
+COMPRESSION_ENABLE = True
+# 响应体超过该字节数才压缩
+COMPRESSION_MIN_SIZE = 1024
+# gzip压缩级别（1-9）
+COMPRESSION_GZIP_LEVEL = 6
+# brotli压缩质量（0-11），较低的质量压缩更快
+COMPRESSION_BROTLI_QUALITY = 4
+
 # 知识库匹配向量数量
 VECTOR_SEARCH_TOP_K = 3
 
@@ -60,19 +149,150 @@ VECTOR_SEARCH_TOP_K = 3
 # 但有用户报告遇到过匹配分值超过1的情况，为了兼容性默认设为1，在WEBUI中调整范围为0-2
 SCORE_THRESHOLD = 1.0
 
+# 检索结果重排：多取 top_k * RERANK_OVERSAMPLE 个候选文档，按相关度和多样性（MMR）重新选出 top_k 个，可在请求中单独开启
+RERANK_ENABLE = False
+# 候选文档数相对 top_k 的倍数
+RERANK_OVERSAMPLE = 4
+# 候选文档数上限
+RERANK_MAX_CANDIDATES = 100
+# MMR中相关度的权重（0-1），1表示只按相关度排序，越小越倾向于选择内容不同的文档
+RERANK_MMR_LAMBDA = 0.7
+# 相关度中词重叠得分的权重（0-1），其余为检索服务返回的得分
+RERANK_LEXICAL_WEIGHT = 0.3
+
+
+# 知识库上下文的token预算，按相关度依次装入文档，超出预算的文档不放入prompt，0表示不限制
+CONTEXT_TOKEN_BUDGET = 3000
+# 近似重复文档的判定阈值（字符shingle的Jaccard相似度），超过阈值的低相关度文档会被去除
+CONTEXT_NEAR_DUPLICATE_THRESHOLD = 0.8
+# 计算近似重复时使用的shingle字符数
+CONTEXT_SHINGLE_SIZE = 5
+
 
 # fast-search服务接口地址
 SEARCH_SERVER_URL = "http://127.0.0.1:7862"
 
+# fast-search服务连接池配置，连接在服务生命周期内复用（keep-alive）
+# 连接池最大连接数
+SEARCH_CLIENT_LIMIT = 100
+# 单个主机最大连接数，0表示不限制
+SEARCH_CLIENT_LIMIT_PER_HOST = 50
+# 空闲连接保持时间（秒）
+SEARCH_CLIENT_KEEPALIVE_TIMEOUT = 30
+# DNS缓存时间（秒），None表示永久缓存
+SEARCH_CLIENT_DNS_CACHE_TTL = 300
+# 请求总超时时间（秒）
+SEARCH_CLIENT_TIMEOUT = 60
+# 建立连接超时时间（秒）
+SEARCH_CLIENT_CONNECT_TIMEOUT = 5
+
+# 检索请求对冲：请求超过近期延迟的分位数仍未返回时，再发一个相同请求，取先返回的结果并取消另一个
+SEARCH_HEDGE_ENABLE = True
+# 对冲请求发往的fast-search副本地址，轮流使用，为空时发往 SEARCH_SERVER_URL
+SEARCH_REPLICA_URLS = []
+# 未配置副本时是否向 SEARCH_SERVER_URL 发对冲请求（额外请求数受预算限制）；设为False则只在有副本时对冲
+SEARCH_HEDGE_SAME_URL = True
+# 触发对冲的延迟分位数（0-100）
+SEARCH_HEDGE_PERCENTILE = 95
+# 对冲请求数占请求总数的最大百分比
+SEARCH_HEDGE_BUDGET_PERCENT = 5
+# 延迟样本不足时使用的对冲阈值（秒）
+SEARCH_HEDGE_INITIAL_DELAY = 0.5
+# 对冲阈值下限（秒）
+SEARCH_HEDGE_MIN_DELAY = 0.01
+
+# 知识库检索结果缓存，按 (知识库名称, 规范化后的问题, top_k, score_threshold) 缓存
+SEARCH_CACHE_ENABLE = True
+# 缓存过期时间（秒）
+SEARCH_CACHE_TTL = 300
+# 最大缓存条目数
+SEARCH_CACHE_MAX_ENTRIES = 10000
+# 最大缓存内存占用（字节，按文档内容估算）
+SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# 知识库检索后端，未配置的知识库使用 fast-search 服务（"remote"）
+# "local" 表示使用进程内索引（内存映射的向量 + BM25倒排索引），索引通过 python manage.py build-index 构建
+KNOWLEDGE_BASE_BACKENDS = {
+    # "samples": "local",
+}
+# 本地索引目录，每个知识库一个子目录
+LOCAL_INDEX_ROOT = os.path.join(BASE_DIR, "data", "indexes")
+# 本地混合检索中BM25得分的权重（0-1），其余为向量相似度
+LOCAL_INDEX_BM25_WEIGHT = 0.5
+# BM25参数
+LOCAL_INDEX_BM25_K1 = 1.5
+LOCAL_INDEX_BM25_B = 0.75
+
+# 单个知识库检索的超时时间（秒），按知识库的检索后端配置；同时检索多个知识库时，超时的知识库被跳过
+SEARCH_BACKEND_TIMEOUT = {
+    "remote": 10,
+    "local": 2,
+}
+# 单次对话最多同时检索的知识库数量
+MAX_KNOWLEDGE_BASES = 10
+# 指标中knowledge_base标签最多使用的知识库数量：KNOWLEDGE_BASE_BACKENDS中配置的和检索返回过文档的知识库，
+# 其余记为unknown，避免任意请求参数产生无限多的指标序列
+METRICS_MAX_KNOWLEDGE_BASE_LABELS = 500
+
 
 LLM_MODELS_CONFIG = {
     "openai-api": {
         "model_name": "gpt-4",  # 由接口传入，不会使用这个
         "api_base_url": "https://api.openai.com/v1",
         "api_key": "EMPTY",
+        # 可选：按模型名称配置多个OpenAI兼容接口，请求按进行中请求数最少分配，未配置的模型使用上面的 api_base_url
+        # 未指定 api_key 的后端使用上面的 api_key
+        "backends": {
+            # "Qwen1.5-14B-Chat": [
+            #     {"api_base_url": "http://10.0.0.1:8000/v1"},
+            #     {"api_base_url": "http://10.0.0.2:8000/v1", "api_key": "EMPTY"},
+            # ],
+        },
     },
 }
 
+# 多后端负载均衡：连接失败时换后端重试的次数
+LLM_BALANCER_MAX_RETRIES = 2
+# 后端连续失败（连接失败、超时、5xx）多少次后熔断
+LLM_CIRCUIT_FAILURE_THRESHOLD = 5
+# 熔断多少秒后放行一个试探请求
+LLM_CIRCUIT_RESET_TIMEOUT = 30
+# 后端健康检查（请求 /models 接口）的间隔和超时时间（秒）
+LLM_HEALTH_CHECK_INTERVAL = 10
+LLM_HEALTH_CHECK_TIMEOUT = 3
+
+
+# 答案缓存，按渲染后的完整prompt和模型参数缓存LLM答案
+# 请求未指定cache时仅在temperature为0时使用缓存，请求可传cache=true强制使用或cache=false跳过
+ANSWER_CACHE_ENABLE = True
+# 缓存过期时间（秒）
+ANSWER_CACHE_TTL = 3600
+# 最大缓存条目数
+ANSWER_CACHE_MAX_ENTRIES = 2000
+# 最大缓存内存占用（字节）
+ANSWER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+
+# 合并并发的相同请求：相同检索参数的search_docs、可缓存的相同prompt的LLM生成只向上游发起一次
+SINGLE_FLIGHT_ENABLE = True
+
+
+# LLM客户端池配置，同一接口地址的客户端在进程内复用
+# 客户端池最多缓存的接口地址数量
+LLM_CLIENT_POOL_SIZE = 8
+# 单个接口地址的最大连接数
+LLM_CLIENT_MAX_CONNECTIONS = 100
+# 单个接口地址保持的最大空闲连接数
+LLM_CLIENT_MAX_KEEPALIVE = 20
+# 空闲连接保持时间（秒）
+LLM_CLIENT_KEEPALIVE_EXPIRY = 60
+# 请求超时时间（秒）
+LLM_CLIENT_TIMEOUT = 300
+
+
+# 检查本配置文件是否修改的最小间隔（秒），文件修改后才会重新加载prompt模板
+PROMPT_TEMPLATES_CHECK_INTERVAL = 1
+
 
 # prompt模板使用Jinja2语法，简单点就是用双大括号代替f-string的单大括号
 # 本配置文件支持热加载，修改prompt模板后无需重启服务。
@@ -114,4 +334,10 @@ PROMPT_TEMPLATES = {
             '请你回答我的问题:\n'
             '{{ question }}\n\n',
     },
+
+    "history_summary": {  # 压缩超出预算的历史对话，支持的变量：history
+        "default":
+            '请将以下对话历史压缩为简洁的摘要，保留关键事实、用户的意图和已经给出的结论，不要添加对话中没有的内容：\n'
+            '{{ history }}\n',
+    },
 }
@@ -0,0 +1,79 @@
+"""
+出处格式微基准测试：比较 Markdown 出处 + 标准库json 与 compact 出处 + orjson 的序列化耗时和响应体大小（含gzip/br压缩后）
+
+候选文档模拟检索服务常见的情况：top_k个分块来自少数几个文件
+
+运行：python -m benchmarks.bench_citations --top-k 20 --files 5 --iterations 2000
+"""
+
+import argparse
+import gzip
+import json
+import os
+import time
+
+os.environ.setdefault("XIAOAPI_SETTINGS_MODULE", "application.settings")
+
+import orjson
+
+from modules.fastknowledge.routers_knowledge_base_chat import format_source_documents, compact_source_documents
+from modules.fastknowledge.utils import DocumentWithVSId
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def make_docs(top_k: int, files: int, chunk_chars: int):
+    docs = []
+    for i in range(top_k):
+        text = f"第{i}个分块：缓存过期时间、连接池大小和重试次数的配置说明。" * (chunk_chars // 30)
+        docs.append(DocumentWithVSId(
+            page_content=text[:chunk_chars],
+            metadata={"source": f"运维手册_{i % files}.md", "knowledge_base_name": "samples"},
+            id=str(i),
+            score=0.2 + 0.01 * i,
+        ))
+    return docs
+
+
+def bench(name, build, dumps, iterations):
+    body = dumps(build())
+    start = time.perf_counter()
+    for _ in range(iterations):
+        dumps(build())
+    cost = (time.perf_counter() - start) / iterations * 1e6
+    sizes = [f"raw {len(body):7d}", f"gzip {len(gzip.compress(body, compresslevel=6)):6d}"]
+    if brotli is not None:
+        sizes.append(f"br {len(brotli.compress(body, quality=4)):6d}")
+    print(f"{name:<22} {cost:8.1f} us/response  " + "  ".join(sizes) + " bytes")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--top-k", type=int, default=20, help="出处文档数")
+    parser.add_argument("--files", type=int, default=5, help="文档来自的文件数")
+    parser.add_argument("--chunk-chars", type=int, default=500, help="每个分块的字符数")
+    parser.add_argument("--iterations", type=int, default=2000, help="重复次数")
+    args = parser.parse_args()
+
+    docs = make_docs(args.top_k, args.files, args.chunk_chars)
+    answer = "根据已知信息，" + "缓存过期时间建议设置为一小时。" * 20
+
+    def response(source_documents):
+        return {"code": 200, "answer": answer, "docs": source_documents, "dropped_docs": [],
+                "failed_knowledge_bases": [], "degraded": False, "cache": "bypass"}
+
+    def stdlib_dumps(content):
+        return json.dumps(content, ensure_ascii=False).encode("utf-8")
+
+    print(f"top_k: {args.top_k}, files: {args.files}, chunk chars: {args.chunk_chars}, iterations: {args.iterations}")
+    bench("markdown + json", lambda: response(format_source_documents(docs)), stdlib_dumps, args.iterations)
+    bench("markdown + orjson", lambda: response(format_source_documents(docs)), orjson.dumps, args.iterations)
+    bench("compact + orjson", lambda: response(compact_source_documents(docs)), orjson.dumps, args.iterations)
+    bench("compact+content+orjson", lambda: response(compact_source_documents(docs, True)), orjson.dumps, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
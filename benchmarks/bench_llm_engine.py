@@ -0,0 +1,129 @@
+"""
+LLM执行路径基准测试：对比 LLM_ENGINE 为 langchain 与 direct 时，每个请求在服务进程中消耗的CPU时间和内存分配
+
+OpenAI兼容接口的模拟服务运行在单独的进程中，统计的CPU时间只包含本进程（prompt渲染、接口调用、流式解析）的开销；
+内存分配单独运行一轮，用tracemalloc统计并发请求期间的内存分配峰值
+
+运行：python -m benchmarks.bench_llm_engine --concurrency 16 --requests 400 --tokens 64
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Optional
+
+os.environ.setdefault("XIAOAPI_SETTINGS_MODULE", "application.settings")
+
+from benchmarks.loadtest import StubProfile, create_openai_stub, start_stub, configure_settings
+
+LLM_PORT = 18931
+SEARCH_PORT = 18932
+
+
+@dataclass
+class BenchRequest:
+    """
+    chat.ainvoke_answer / astream_answer 用到的请求字段
+    """
+    model_name: str
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+    cache: Optional[bool] = False
+
+
+def run_stub(tokens: int):
+    async def serve():
+        profile = StubProfile(latency_ms=5, jitter_ms=0, tokens=tokens, tokens_per_second=0)
+        await start_stub(create_openai_stub(profile), LLM_PORT)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def wait_stub():
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", LLM_PORT)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError("模拟服务未能启动")
+
+
+async def run_requests(chat, chat_prompt, inputs, request_data, concurrency: int, total: int, stream: bool):
+    queue = iter(range(total))
+
+    async def worker():
+        for _ in queue:
+            if stream:
+                async for _ in chat.astream_answer(request_data, chat_prompt, inputs):
+                    pass
+            else:
+                await chat.ainvoke_answer(request_data, chat_prompt, inputs)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def bench(args):
+    from application.settings import LLM_MODELS, PROMPT_TEMPLATES
+    from modules.fastknowledge import chat
+    from modules.fastknowledge.history import ChatPrompt, History
+
+    history = [History(role="user" if i % 2 == 0 else "assistant", content=f"第{i}轮对话的内容。" * 10)
+               for i in range(args.history)]
+    chat_prompt = ChatPrompt(history, PROMPT_TEMPLATES["knowledge_base_chat"]["default"])
+    inputs = {"context": "缓存过期时间、连接池大小和重试次数的配置说明。" * 50, "question": "缓存过期时间如何设置？"}
+    request_data = BenchRequest(model_name=LLM_MODELS[0])
+
+    print(f"concurrency: {args.concurrency}, requests: {args.requests}, tokens: {args.tokens}, "
+          f"history: {args.history}")
+    for stream in (False, True):
+        for engine in (chat.ENGINE_LANGCHAIN, chat.ENGINE_DIRECT):
+            chat.LLM_ENGINE = engine
+            # 预热：建立连接、初始化客户端
+            await run_requests(chat, chat_prompt, inputs, request_data, args.concurrency, args.concurrency, stream)
+
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            await run_requests(chat, chat_prompt, inputs, request_data, args.concurrency, args.requests, stream)
+            cpu = (time.process_time() - cpu_start) / args.requests * 1000
+            wall = time.perf_counter() - wall_start
+
+            tracemalloc.start()
+            await run_requests(chat, chat_prompt, inputs, request_data, args.concurrency, args.alloc_requests, stream)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            name = f"{engine} {'stream' if stream else 'invoke'}"
+            print(f"{name:<18} {cpu:7.2f} ms cpu/request  {args.requests / wall:8.1f} req/s  "
+                  f"peak {peak / 1024:8.1f} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--requests", type=int, default=400, help="统计CPU时间的请求数")
+    parser.add_argument("--alloc-requests", type=int, default=100, help="统计内存分配峰值的请求数")
+    parser.add_argument("--tokens", type=int, default=64, help="每次生成的token数")
+    parser.add_argument("--history", type=int, default=6, help="历史消息条数")
+    args = parser.parse_args()
+
+    configure_settings(SEARCH_PORT, LLM_PORT, disable_cache=True)
+    stub = multiprocessing.Process(target=run_stub, args=(args.tokens,), daemon=True)
+    stub.start()
+    try:
+        async def run():
+            await wait_stub()
+            await bench(args)
+
+        asyncio.run(run())
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+prompt构建微基准测试：对比 History.to_msg_template 旧实现（每轮历史都用jinja2编译）与当前实现
+
+运行：python -m benchmarks.bench_prompt_build --turns 20 --iterations 200
+"""
+
+import argparse
+import os
+import time
+
+os.environ.setdefault("XIAOAPI_SETTINGS_MODULE", "application.settings")
+
+from langchain.prompts.chat import ChatMessagePromptTemplate
+from langchain_core.prompts import ChatPromptTemplate
+
+from application.settings import PROMPT_TEMPLATES
+from modules.fastknowledge.history import History
+
+
+def legacy_to_msg_template(h: History, is_raw=True) -> ChatMessagePromptTemplate:
+    """
+    旧实现：历史消息包裹 {% raw %} 后按jinja2模板编译
+    """
+    role = {"ai": "assistant", "human": "user"}.get(h.role, h.role)
+    content = "{% raw %}" + h.content + "{% endraw %}" if is_raw else h.content
+    return ChatMessagePromptTemplate.from_template(content, "jinja2", role=role)
+
+
+def build_prompt(history, prompt_template, to_msg_template):
+    input_msg = to_msg_template(History(role="user", content=prompt_template), False)
+    chat_prompt = ChatPromptTemplate.from_messages([to_msg_template(h) for h in history] + [input_msg])
+    return chat_prompt.format_messages(context="已知信息" * 50, question="问题")
+
+
+def bench(name, history, prompt_template, to_msg_template, iterations):
+    build_prompt(history, prompt_template, to_msg_template)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        build_prompt(history, prompt_template, to_msg_template)
+    cost = (time.perf_counter() - start) / iterations * 1000
+    print(f"{name:<8} {cost:8.3f} ms/request")
+    return cost
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=20, help="历史对话消息数")
+    parser.add_argument("--iterations", type=int, default=200, help="每种实现的构建次数")
+    args = parser.parse_args()
+
+    history = [
+        History(role="user" if i % 2 == 0 else "assistant", content=f"第{i}轮对话内容，" * 20)
+        for i in range(args.turns)
+    ]
+    prompt_template = PROMPT_TEMPLATES["knowledge_base_chat"]["default"]
+
+    print(f"history turns: {args.turns}, iterations: {args.iterations}")
+    before = bench("before", history, prompt_template, legacy_to_msg_template, args.iterations)
+    after = bench("after", history, prompt_template, History.to_msg_template, args.iterations)
+    print(f"speedup  {before / after:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+压测与回放工具：在进程内启动fast-search和OpenAI兼容接口的模拟服务，驱动真实的FastAPI应用
+
+运行：python manage.py bench --mode closed --concurrency 16 --requests 500
+     python manage.py bench --mode open --rate 50 --duration 30 --output bench.json
+
+开环(open)模式按泊松过程以固定速率发送请求，不受服务端响应速度影响；
+闭环(closed)模式模拟固定数量的用户，每个用户收到响应后才发送下一个请求。
+"""
+
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+import typer
+from aiohttp import web
+from typer import Typer
+
+STUB_HOST = "127.0.0.1"
+
+
+@dataclass
+class StubProfile:
+    """
+    模拟服务的延迟和错误配置
+    """
+    latency_ms: float = 20.0  # fast-search响应延迟 / LLM首token延迟
+    jitter_ms: float = 5.0  # 延迟的随机波动（指数分布均值）
+    error_rate: float = 0.0  # 返回HTTP 500的比例
+    tokens: int = 64  # LLM每次生成的token数
+    tokens_per_second: float = 200.0  # LLM生成速度
+
+    def delay(self) -> float:
+        jitter = random.expovariate(1 / self.jitter_ms) if self.jitter_ms > 0 else 0.0
+        return (self.latency_ms + jitter) / 1000
+
+
+@dataclass
+class RequestResult:
+    latency: float
+    ttft: Optional[float]
+    ok: bool
+
+
+@dataclass
+class BenchReport:
+    mode: str
+    endpoint: str
+    stream: bool
+    requests: int
+    errors: int
+    duration: float
+    throughput: float
+    latency: Dict[str, float] = field(default_factory=dict)
+    ttft: Dict[str, float] = field(default_factory=dict)
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(p: float) -> float:
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] * 1000
+
+    return {
+        "p50": pick(50),
+        "p95": pick(95),
+        "p99": pick(99),
+        "max": values[-1] * 1000,
+        "mean": sum(values) / len(values) * 1000,
+    }
+
+
+def create_search_stub(profile: StubProfile) -> web.Application:
+    async def search_docs(request: web.Request):
+        body = await request.json()
+        await asyncio.sleep(profile.delay())
+        if random.random() < profile.error_rate:
+            return web.json_response({"detail": "stub error"}, status=500)
+        docs = [
+            {
+                "page_content": f"{body['query']} 的相关内容片段 {i}。" * 8,
+                "metadata": {"source": f"doc_{i}.txt"},
+                "id": f"{body['knowledge_base_name']}-{i}",
+                "score": round(0.2 + 0.1 * i, 3),
+            }
+            for i in range(body.get("top_k", 3))
+        ]
+        return web.json_response(docs)
+
+    app = web.Application()
+    app.router.add_post("/knowledge_base/search_docs", search_docs)
+    return app
+
+
+def create_openai_stub(profile: StubProfile) -> web.Application:
+    def chunk(model: str, delta: Dict, finish_reason: Optional[str] = None) -> bytes:
+        data = {
+            "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(data)}\n\n".encode()
+
+    async def chat_completions(request: web.Request):
+        body = await request.json()
+        model = body.get("model", "stub")
+        await asyncio.sleep(profile.delay())
+        if random.random() < profile.error_rate:
+            return web.json_response({"error": {"message": "stub error", "type": "server_error"}}, status=500)
+
+        interval = 1 / profile.tokens_per_second if profile.tokens_per_second else 0
+        if body.get("stream"):
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            await response.write(chunk(model, {"role": "assistant", "content": ""}))
+            for i in range(profile.tokens):
+                await response.write(chunk(model, {"content": f"t{i} "}))
+                await asyncio.sleep(interval)
+            await response.write(chunk(model, {}, "stop") + b"data: [DONE]\n\n")
+            return response
+
+        await asyncio.sleep(interval * profile.tokens)
+        return web.json_response({
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(f"t{i}" for i in range(profile.tokens))},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": profile.tokens, "total_tokens": profile.tokens},
+        })
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+async def start_stub(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, STUB_HOST, port).start()
+    return runner
+
+
+def configure_settings(search_port: int, llm_port: int, disable_cache: bool):
+    """
+    在导入应用模块之前把依赖地址指向模拟服务
+    """
+    from application import settings
+
+    settings.SEARCH_SERVER_URL = f"http://{STUB_HOST}:{search_port}"
+    for config in settings.LLM_MODELS_CONFIG.values():
+        config["api_base_url"] = f"http://{STUB_HOST}:{llm_port}/v1"
+        config["api_key"] = "EMPTY"
+    if disable_cache:
+        settings.SEARCH_CACHE_ENABLE = False
+        settings.ANSWER_CACHE_ENABLE = False
+        settings.SINGLE_FLIGHT_ENABLE = False
+
+
+async def send_request(client, endpoint: str, payload: Dict, stream: bool) -> RequestResult:
+    from webui_pages.api_request import StreamDecoder
+
+    start = time.perf_counter()
+    ttft = None
+    ok = True
+    try:
+        if stream:
+            decoder = StreamDecoder()
+            async with client.stream("POST", f"/chat/{endpoint}", json=payload) as r:
+                ok = r.status_code == 200
+                async for text in r.aiter_text():
+                    for data in decoder.feed(text):
+                        if "answer" in data and ttft is None:
+                            ttft = time.perf_counter() - start
+                        if data.get("code", 200) != 200:
+                            ok = False
+            ok = ok and ttft is not None
+        else:
+            r = await client.post(f"/chat/{endpoint}", json=payload)
+            data = r.json()
+            ok = r.status_code == 200 and data.get("code", 200) == 200
+            ttft = time.perf_counter() - start
+    except Exception:
+        ok = False
+    return RequestResult(time.perf_counter() - start, ttft if ok else None, ok)
+
+
+def build_payload(endpoint: str, index: int, distinct_queries: int, stream: bool) -> Dict:
+    query = f"压测问题 {index % distinct_queries if distinct_queries else index}"
+    payload = {"query": query, "stream": stream}
+    if endpoint == "knowledge_base_chat":
+        payload["knowledge_base_name"] = "bench"
+    return payload
+
+
+async def run_closed_loop(client, endpoint, stream, concurrency, total, duration, distinct_queries):
+    results: List[RequestResult] = []
+    counter = iter(range(total if total else 1 << 62))
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def user():
+        for index in counter:
+            if deadline and time.perf_counter() >= deadline:
+                return
+            results.append(await send_request(client, endpoint, build_payload(endpoint, index, distinct_queries, stream), stream))
+
+    await asyncio.gather(*[user() for _ in range(concurrency)])
+    return results
+
+
+async def run_open_loop(client, endpoint, stream, rate, total, duration, distinct_queries):
+    tasks = []
+    start = time.perf_counter()
+    index = 0
+    next_at = start
+    while (not total or index < total) and (not duration or next_at - start < duration):
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        payload = build_payload(endpoint, index, distinct_queries, stream)
+        tasks.append(asyncio.create_task(send_request(client, endpoint, payload, stream)))
+        index += 1
+        next_at += random.expovariate(rate)
+    return list(await asyncio.gather(*tasks))
+
+
+async def run_bench(
+        mode: str,
+        endpoint: str,
+        stream: bool,
+        concurrency: int,
+        rate: float,
+        total: int,
+        duration: float,
+        warmup: int,
+        distinct_queries: int,
+        disable_cache: bool,
+        search_profile: StubProfile,
+        llm_profile: StubProfile,
+        app_port: int,
+        search_port: int,
+        llm_port: int,
+) -> BenchReport:
+    import httpx
+    import uvicorn
+
+    configure_settings(search_port, llm_port, disable_cache)
+    runners = [
+        await start_stub(create_search_stub(search_profile), search_port),
+        await start_stub(create_openai_stub(llm_profile), llm_port),
+    ]
+
+    from xiaoapi.core import get_fastapi_application
+
+    config = uvicorn.Config(get_fastapi_application(), host=STUB_HOST, port=app_port, lifespan="on", log_level="warning")
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    try:
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(base_url=f"http://{STUB_HOST}:{app_port}", timeout=300, limits=limits) as client:
+            for index in range(warmup):
+                await send_request(client, endpoint, build_payload(endpoint, -index - 1, 0, stream), stream)
+
+            start = time.perf_counter()
+            if mode == "open":
+                results = await run_open_loop(client, endpoint, stream, rate, total, duration, distinct_queries)
+            else:
+                results = await run_closed_loop(client, endpoint, stream, concurrency, total, duration, distinct_queries)
+            elapsed = time.perf_counter() - start
+    finally:
+        server.should_exit = True
+        await server_task
+        for runner in runners:
+            await runner.cleanup()
+
+    ok = [r for r in results if r.ok]
+    return BenchReport(
+        mode=mode,
+        endpoint=endpoint,
+        stream=stream,
+        requests=len(results),
+        errors=len(results) - len(ok),
+        duration=elapsed,
+        throughput=len(ok) / elapsed if elapsed else 0.0,
+        latency=percentiles([r.latency for r in ok]),
+        ttft=percentiles([r.ttft for r in ok if r.ttft is not None]),
+    )
+
+
+def print_report(report: BenchReport):
+    print(f"mode={report.mode} endpoint={report.endpoint} stream={report.stream}")
+    print(f"requests={report.requests} errors={report.errors} duration={report.duration:.2f}s "
+          f"throughput={report.throughput:.2f} req/s")
+    for name, values in (("latency", report.latency), ("ttft", report.ttft)):
+        if values:
+            print(f"{name:<8} " + " ".join(f"{k}={v:.1f}ms" for k, v in values.items()))
+
+
+def register_command(shell: Typer):
+
+    @shell.command()
+    def bench(
+            mode: str = typer.Option("closed", help="负载模式：closed（固定并发）或 open（固定到达速率）"),
+            endpoint: str = typer.Option("knowledge_base_chat", help="压测接口：knowledge_base_chat 或 llm_chat"),
+            stream: bool = typer.Option(True, help="是否使用流式接口，流式时才能统计首token延迟"),
+            concurrency: int = typer.Option(16, help="closed模式的并发用户数"),
+            rate: float = typer.Option(20.0, help="open模式每秒发送的请求数"),
+            requests: int = typer.Option(200, help="请求总数，0表示只按duration限制"),
+            duration: float = typer.Option(0.0, help="压测时长（秒），0表示只按requests限制"),
+            warmup: int = typer.Option(5, help="预热请求数，不计入结果"),
+            distinct_queries: int = typer.Option(0, help="不同问题的数量，0表示每个请求都不同"),
+            disable_cache: bool = typer.Option(True, help="关闭检索缓存、答案缓存和请求合并"),
+            search_latency: float = typer.Option(20.0, help="fast-search模拟延迟（毫秒）"),
+            search_jitter: float = typer.Option(5.0, help="fast-search延迟波动（毫秒）"),
+            search_error_rate: float = typer.Option(0.0, help="fast-search错误率"),
+            llm_ttft: float = typer.Option(200.0, help="LLM模拟首token延迟（毫秒）"),
+            llm_jitter: float = typer.Option(50.0, help="LLM首token延迟波动（毫秒）"),
+            llm_tokens: int = typer.Option(64, help="LLM每次生成的token数"),
+            llm_token_rate: float = typer.Option(200.0, help="LLM每秒生成的token数"),
+            llm_error_rate: float = typer.Option(0.0, help="LLM错误率"),
+            app_port: int = typer.Option(19000, help="被测服务端口"),
+            search_port: int = typer.Option(19001, help="fast-search模拟服务端口"),
+            llm_port: int = typer.Option(19002, help="LLM模拟服务端口"),
+            output: Optional[str] = typer.Option(None, help="将结果以json写入文件，便于版本间对比"),
+    ):
+        """
+        压测：启动依赖的模拟服务，驱动真实应用并统计吞吐量、延迟分位数和首token延迟
+        """
+        report = asyncio.run(run_bench(
+            mode=mode,
+            endpoint=endpoint,
+            stream=stream,
+            concurrency=concurrency,
+            rate=rate,
+            total=requests,
+            duration=duration,
+            warmup=warmup,
+            distinct_queries=distinct_queries,
+            disable_cache=disable_cache,
+            search_profile=StubProfile(search_latency, search_jitter, search_error_rate),
+            llm_profile=StubProfile(llm_ttft, llm_jitter, llm_error_rate, llm_tokens, llm_token_rate),
+            app_port=app_port,
+            search_port=search_port,
+            llm_port=llm_port,
+        ))
+        print_report(report)
+        if output:
+            with open(output, "w", encoding="utf-8") as f:
+                json.dump(asdict(report), f, ensure_ascii=False, indent=2)
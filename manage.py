@@ -13,6 +13,10 @@ def main():
             "available on your PYTHONPATH environment variable? Did you "
             "forget to activate a virtual environment?"
         ) from exc
+    from benchmarks.loadtest import register_command as register_bench_command
+    register_bench_command(manage_typer)
+    from modules.fastknowledge.local_index import register_command as register_index_command
+    register_index_command(manage_typer)
     manage_typer()
 
 
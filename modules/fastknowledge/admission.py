@@ -0,0 +1,225 @@
+"""
+对话请求的准入控制：按模型限制并发数，超出并发的请求进入有界等待队列，按优先级（交互 > 批量）出队
+
+队列已满时立即返回 429，等待超时返回 503，两者都带 Retry-After 响应头；
+队列已满但有低优先级请求在等待时，挤出最晚进入队列的低优先级请求（返回503），为新的高优先级请求让出位置。
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import AsyncIterator, Dict, List, Union
+
+from fastapi import status
+
+from application.settings import ADMISSION_ENABLE, ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT
+from xiaoapi.response import ErrorResponse
+from .metrics import admission_wait_seconds, admission_rejected_total, admission_queue_depth, admission_in_flight
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITIES = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1}
+
+
+class AdmissionRejected(Exception):
+    """
+    请求未被准入，status_code 为 429（队列已满）或 503（等待超时或被高优先级请求挤出）
+    """
+
+    def __init__(self, status_code: int, reason: str, retry_after: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_response(self) -> ErrorResponse:
+        response = ErrorResponse(str(self), code=self.status_code, status=self.status_code)
+        response.headers["Retry-After"] = str(self.retry_after)
+        return response
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "future")
+
+    def __init__(self, priority: int, seq: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Permit:
+    """
+    准入许可，请求结束时调用 release，重复调用无影响
+    """
+
+    __slots__ = ("_limiter", "_start", "_released")
+
+    def __init__(self, limiter: "ConcurrencyLimiter"):
+        self._limiter = limiter
+        self._start = time.perf_counter()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._limiter._release(time.perf_counter() - self._start)
+
+
+class _NoopPermit:
+    """
+    未开启准入控制时使用
+    """
+
+    def release(self):
+        pass
+
+
+class ConcurrencyLimiter:
+    """
+    单个模型的并发限制，只在事件循环线程中使用
+    """
+
+    def __init__(self, model_name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._avg_hold = 1.0  # 请求占用并发的平均时长（秒），用于估算 Retry-After
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._avg_hold * (len(self._waiters) + 1) / self.max_concurrency))
+
+    def _reject(self, status_code: int, reason: str, priority: str, message: str) -> AdmissionRejected:
+        admission_rejected_total.inc(model=self.model_name, priority=priority, reason=reason)
+        return AdmissionRejected(status_code, reason, self.retry_after(), message)
+
+    def _update_gauges(self):
+        admission_queue_depth.set(len(self._waiters), model=self.model_name)
+        admission_in_flight.set(self.active, model=self.model_name)
+
+    async def acquire(self, priority: str = PRIORITY_INTERACTIVE) -> Permit:
+        start = time.perf_counter()
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self._update_gauges()
+            admission_wait_seconds.observe(0.0, model=self.model_name, priority=priority)
+            return Permit(self)
+
+        rank = PRIORITIES[priority]
+        if len(self._waiters) >= self.max_queue:
+            victim = max(self._waiters, default=None)
+            if victim is None or victim.priority <= rank:
+                raise self._reject(status.HTTP_429_TOO_MANY_REQUESTS, "queue_full", priority,
+                                   f"模型 {self.model_name} 请求排队已满，请稍后重试")
+            self._waiters.remove(victim)
+            heapq.heapify(self._waiters)
+            victim_priority = next(name for name, value in PRIORITIES.items() if value == victim.priority)
+            victim.future.set_exception(self._reject(
+                status.HTTP_503_SERVICE_UNAVAILABLE, "preempted", victim_priority,
+                f"模型 {self.model_name} 繁忙，请求被更高优先级的请求挤出队列，请稍后重试"))
+
+        waiter = _Waiter(rank, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, waiter)
+        self._update_gauges()
+        try:
+            # 不使用 wait_for：获得许可的同时调用方被取消时，wait_for 可能吞掉取消并返回，许可随之泄漏
+            await asyncio.wait([waiter.future], timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if waiter.future.done() and waiter.future.exception() is None:
+                # 已获得许可但调用方被取消，交还许可
+                Permit(self).release()
+            raise
+        finally:
+            if not waiter.future.done():
+                waiter.future.cancel()
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+            self._update_gauges()
+
+        # future被取消说明排队超时；超时的同时恰好获得许可时按获得许可处理
+        if waiter.future.cancelled():
+            raise self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, "timeout", priority,
+                               f"模型 {self.model_name} 繁忙，排队超过 {self.queue_timeout} 秒，请稍后重试")
+        if waiter.future.exception() is not None:
+            # 被更高优先级的请求挤出队列
+            raise waiter.future.exception()
+        admission_wait_seconds.observe(time.perf_counter() - start, model=self.model_name, priority=priority)
+        return Permit(self)
+
+    def _release(self, held: float):
+        self._avg_hold = 0.9 * self._avg_hold + 0.1 * held
+        self.active -= 1
+        # 把许可直接交给优先级最高的等待者，避免新到的请求插队
+        while self._waiters and self.active < self.max_concurrency:
+            waiter = heapq.heappop(self._waiters)
+            if not waiter.future.done():
+                self.active += 1
+                waiter.future.set_result(None)
+        self._update_gauges()
+
+    def stats(self) -> Dict:
+        return {
+            "model_name": self.model_name,
+            "active": self.active,
+            "queued": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "avg_hold_seconds": round(self._avg_hold, 3),
+        }
+
+
+class AdmissionController:
+    """
+    按模型名称创建并发限制，配置项中未配置的模型使用default
+    """
+
+    def __init__(self):
+        self._limiters: Dict[str, ConcurrencyLimiter] = {}
+
+    def get(self, model_name: str) -> ConcurrencyLimiter:
+        limiter = self._limiters.get(model_name)
+        if limiter is None:
+            limiter = self._limiters[model_name] = ConcurrencyLimiter(
+                model_name,
+                ADMISSION_MAX_CONCURRENCY.get(model_name, ADMISSION_MAX_CONCURRENCY["default"]),
+                ADMISSION_MAX_QUEUE.get(model_name, ADMISSION_MAX_QUEUE["default"]),
+                ADMISSION_QUEUE_TIMEOUT,
+            )
+        return limiter
+
+    async def acquire(self, model_name: str, priority: str = PRIORITY_INTERACTIVE) -> Permit:
+        return await self.get(model_name).acquire(priority)
+
+    def stats(self) -> List[Dict]:
+        return [limiter.stats() for limiter in self._limiters.values()]
+
+
+admission_controller = AdmissionController()
+
+
+async def admit(model_name: str, priority: str = PRIORITY_INTERACTIVE) -> Union[Permit, _NoopPermit]:
+    """
+    获取模型的准入许可，未获准入时抛出 AdmissionRejected
+    """
+    if not ADMISSION_ENABLE:
+        return _NoopPermit()
+    return await admission_controller.acquire(model_name, priority)
+
+
+async def hold_permit(iterator: AsyncIterator, permit: Union[Permit, _NoopPermit]) -> AsyncIterator:
+    """
+    流式响应结束（包括客户端断开）时释放许可
+    """
+    try:
+        async for item in iterator:
+            yield item
+    finally:
+        permit.release()
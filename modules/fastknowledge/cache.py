@@ -0,0 +1,120 @@
+"""
+进程内TTL/LRU缓存
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+
+class _Entry:
+    __slots__ = ("value", "size", "expire_at", "tag")
+
+    def __init__(self, value: Any, size: int, expire_at: float, tag: Optional[Hashable]):
+        self.value = value
+        self.size = size
+        self.expire_at = expire_at
+        self.tag = tag
+
+
+class TTLCache:
+    """
+    带过期时间的LRU缓存，同时限制条目数和估算的内存占用
+    条目可以带一个标签，用于按标签批量失效（如某个知识库重建索引后）
+    每次失效都会推进标签的版本号，写入时可以带上取数前记录的版本号，版本号变化说明取数期间发生过失效，放弃写入
+    只在事件循环线程中使用，不加锁
+    """
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._tags: Dict[Hashable, Set[Hashable]] = {}
+        self._generations: Dict[Hashable, int] = {}
+        self._epoch = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expire_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def generation(self, tag: Optional[Hashable] = None) -> Tuple[int, int]:
+        """
+        标签当前的版本号，invalidate 该标签或 clear 后会变化
+        """
+        return self._epoch, self._generations.get(tag, 0)
+
+    def set(self, key: Hashable, value: Any, size: int, tag: Optional[Hashable] = None,
+            generation: Optional[Tuple[int, int]] = None):
+        if size > self.max_bytes:
+            return
+        if generation is not None and generation != self.generation(tag):
+            # 取数期间缓存已失效，写入的可能是旧数据
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(value, size, time.monotonic() + self.ttl, tag)
+        self.bytes += size
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, tag: Hashable) -> int:
+        """
+        删除某个标签下的全部条目，返回删除数量
+        """
+        self._generations[tag] = self._generations.get(tag, 0) + 1
+        keys = self._tags.pop(tag, set())
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+        self._generations.clear()
+        self._epoch += 1
+        self.bytes = 0
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        if entry.tag is not None:
+            keys = self._tags.get(entry.tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[entry.tag]
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,270 @@
+"""
+LLM答案生成，llm_chat 和 knowledge_base_chat 共用
+
+temperature为0（或请求显式开启）时，按渲染后的完整prompt和模型参数缓存答案；
+LLM_ENGINE 为 direct 时直接调用OpenAI兼容接口（见 llm_engine.py），否则通过LangChain的LLMChain调用
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.chains import LLMChain
+
+from application.settings import ANSWER_CACHE_ENABLE, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_BYTES, \
+    SINGLE_FLIGHT_ENABLE, HISTORY_TOKEN_BUDGET, HISTORY_SUMMARY_ENABLE, HISTORY_SUMMARY_MAX_TOKENS, \
+    HISTORY_SUMMARY_TIMEOUT, HISTORY_SUMMARY_CACHE_TTL, HISTORY_SUMMARY_CACHE_MAX_ENTRIES, HISTORY_SUMMARY_CACHE_MAX_BYTES, LLM_ENGINE
+from xiaoapi.core import logger
+from .cache import TTLCache
+from .deadline import Deadline
+from . import llm_engine
+from .history import ChatPrompt, History, split_history
+from .metrics import TokenUsageCallbackHandler, llm_seconds, llm_ttft_seconds, timed, record_cancelled_generation
+from .singleflight import SingleFlight
+from .utils import get_ChatOpenAI, iter_chain_tokens, get_prompt_template
+
+answer_cache = TTLCache(ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_BYTES)
+answer_flight = SingleFlight()
+history_summary_cache = TTLCache(HISTORY_SUMMARY_CACHE_TTL, HISTORY_SUMMARY_CACHE_MAX_ENTRIES, HISTORY_SUMMARY_CACHE_MAX_BYTES)
+history_summary_flight = SingleFlight()
+
+ENGINE_LANGCHAIN = "langchain"
+ENGINE_DIRECT = "direct"
+
+CACHE_HIT = "hit"
+CACHE_MISS = "miss"
+CACHE_BYPASS = "bypass"
+
+
+def use_answer_cache(cache: Optional[bool], temperature: float) -> bool:
+    """
+    cache为None时仅在temperature为0时使用缓存，True为强制使用，False为跳过
+    """
+    if not ANSWER_CACHE_ENABLE or cache is False:
+        return False
+    return cache is True or temperature == 0
+
+
+def get_answer_cache_key(messages: List[Dict[str, str]], model_name: str, temperature: float, max_tokens: int) -> str:
+    """
+    按渲染后的消息和模型参数计算缓存key
+    """
+    payload = json.dumps(
+        [[message["role"], message["content"]] for message in messages] + [model_name, temperature, max_tokens],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _render(request_data, chat_prompt: ChatPrompt, inputs: Dict) -> Optional[List[Dict[str, str]]]:
+    """
+    直接调用接口或需要计算缓存key时渲染消息；LangChain路径且不使用缓存时由LangChain渲染，返回None
+    """
+    if LLM_ENGINE == ENGINE_DIRECT or use_answer_cache(request_data.cache, request_data.temperature):
+        return chat_prompt.format_messages(inputs)
+    return None
+
+
+def _lookup(request_data, messages: Optional[List[Dict[str, str]]]) -> Tuple[Optional[str], Optional[str], str]:
+    """
+    返回 (缓存key, 缓存的答案, 缓存状态)
+    """
+    if not use_answer_cache(request_data.cache, request_data.temperature):
+        return None, None, CACHE_BYPASS
+
+    key = get_answer_cache_key(messages, request_data.model_name, request_data.temperature, request_data.max_tokens)
+    answer = answer_cache.get(key)
+    return key, answer, CACHE_MISS if answer is None else CACHE_HIT
+
+
+def _store(key: Optional[str], answer: str):
+    if key is not None and answer:
+        answer_cache.set(key, answer, len(answer.encode("utf-8")))
+
+
+async def complete(
+        chat_prompt: ChatPrompt,
+        inputs: Dict,
+        model_name: str,
+        temperature: float,
+        max_tokens: Optional[int],
+        messages: Optional[List[Dict[str, str]]] = None,
+) -> str:
+    """
+    按 LLM_ENGINE 生成完整答案，messages为已渲染的消息
+    """
+    if LLM_ENGINE == ENGINE_DIRECT:
+        messages = messages if messages is not None else chat_prompt.format_messages(inputs)
+        return await llm_engine.acomplete(model_name, messages, temperature, max_tokens)
+
+    model = get_ChatOpenAI(
+        model_name=model_name,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        callbacks=[TokenUsageCallbackHandler(model_name)],
+    )
+    chain = LLMChain(prompt=chat_prompt.to_chat_prompt_template(), llm=model)
+    result = await chain.ainvoke(inputs)
+    return result["text"]
+
+
+def stream(
+        chat_prompt: ChatPrompt,
+        inputs: Dict,
+        model_name: str,
+        temperature: float,
+        max_tokens: Optional[int],
+        messages: Optional[List[Dict[str, str]]] = None,
+        timeout: Optional[float] = None,
+) -> AsyncIterator[str]:
+    """
+    按 LLM_ENGINE 流式生成，逐个返回token；超过timeout秒仍未生成完毕时抛出 asyncio.TimeoutError
+    """
+    if LLM_ENGINE == ENGINE_DIRECT:
+        messages = messages if messages is not None else chat_prompt.format_messages(inputs)
+        return llm_engine.astream(model_name, messages, temperature, max_tokens, timeout)
+
+    callback = AsyncIteratorCallbackHandler()
+    model = get_ChatOpenAI(
+        model_name=model_name,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        streaming=True,
+        callbacks=[callback, TokenUsageCallbackHandler(model_name)],
+    )
+    chain = LLMChain(prompt=chat_prompt.to_chat_prompt_template(), llm=model)
+    return iter_chain_tokens(chain, inputs, callback, timeout)
+
+
+async def ainvoke_answer(
+        request_data,
+        chat_prompt: ChatPrompt,
+        inputs: Dict,
+        deadline: Optional[Deadline] = None,
+) -> Tuple[str, str]:
+    """
+    生成完整答案，返回 (答案, 缓存状态)；超过截止时间时取消生成并抛出 DeadlineExceeded
+    """
+    messages = _render(request_data, chat_prompt, inputs)
+    key, answer, cache_status = _lookup(request_data, messages)
+    if answer is not None:
+        return answer, cache_status
+
+    async def generate() -> str:
+        try:
+            text = await complete(chat_prompt, inputs, request_data.model_name, request_data.temperature,
+                                  request_data.max_tokens, messages)
+        except asyncio.CancelledError:
+            # 客户端断开或超过截止时间，生成随之取消
+            record_cancelled_generation(request_data.model_name)
+            raise
+        _store(key, text)
+        return text
+
+    with timed("llm", llm_seconds, model=request_data.model_name):
+        if key is not None and SINGLE_FLIGHT_ENABLE:
+            # 可缓存的请求结果是确定的，相同prompt并发时共享一次生成
+            answer = answer_flight.do(key, generate)
+        else:
+            answer = generate()
+        if deadline is not None:
+            return await deadline.run(answer, "LLM生成"), cache_status
+        return await answer, cache_status
+
+
+async def astream_answer(
+        request_data,
+        chat_prompt: ChatPrompt,
+        inputs: Dict,
+        deadline: Optional[Deadline] = None,
+) -> AsyncIterator[Dict]:
+    """
+    流式生成答案，先产出 {"cache": 缓存状态}，再逐个产出 {"answer": token}
+    命中缓存时整个答案作为一条消息返回；超过截止时间时取消生成并抛出 DeadlineExceeded
+    """
+    messages = _render(request_data, chat_prompt, inputs)
+    key, answer, cache_status = _lookup(request_data, messages)
+    yield {"cache": cache_status}
+    if answer is not None:
+        yield {"answer": answer}
+        return
+
+    tokens = []
+    start_time = time.perf_counter()
+    timeout = deadline.remaining() if deadline is not None else None
+    try:
+        async for token in stream(chat_prompt, inputs, request_data.model_name, request_data.temperature,
+                                  request_data.max_tokens, messages, timeout):
+            if not tokens:
+                llm_ttft_seconds.observe(time.perf_counter() - start_time, model=request_data.model_name)
+            tokens.append(token)
+            yield {"answer": token}
+    except asyncio.TimeoutError:
+        record_cancelled_generation(request_data.model_name, len(tokens))
+        if deadline is None:
+            raise
+        raise deadline.exceeded("LLM生成")
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端断开，迭代提前结束时生成随之取消
+        record_cancelled_generation(request_data.model_name, len(tokens))
+        raise
+    llm_seconds.observe(time.perf_counter() - start_time, model=request_data.model_name)
+    _store(key, "".join(tokens))
+
+
+def get_history_token_budget(model_name: str) -> int:
+    return HISTORY_TOKEN_BUDGET.get(model_name, HISTORY_TOKEN_BUDGET["default"])
+
+
+async def summarize_history(history: List[History], model_name: str) -> str:
+    """
+    将较早的历史对话压缩为摘要，按 (模型, 对话内容) 缓存
+    """
+    payload = json.dumps([[h.role, h.content] for h in history] + [model_name], ensure_ascii=False)
+    key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    summary = history_summary_cache.get(key)
+    if summary is not None:
+        return summary
+
+    async def generate() -> str:
+        chat_prompt = ChatPrompt([], get_prompt_template("history_summary", "default"))
+        text = "\n".join(f"{h.role}: {h.content}" for h in history)
+        summary = await complete(chat_prompt, {"history": text}, model_name, 0, HISTORY_SUMMARY_MAX_TOKENS)
+        history_summary_cache.set(key, summary, len(summary.encode("utf-8")))
+        return summary
+
+    return await history_summary_flight.do(key, generate)
+
+
+async def budget_history(history: List[History], model_name: str, deadline: Optional[Deadline] = None) -> List[History]:
+    """
+    按模型的token预算裁剪历史对话，保留最近的消息；开启摘要时较早的消息压缩为一条摘要
+    摘要最多等待 HISTORY_SUMMARY_TIMEOUT 秒（且不超过请求的剩余时间），超时或失败时只保留最近的消息
+    """
+    token_budget = get_history_token_budget(model_name)
+    older, recent = split_history(history, model_name, token_budget)
+    if not older or not HISTORY_SUMMARY_ENABLE:
+        return recent
+
+    older, recent = split_history(history, model_name, max(token_budget - HISTORY_SUMMARY_MAX_TOKENS, 0))
+    timeout = HISTORY_SUMMARY_TIMEOUT
+    if deadline is not None:
+        timeout = min(timeout, deadline.remaining())
+    try:
+        summary = await asyncio.wait_for(summarize_history(older, model_name), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"压缩历史对话超时（{timeout:g}秒），仅保留最近的消息")
+        return recent
+    except asyncio.CancelledError:
+        # 请求本身被取消（如客户端断开）时继续抛出，只有摘要调用被取消时才降级
+        if asyncio.current_task().cancelling():
+            raise
+        logger.warning("压缩历史对话被取消，仅保留最近的消息")
+        return recent
+    except Exception as e:
+        logger.error(f"压缩历史对话失败，仅保留最近的消息：{e}")
+        return recent
+    return [History(role="system", content=f"此前对话的摘要：{summary}")] + recent
@@ -0,0 +1,123 @@
+"""
+响应压缩：按请求头 Accept-Encoding 协商 br / gzip，只压缩超过 COMPRESSION_MIN_SIZE 字节的非流式响应
+
+流式响应（SSE、NDJSON）逐条发送，不做压缩，避免压缩缓冲推迟token的发送；
+br 需要安装 brotli，未安装时只使用 gzip。中间件需在 application/settings.py 的 MIDDLEWARES 中最先注册（最内层），
+外层基于 BaseHTTPMiddleware 的中间件会把响应体转为分块发送
+"""
+
+import gzip
+from typing import Optional
+
+from fastapi import FastAPI
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from application.settings import COMPRESSION_ENABLE, COMPRESSION_MIN_SIZE, COMPRESSION_GZIP_LEVEL, \
+    COMPRESSION_BROTLI_QUALITY
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STREAMING_CONTENT_TYPES = ("text/event-stream", "application/x-ndjson")
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    从 Accept-Encoding 中选择压缩方式，优先 br，q=0 表示不接受
+    """
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int, gzip_level: int, brotli_quality: int):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    @staticmethod
+    def compressible(headers: Headers) -> bool:
+        """
+        只有带 Content-Length 的非流式响应可能被压缩：SSE/NDJSON 和没有 Content-Length 的响应原样透传
+        """
+        content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+        return (content_type not in STREAMING_CONTENT_TYPES and "content-length" in headers
+                and "content-encoding" not in headers)
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+
+        async def send_compressed(message: Message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                if not self.compressible(Headers(raw=message["headers"])):
+                    # 流式响应立即发送响应头，不等第一段响应体
+                    await send(message)
+                    return
+                # 等收到第一段响应体，确定是否为完整的非流式响应后再发送响应头
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+
+            start, start_message = start_message, None
+            headers = MutableHeaders(raw=start["headers"])
+            body = message.get("body", b"")
+            if message.get("more_body", False) or len(body) < self.minimum_size:
+                await send(start)
+                await send(message)
+                return
+
+            body = self.compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def register_compression_middleware(app: FastAPI):
+    """
+    响应压缩中间件
+    """
+    if COMPRESSION_ENABLE:
+        app.add_middleware(
+            CompressionMiddleware,
+            minimum_size=COMPRESSION_MIN_SIZE,
+            gzip_level=COMPRESSION_GZIP_LEVEL,
+            brotli_quality=COMPRESSION_BROTLI_QUALITY,
+        )
@@ -0,0 +1,73 @@
+"""
+知识库上下文组装：去除重复/近似重复的文档，按相关度排序，并在token预算内装入上下文
+"""
+
+import hashlib
+from typing import Dict, List, Optional, Set, Tuple
+
+from application.settings import CONTEXT_NEAR_DUPLICATE_THRESHOLD, CONTEXT_SHINGLE_SIZE
+from .tokenizer import count_tokens
+from .utils import DocumentWithVSId, normalize_query
+
+DROPPED_DUPLICATE = "duplicate"
+DROPPED_NEAR_DUPLICATE = "near_duplicate"
+DROPPED_BUDGET = "budget"
+
+
+def _shingles(text: str, size: int = CONTEXT_SHINGLE_SIZE) -> Set[str]:
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def _jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _dropped(doc: DocumentWithVSId, reason: str) -> Dict:
+    return {"id": doc.id, "knowledge_base_name": doc.metadata.get("knowledge_base_name"), "source": doc.metadata.get("source"),
+            "score": doc.score, "reason": reason}
+
+
+def pack_context(
+        docs: List[DocumentWithVSId],
+        model_name: str,
+        token_budget: Optional[int],
+        near_duplicate_threshold: float = CONTEXT_NEAR_DUPLICATE_THRESHOLD,
+) -> Tuple[List[DocumentWithVSId], List[Dict]]:
+    """
+    返回 (装入上下文的文档, 被丢弃的文档及原因)
+    score越小相关度越高，按score升序依次装入，装不下的文档跳过，继续尝试后面更短的文档
+    token_budget为None或不大于0时不限制
+    """
+    kept: List[DocumentWithVSId] = []
+    dropped: List[Dict] = []
+    seen_hashes: Set[str] = set()
+    kept_shingles: List[Set[str]] = []
+    used_tokens = 0
+
+    for doc in sorted(docs, key=lambda d: d.score):
+        normalized = normalize_query(doc.page_content)
+        digest = hashlib.md5(normalized.encode("utf-8")).hexdigest()
+        if digest in seen_hashes:
+            dropped.append(_dropped(doc, DROPPED_DUPLICATE))
+            continue
+
+        shingles = _shingles(normalized)
+        if any(_jaccard(shingles, other) >= near_duplicate_threshold for other in kept_shingles):
+            dropped.append(_dropped(doc, DROPPED_NEAR_DUPLICATE))
+            continue
+
+        tokens = count_tokens(doc.page_content, model_name) + 1  # 文档之间的换行
+        if token_budget and token_budget > 0 and used_tokens + tokens > token_budget:
+            dropped.append(_dropped(doc, DROPPED_BUDGET))
+            continue
+
+        used_tokens += tokens
+        seen_hashes.add(digest)
+        kept_shingles.append(shingles)
+        kept.append(doc)
+
+    return kept, dropped
@@ -0,0 +1,187 @@
+"""
+服务端会话存储：按 conversation_id 保存对话消息，请求只需传入 conversation_id，
+由服务端读取最近的历史消息，并在回答完成后追加本轮问答，请求体大小不随对话轮数增长
+
+默认使用SQLite，可通过 CONVERSATION_STORE 替换为实现了 ConversationStore 接口的其他存储
+"""
+
+import asyncio
+import importlib
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+from application.settings import CONVERSATION_STORE, CONVERSATION_STORE_OPTIONS, CONVERSATION_HISTORY_LIMIT, \
+    CONVERSATION_TTL
+from xiaoapi.core import logger
+from .history import History
+
+
+class ConversationStore(ABC):
+    """
+    会话存储接口
+    """
+
+    @abstractmethod
+    async def load(self, conversation_id: str, limit: int) -> List[History]:
+        """
+        按时间顺序返回会话最近的limit条消息，会话不存在时返回空列表
+        """
+
+    @abstractmethod
+    async def append(self, conversation_id: str, messages: List[History]):
+        """
+        追加消息并更新会话的最后更新时间
+        """
+
+    @abstractmethod
+    async def cleanup(self, expire_before: float) -> int:
+        """
+        删除最后更新时间早于expire_before的会话，返回删除的会话数
+        """
+
+    async def close(self):
+        pass
+
+
+_SQLITE_SCHEMA = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation_id TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages (conversation_id, id);
+"""
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    SQLite存储，数据库操作在线程池中执行；共用一个连接，按锁串行访问
+    """
+
+    def __init__(self, path: str):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(_SQLITE_SCHEMA)
+
+    def _load(self, conversation_id: str, limit: int) -> List[History]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, limit),
+            ).fetchall()
+        return [History(role=role, content=content) for role, content in reversed(rows)]
+
+    def _append(self, conversation_id: str, messages: List[History]):
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                    [(conversation_id, h.role, h.content, now) for h in messages],
+                )
+                self._conn.execute(
+                    "INSERT INTO conversations (conversation_id, updated_at) VALUES (?, ?) "
+                    "ON CONFLICT (conversation_id) DO UPDATE SET updated_at = excluded.updated_at",
+                    (conversation_id, now),
+                )
+
+    def _cleanup(self, expire_before: float) -> int:
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.execute(
+                    "DELETE FROM messages WHERE conversation_id IN "
+                    "(SELECT conversation_id FROM conversations WHERE updated_at < ?)",
+                    (expire_before,),
+                )
+                return self._conn.execute("DELETE FROM conversations WHERE updated_at < ?", (expire_before,)).rowcount
+
+    async def load(self, conversation_id: str, limit: int) -> List[History]:
+        return await asyncio.to_thread(self._load, conversation_id, limit)
+
+    async def append(self, conversation_id: str, messages: List[History]):
+        await asyncio.to_thread(self._append, conversation_id, messages)
+
+    async def cleanup(self, expire_before: float) -> int:
+        return await asyncio.to_thread(self._cleanup, expire_before)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_conversation_store: Optional[ConversationStore] = None
+
+
+def get_conversation_store() -> ConversationStore:
+    """
+    按 CONVERSATION_STORE 创建存储，首次使用时创建
+    """
+    global _conversation_store
+    if _conversation_store is None:
+        module_name, class_name = CONVERSATION_STORE.rsplit(".", 1)
+        store_class = getattr(importlib.import_module(module_name), class_name)
+        _conversation_store = store_class(**CONVERSATION_STORE_OPTIONS)
+    return _conversation_store
+
+
+async def close_conversation_store():
+    global _conversation_store
+    if _conversation_store is not None:
+        await _conversation_store.close()
+        _conversation_store = None
+
+
+async def load_history(request_data) -> List[History]:
+    """
+    传入conversation_id时从会话存储读取最近的历史消息，否则使用请求中的history
+    """
+    if request_data.conversation_id is None:
+        return [History.from_data(h) for h in request_data.history]
+    return await get_conversation_store().load(request_data.conversation_id, CONVERSATION_HISTORY_LIMIT)
+
+
+async def save_turn(request_data, answer: str):
+    """
+    回答完成后把本轮问答追加到会话；保存失败只记录日志，不影响本次回答
+    """
+    if request_data.conversation_id is None or not answer:
+        return
+    try:
+        await get_conversation_store().append(request_data.conversation_id, [
+            History(role="user", content=request_data.query),
+            History(role="assistant", content=answer),
+        ])
+    except Exception as e:
+        logger.error(f"保存会话 {request_data.conversation_id} 失败：{e}")
+
+
+async def run_cleanup(interval: float):
+    """
+    定时删除超过 CONVERSATION_TTL 未更新的会话
+    """
+    while True:
+        try:
+            removed = await get_conversation_store().cleanup(time.time() - CONVERSATION_TTL)
+            if removed:
+                logger.info(f"清理过期会话 {removed} 个")
+        except Exception as e:
+            logger.error(f"清理过期会话失败：{e}")
+        await asyncio.sleep(interval)
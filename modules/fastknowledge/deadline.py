@@ -0,0 +1,57 @@
+"""
+请求的截止时间：整个请求共享一个时间预算，检索使用其中一部分，剩余时间留给LLM生成
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Optional, TypeVar
+
+from application.settings import REQUEST_TIMEOUT, REQUEST_TIMEOUT_MAX, RETRIEVAL_TIMEOUT_RATIO
+
+T = TypeVar("T")
+
+# 请求头中指定超时时间（秒），请求体中的 timeout 字段优先
+TIMEOUT_HEADER = "X-Request-Timeout"
+
+
+class DeadlineExceeded(Exception):
+    """
+    请求的时间预算已用完
+    """
+
+
+class Deadline:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    @classmethod
+    def from_request(cls, timeout: Optional[float] = None, header_timeout: Optional[float] = None) -> "Deadline":
+        """
+        按 请求字段 > 请求头 > REQUEST_TIMEOUT 的顺序确定时间预算，不超过 REQUEST_TIMEOUT_MAX
+        """
+        for value in (timeout, header_timeout):
+            if value is not None and value > 0:
+                return cls(min(value, REQUEST_TIMEOUT_MAX))
+        return cls(REQUEST_TIMEOUT)
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def retrieval_timeout(self) -> float:
+        """
+        检索可用的时间：总预算的 RETRIEVAL_TIMEOUT_RATIO，且不超过剩余时间
+        """
+        return min(self.timeout * RETRIEVAL_TIMEOUT_RATIO, self.remaining())
+
+    def exceeded(self, stage: str) -> DeadlineExceeded:
+        return DeadlineExceeded(f"请求超时：{stage}未能在 {self.timeout:g} 秒的时间预算内完成")
+
+    async def run(self, aw: Awaitable[T], stage: str) -> T:
+        """
+        在剩余时间内等待执行完成，超时时取消并抛出 DeadlineExceeded
+        """
+        try:
+            return await asyncio.wait_for(aw, self.remaining())
+        except asyncio.TimeoutError:
+            raise self.exceeded(stage)
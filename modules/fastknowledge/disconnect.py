@@ -0,0 +1,104 @@
+"""
+客户端断开连接时取消进行中的检索和LLM生成
+
+非流式请求：处理过程与断开监听并发执行，客户端先断开时取消处理过程；
+流式请求：每次等待下一条消息时同时监听断开，客户端断开后取消进行中的生成并关闭输出
+"""
+
+import asyncio
+from typing import AsyncIterator, Awaitable, TypeVar
+
+from fastapi import Request
+
+from application.settings import CANCEL_ON_DISCONNECT
+from .metrics import cancelled_requests_total
+
+T = TypeVar("T")
+
+# 客户端已关闭连接（nginx的约定），响应不会被客户端收到，仅用于日志
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    """
+    客户端已断开连接
+    """
+
+
+async def wait_disconnected(request: Request):
+    """
+    等待客户端断开连接；请求体已读取完毕，之后只会收到 http.disconnect 消息
+    """
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(request: Request, aw: Awaitable[T], endpoint: str, model_name: str = "") -> T:
+    """
+    等待执行完成；客户端先断开时取消执行并抛出 ClientDisconnected
+    """
+    if not CANCEL_ON_DISCONNECT:
+        return await aw
+
+    task = asyncio.ensure_future(aw)
+    watcher = asyncio.ensure_future(wait_disconnected(request))
+    try:
+        done, _ = await asyncio.wait([task, watcher], return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+
+    if task in done:
+        return task.result()
+    task.cancel()
+    cancelled_requests_total.inc(endpoint=endpoint, model=model_name)
+    raise ClientDisconnected(f"客户端已断开连接，取消 {endpoint} 请求")
+
+
+async def stream_until_disconnect(
+        request: Request,
+        iterator: AsyncIterator[T],
+        endpoint: str,
+        model_name: str = "",
+) -> AsyncIterator[T]:
+    """
+    逐条输出iterator的内容，客户端断开时取消正在等待的下一条消息并关闭iterator
+    """
+    if not CANCEL_ON_DISCONNECT:
+        async for item in iterator:
+            yield item
+        return
+
+    watcher = asyncio.ensure_future(wait_disconnected(request))
+    pending = None
+    finished = False
+    try:
+        while True:
+            pending = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.wait([pending, watcher], return_when=asyncio.FIRST_COMPLETED)
+            if not pending.done():
+                return
+            try:
+                item = pending.result()
+            except StopAsyncIteration:
+                finished = True
+                return
+            except Exception:
+                finished = True
+                raise
+            pending = None
+            yield item
+    finally:
+        watcher.cancel()
+        if not finished:
+            # 客户端断开，断开可能先被 StreamingResponse 检测到，此时输出被取消
+            cancelled_requests_total.inc(endpoint=endpoint, model=model_name)
+        if pending is not None and not pending.done():
+            # 取消异常在iterator内部传播，iterator随之结束
+            pending.cancel()
+        else:
+            await iterator.aclose()
@@ -0,0 +1,56 @@
+"""
+生命周期事件，在 application/settings.py 的 EVENTS 中注册
+"""
+
+import asyncio
+
+from fastapi import FastAPI
+
+from application.settings import CONVERSATION_CLEANUP_INTERVAL
+from .conversation import run_cleanup, close_conversation_store
+from .llm_clients import llm_client_pool, llm_balancers
+from .utils import get_search_session, close_search_session
+
+
+async def connect_search_server(app: FastAPI, status: bool):
+    """
+    启动时创建访问fast-search服务的共享连接池，关闭时释放
+    """
+    if status:
+        get_search_session()
+    else:
+        await close_search_session()
+
+
+async def close_llm_clients(app: FastAPI, status: bool):
+    """
+    关闭时释放LLM客户端池中的连接
+    """
+    if not status:
+        await llm_client_pool.aclose()
+
+
+async def check_llm_backends(app: FastAPI, status: bool):
+    """
+    配置了多个LLM后端时，启动后台健康检查任务，关闭时取消
+    """
+    if status:
+        if llm_balancers:
+            app.state.llm_health_check = asyncio.create_task(llm_balancers.run_health_checks())
+    else:
+        task = getattr(app.state, "llm_health_check", None)
+        if task is not None:
+            task.cancel()
+
+
+async def cleanup_conversations(app: FastAPI, status: bool):
+    """
+    启动定时清理过期会话的后台任务，关闭时取消任务并关闭会话存储
+    """
+    if status:
+        app.state.conversation_cleanup = asyncio.create_task(run_cleanup(CONVERSATION_CLEANUP_INTERVAL))
+    else:
+        task = getattr(app.state, "conversation_cleanup", None)
+        if task is not None:
+            task.cancel()
+        await close_conversation_store()
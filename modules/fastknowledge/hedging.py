@@ -0,0 +1,146 @@
+"""
+对冲请求（hedged requests）：请求超过自适应阈值（近期延迟的分位数）仍未返回时，再发一个相同请求，取先成功的结果并取消另一个
+
+额外请求数受预算限制：每个请求存入 budget_percent% 个令牌，每次对冲消耗1个，令牌不足时不对冲
+"""
+
+import asyncio
+import itertools
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import numpy as np
+
+from .metrics import search_hedges_total
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """
+    记录最近 window 次请求的延迟，样本数达到 min_samples 前使用 initial_delay 作为阈值
+    """
+
+    def __init__(self, percentile: float, window: int, min_samples: int, initial_delay: float, min_delay: float):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self._samples = deque(maxlen=window)
+        self._threshold: Optional[float] = None
+        self._recompute_every = max(window // 20, 1)
+        self._observed = 0
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+        self._observed += 1
+        if self._observed % self._recompute_every == 0:
+            self._threshold = None
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def threshold(self) -> float:
+        if len(self._samples) < self.min_samples:
+            return self.initial_delay
+        if self._threshold is None:
+            self._threshold = max(float(np.percentile(self._samples, self.percentile)), self.min_delay)
+        return self._threshold
+
+
+class HedgeBudget:
+    """
+    令牌桶：每个请求存入 percent / 100 个令牌，最多积累 max_tokens 个
+    """
+
+    def __init__(self, percent: float, max_tokens: float = 10.0):
+        self.ratio = percent / 100.0
+        self.max_tokens = max_tokens
+        self.tokens = 0.0
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class Hedger:
+    """
+    只在事件循环线程中使用
+    首个请求发往 primary_url；对冲请求轮流发往 replica_urls，未配置副本时发往 primary_url，
+    same_url 为 False 时未配置副本则不对冲
+    """
+
+    def __init__(
+            self,
+            primary_url: str,
+            replica_urls: List[str],
+            percentile: float,
+            budget_percent: float,
+            window: int = 1000,
+            min_samples: int = 20,
+            initial_delay: float = 0.5,
+            min_delay: float = 0.01,
+            same_url: bool = True,
+    ):
+        self.primary_url = primary_url
+        self.replica_urls = [url for url in replica_urls if url != primary_url]
+        self.enabled = bool(self.replica_urls) or same_url
+        self._replicas = itertools.cycle(self.replica_urls or [primary_url])
+        self.tracker = LatencyTracker(percentile, window, min_samples, initial_delay, min_delay)
+        self.budget = HedgeBudget(budget_percent)
+
+    async def run(self, call: Callable[[str], Awaitable[T]]) -> T:
+        """
+        call 接收服务地址并发起请求；两个请求都失败时抛出后失败的异常
+        """
+        if not self.enabled:
+            return await call(self.primary_url)
+
+        loop = asyncio.get_running_loop()
+        self.budget.deposit()
+        primary = asyncio.ensure_future(call(self.primary_url))
+        started: Dict[asyncio.Future, float] = {primary: loop.time()}
+        try:
+            done, _ = await asyncio.wait([primary], timeout=self.tracker.threshold())
+            if not done:
+                if self.budget.withdraw():
+                    search_hedges_total.inc(outcome="sent")
+                    hedge = asyncio.ensure_future(call(next(self._replicas)))
+                    started[hedge] = loop.time()
+                else:
+                    search_hedges_total.inc(outcome="skipped")
+
+            error: Optional[BaseException] = None
+            while started:
+                done, _ = await asyncio.wait(list(started), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    start = started.pop(task)
+                    if task.exception() is None:
+                        if task is primary:
+                            self.tracker.observe(loop.time() - start)
+                        else:
+                            search_hedges_total.inc(outcome="won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            if primary in started:
+                # 首个请求被对冲请求抢先或随调用方一起取消：到取消为止的耗时是其延迟的下限，
+                # 同样计入样本，否则慢请求不进入统计，阈值会越来越低
+                self.tracker.observe(loop.time() - started[primary])
+            for task in started:
+                task.cancel()
+
+    def stats(self) -> Dict:
+        return {
+            "threshold": self.tracker.threshold(),
+            "samples": len(self.tracker),
+            "budget_tokens": self.budget.tokens,
+            "replicas": len(self.replica_urls),
+            "enabled": self.enabled,
+        }
@@ -1,7 +1,48 @@
+from functools import lru_cache
+
+from jinja2 import meta
 from pydantic import BaseModel, Field
 from langchain.prompts.chat import ChatMessagePromptTemplate
+from langchain_core.messages import ChatMessage
+from langchain_core.prompts import ChatPromptTemplate, StringPromptTemplate
 from typing import List, Tuple, Dict, Union
 
+from .prompt import compile_template, jinja2_env
+from .tokenizer import count_tokens
+
+# 每条消息除内容外的格式开销（role、分隔符等）
+MESSAGE_TOKEN_OVERHEAD = 4
+
+ROLE_MAPS = {
+    "ai": "assistant",
+    "human": "user",
+}
+
+
+class CompiledJinja2PromptTemplate(StringPromptTemplate):
+    """
+    使用按模板文本缓存的已编译jinja2模板渲染，避免每次渲染都重新解析编译
+    """
+    template: str
+
+    @property
+    def _prompt_type(self) -> str:
+        return "compiled_jinja2"
+
+    def format(self, **kwargs) -> str:
+        kwargs = self._merge_partial_and_user_variables(**kwargs)
+        return compile_template(self.template).render(**kwargs)
+
+
+@lru_cache(maxsize=256)
+def get_msg_template(content: str, role: str) -> ChatMessagePromptTemplate:
+    """
+    构建消息模板，按 (模板文本, 角色) 缓存
+    """
+    input_variables = sorted(meta.find_undeclared_variables(jinja2_env.parse(content)))
+    prompt = CompiledJinja2PromptTemplate(template=content, input_variables=input_variables)
+    return ChatMessagePromptTemplate(prompt=prompt, role=role)
+
 
 class History(BaseModel):
     """
@@ -17,22 +58,12 @@ class History(BaseModel):
     def to_msg_tuple(self):
         return "ai" if self.role=="assistant" else "human", self.content
 
-    def to_msg_template(self, is_raw=True) -> ChatMessagePromptTemplate:
-        role_maps = {
-            "ai": "assistant",
-            "human": "user",
-        }
-        role = role_maps.get(self.role, self.role)
-        if is_raw: # 当前默认历史消息都是没有input_variable的文本。
-            content = "{% raw %}" + self.content + "{% endraw %}"
-        else:
-            content = self.content
-
-        return ChatMessagePromptTemplate.from_template(
-            content,
-            "jinja2",
-            role=role,
-        )
+    def to_msg_template(self, is_raw=True) -> Union[ChatMessagePromptTemplate, ChatMessage]:
+        role = ROLE_MAPS.get(self.role, self.role)
+        if is_raw: # 当前默认历史消息都是没有input_variable的文本，直接作为消息，无需编译模板
+            return ChatMessage(role=role, content=self.content)
+
+        return get_msg_template(self.content, role)
 
     @classmethod
     def from_data(cls, h: Union[List, Tuple, Dict]) -> "History":
@@ -42,3 +73,44 @@ class History(BaseModel):
             h = cls(**h)
 
         return h
+
+
+class ChatPrompt:
+    """
+    对话prompt：历史消息原样作为消息，最后一条用户消息为jinja2模板，按输入变量渲染
+    可直接渲染为OpenAI接口的消息列表，也可转换为LangChain的 ChatPromptTemplate
+    """
+
+    __slots__ = ("history", "template")
+
+    def __init__(self, history: List[History], template: str):
+        self.history = history
+        self.template = template
+
+    def format_messages(self, inputs: Dict) -> List[Dict[str, str]]:
+        messages = [{"role": ROLE_MAPS.get(h.role, h.role), "content": h.content} for h in self.history]
+        messages.append({"role": "user", "content": compile_template(self.template).render(**inputs)})
+        return messages
+
+    def to_chat_prompt_template(self) -> ChatPromptTemplate:
+        input_msg = History(role="user", content=self.template).to_msg_template(False)
+        return ChatPromptTemplate.from_messages([h.to_msg_template() for h in self.history] + [input_msg])
+
+
+def count_history_tokens(history: List[History], model_name: str) -> int:
+    return sum(count_tokens(h.content, model_name) + MESSAGE_TOKEN_OVERHEAD for h in history)
+
+
+def split_history(history: List[History], model_name: str, token_budget: int) -> Tuple[List[History], List[History]]:
+    """
+    从最近的消息开始保留，直到超出token预算，返回 (超出预算的较早消息, 保留的最近消息)
+    """
+    used_tokens = 0
+    start = len(history)
+    while start > 0:
+        tokens = count_tokens(history[start - 1].content, model_name) + MESSAGE_TOKEN_OVERHEAD
+        if used_tokens + tokens > token_budget:
+            break
+        used_tokens += tokens
+        start -= 1
+    return history[:start], history[start:]
@@ -0,0 +1,540 @@
+"""
+OpenAI兼容接口的客户端池与多后端负载均衡
+
+ChatOpenAI 每次实例化都会创建新的 openai/httpx 客户端及连接池，
+这里按 LLM_MODELS_CONFIG 中的接口地址缓存长连接客户端，请求级参数（model_name、temperature、max_tokens）
+仍由每次创建的 ChatOpenAI 携带，从而复用 TLS 会话和 keep-alive 连接。
+
+模型在 LLM_MODELS_CONFIG["openai-api"]["backends"] 中配置了多个接口地址时，ChatOpenAI 使用负载均衡的
+chat.completions 对象：按进行中请求数最少选择后端，跳过健康检查失败和熔断中的后端，连接失败时换一个后端重试。
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import openai
+
+from application.settings import LLM_CLIENT_POOL_SIZE, LLM_CLIENT_MAX_CONNECTIONS, LLM_CLIENT_MAX_KEEPALIVE, \
+    LLM_CLIENT_KEEPALIVE_EXPIRY, LLM_CLIENT_TIMEOUT, LLM_MODELS_CONFIG, LLM_BALANCER_MAX_RETRIES, \
+    LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_TIMEOUT, LLM_HEALTH_CHECK_INTERVAL, LLM_HEALTH_CHECK_TIMEOUT
+from xiaoapi.core import logger
+from .metrics import llm_backend_requests_total, llm_client_pool_requests_total, llm_client_pool_evictions_total, \
+    llm_client_pool_size, llm_client_pool_retired
+
+
+class OpenAIClients:
+    """
+    同一接口地址共享的同步/异步客户端
+    """
+
+    def __init__(self, api_base_url: str, api_key: str):
+        limits = httpx.Limits(
+            max_connections=LLM_CLIENT_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_CLIENT_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_CLIENT_KEEPALIVE_EXPIRY,
+        )
+        self.api_base_url = api_base_url
+        self.client = openai.OpenAI(
+            api_key=api_key,
+            base_url=api_base_url,
+            timeout=LLM_CLIENT_TIMEOUT,
+            http_client=httpx.Client(limits=limits, timeout=LLM_CLIENT_TIMEOUT),
+        )
+        self.async_client = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=api_base_url,
+            timeout=LLM_CLIENT_TIMEOUT,
+            http_client=httpx.AsyncClient(limits=limits, timeout=LLM_CLIENT_TIMEOUT),
+        )
+        self.in_flight = 0  # 进行中的请求数，由 OpenAIClientPool 在锁内维护
+        self.evicted = False
+        self.closed = False
+
+    async def aclose(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.client.close()
+        await self.async_client.close()
+
+
+class TrackedCompletions:
+    """
+    包装 client.chat.completions，统计客户端进行中的请求数，流式响应读取完毕或中断时才算结束
+    """
+
+    def __init__(self, pool: "OpenAIClientPool", clients: OpenAIClients, completions: Any):
+        self.pool = pool
+        self.clients = clients
+        self.completions = completions
+
+    def create(self, **kwargs: Any) -> Any:
+        self.pool.acquire(self.clients)
+        try:
+            result = self.completions.create(**kwargs)
+        except BaseException:
+            self.pool.release(self.clients)
+            raise
+        if kwargs.get("stream"):
+            return _track_stream(result, lambda error: self.pool.release(self.clients))
+        self.pool.release(self.clients)
+        return result
+
+
+class AsyncTrackedCompletions(TrackedCompletions):
+    async def create(self, **kwargs: Any) -> Any:
+        self.pool.acquire(self.clients)
+        try:
+            result = await self.completions.create(**kwargs)
+        except BaseException:
+            self.pool.release(self.clients)
+            raise
+        if kwargs.get("stream"):
+            return _track_async_stream(result, lambda error: self.pool.release(self.clients))
+        self.pool.release(self.clients)
+        return result
+
+
+class OpenAIClientPool:
+    """
+    按 (api_base_url, api_key) 缓存客户端的LRU池，超过 max_size 时淘汰最久未使用的客户端
+
+    被淘汰的客户端可能仍被进行中的请求使用，等请求全部结束后再关闭其连接池
+    """
+
+    def __init__(self, max_size: int = LLM_CLIENT_POOL_SIZE):
+        self.max_size = max_size
+        self._clients: "OrderedDict[Tuple[str, str], OpenAIClients]" = OrderedDict()
+        self._retired: List[OpenAIClients] = []  # 已淘汰、仍有进行中请求的客户端
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, api_base_url: str, api_key: str) -> OpenAIClients:
+        key = (api_base_url, api_key)
+        if self._loop is None:
+            try:
+                self._loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+        idle = []
+        with self._lock:
+            clients = self._clients.get(key)
+            if clients is not None:
+                self._clients.move_to_end(key)
+                self.hits += 1
+                llm_client_pool_requests_total.inc(result="hit")
+                return clients
+
+            self.misses += 1
+            llm_client_pool_requests_total.inc(result="miss")
+            clients = OpenAIClients(api_base_url, api_key)
+            self._clients[key] = clients
+            while len(self._clients) > self.max_size:
+                _, evicted = self._clients.popitem(last=False)
+                evicted.evicted = True
+                self.evictions += 1
+                llm_client_pool_evictions_total.inc()
+                if evicted.in_flight:
+                    self._retired.append(evicted)
+                else:
+                    idle.append(evicted)
+            self._update_gauges()
+        for evicted in idle:
+            self._close_later(evicted)
+        return clients
+
+    def completions(self, clients: OpenAIClients, **options: Any) -> Tuple[TrackedCompletions, AsyncTrackedCompletions]:
+        """
+        返回统计进行中请求数的同步/异步 chat.completions，options 传给 with_options（如 max_retries）
+        """
+        client = clients.client.with_options(**options) if options else clients.client
+        async_client = clients.async_client.with_options(**options) if options else clients.async_client
+        return (
+            TrackedCompletions(self, clients, client.chat.completions),
+            AsyncTrackedCompletions(self, clients, async_client.chat.completions),
+        )
+
+    def acquire(self, clients: OpenAIClients):
+        with self._lock:
+            clients.in_flight += 1
+
+    def release(self, clients: OpenAIClients):
+        with self._lock:
+            clients.in_flight -= 1
+            idle = clients.evicted and clients.in_flight == 0 and clients in self._retired
+            if idle:
+                self._retired.remove(clients)
+                self._update_gauges()
+        if idle:
+            self._close_later(clients)
+
+    def _update_gauges(self):
+        llm_client_pool_size.set(len(self._clients))
+        llm_client_pool_retired.set(len(self._retired))
+
+    def _close_later(self, clients: OpenAIClients):
+        """
+        在事件循环中关闭客户端；可能在线程池中调用（同步请求），因此通过 run_coroutine_threadsafe 提交
+        """
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._aclose(clients), loop)
+        else:
+            # 没有事件循环时异步客户端未被使用过，只需关闭同步客户端
+            clients.closed = True
+            clients.client.close()
+
+    @staticmethod
+    async def _aclose(clients: OpenAIClients):
+        try:
+            await clients.aclose()
+        except Exception as e:
+            logger.warning(f"关闭LLM客户端失败：{clients.api_base_url}, {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "size": len(self._clients),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "retired": len(self._retired),
+                "endpoints": [
+                    {"api_base_url": clients.api_base_url, "in_flight": clients.in_flight}
+                    for clients in self._clients.values()
+                ],
+            }
+
+    async def aclose(self):
+        with self._lock:
+            clients = list(self._clients.values()) + self._retired
+            self._clients.clear()
+            self._retired = []
+            self._update_gauges()
+        for c in clients:
+            await self._aclose(c)
+
+
+llm_client_pool = OpenAIClientPool()
+
+
+#################
+# Load balancer #
+#################
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class NoAvailableBackendError(RuntimeError):
+    """
+    模型的所有后端都不可用（健康检查失败或熔断中）
+    """
+
+
+class CircuitBreaker:
+    """
+    连续失败 failure_threshold 次后熔断，reset_timeout 秒后放行一个试探请求：成功则恢复，失败则继续熔断
+    """
+
+    def __init__(self, failure_threshold: int = LLM_CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = LLM_CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def available(self) -> bool:
+        if self.state == CIRCUIT_CLOSED:
+            return True
+        if self.state == CIRCUIT_OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = CIRCUIT_HALF_OPEN
+            self._probing = False
+        return self.state == CIRCUIT_HALF_OPEN and not self._probing
+
+    def acquire(self):
+        if self.state == CIRCUIT_HALF_OPEN:
+            self._probing = True
+
+    def record_success(self):
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_neutral(self):
+        """
+        请求结束但不能说明后端是否正常（如被客户端断开或超时取消）：结束试探，熔断状态不变，下一个请求可以继续试探
+        """
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = CIRCUIT_OPEN
+            self.opened_at = time.monotonic()
+
+
+class LLMBackend:
+    """
+    一个OpenAI兼容接口地址，客户端关闭了openai内置的重试，失败时由负载均衡换后端重试
+    """
+
+    def __init__(self, model_name: str, api_base_url: str, api_key: str):
+        self.model_name = model_name
+        self.api_base_url = api_base_url
+        self.api_key = api_key
+        self.outstanding = 0
+        self.healthy = True
+        self.breaker = CircuitBreaker()
+        self._clients: Optional[Tuple[OpenAIClients, TrackedCompletions, AsyncTrackedCompletions]] = None
+
+    def _get_clients(self) -> Tuple[OpenAIClients, TrackedCompletions, AsyncTrackedCompletions]:
+        clients = llm_client_pool.get(self.api_base_url, self.api_key)
+        if self._clients is None or self._clients[0] is not clients:
+            self._clients = (clients,) + llm_client_pool.completions(clients, max_retries=0)
+        return self._clients
+
+    @property
+    def completions(self):
+        return self._get_clients()[1]
+
+    @property
+    def async_completions(self):
+        return self._get_clients()[2]
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        return self._get_clients()[0].async_client
+
+    def stats(self) -> Dict:
+        return {
+            "api_base_url": self.api_base_url,
+            "outstanding": self.outstanding,
+            "healthy": self.healthy,
+            "circuit": self.breaker.state,
+            "failures": self.breaker.failures,
+        }
+
+
+def _is_connection_error(e: BaseException) -> bool:
+    """
+    请求未到达后端（连接失败）时可以安全地换后端重试；超时的请求可能已在执行，不重试
+    """
+    return isinstance(e, openai.APIConnectionError) and not isinstance(e, openai.APITimeoutError)
+
+
+def _is_client_error(e: BaseException) -> bool:
+    """
+    后端返回了4xx错误，说明后端可以正常响应
+    """
+    return isinstance(e, openai.APIStatusError) and e.status_code < 500
+
+
+def _is_backend_failure(e: BaseException) -> bool:
+    """
+    计入熔断的失败：连接失败、超时和5xx错误
+    """
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code >= 500
+    return isinstance(e, (openai.APIConnectionError, httpx.TransportError))
+
+
+class LLMBalancer:
+    """
+    同一模型的一组后端，按进行中请求数最少选择，同样少时轮流选择
+    """
+
+    def __init__(self, model_name: str, backends: List[LLMBackend], max_retries: int = LLM_BALANCER_MAX_RETRIES):
+        self.model_name = model_name
+        self.backends = backends
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._rotation = itertools.count()
+
+    def acquire(self, exclude: List[LLMBackend]) -> LLMBackend:
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude and b.breaker.available()]
+            # 健康检查全部失败时仍尝试未熔断的后端，避免健康检查本身的问题导致服务完全不可用
+            candidates = [b for b in candidates if b.healthy] or candidates
+            if not candidates:
+                raise NoAvailableBackendError(f"模型 {self.model_name} 没有可用的后端")
+            offset = next(self._rotation)
+            backend = min(
+                (candidates[(offset + i) % len(candidates)] for i in range(len(candidates))),
+                key=lambda b: b.outstanding,
+            )
+            backend.outstanding += 1
+            backend.breaker.acquire()
+            return backend
+
+    def release(self, backend: LLMBackend, error: Optional[BaseException] = None):
+        with self._lock:
+            backend.outstanding -= 1
+            # 每种结果都要结束半开状态下的试探，否则试探被取消后后端会一直不可用
+            if error is None or _is_client_error(error):
+                backend.breaker.record_success()
+            elif _is_backend_failure(error):
+                backend.breaker.record_failure()
+            else:
+                backend.breaker.record_neutral()
+        outcome = "success" if error is None else type(error).__name__
+        llm_backend_requests_total.inc(model=self.model_name, backend=backend.api_base_url, outcome=outcome)
+
+    def _attempts(self) -> int:
+        return min(self.max_retries + 1, len(self.backends))
+
+    def create(self, **kwargs: Any) -> Any:
+        tried: List[LLMBackend] = []
+        for attempt in range(self._attempts()):
+            backend = self.acquire(tried)
+            tried.append(backend)
+            try:
+                result = backend.completions.create(**kwargs)
+            except Exception as e:
+                self.release(backend, e)
+                if not _is_connection_error(e) or attempt == self._attempts() - 1:
+                    raise
+                logger.warning(f"LLM后端连接失败，换后端重试：{backend.api_base_url}, {e}")
+                continue
+            if kwargs.get("stream"):
+                return _track_stream(result, lambda error: self.release(backend, error))
+            self.release(backend)
+            return result
+
+    async def acreate(self, **kwargs: Any) -> Any:
+        tried: List[LLMBackend] = []
+        for attempt in range(self._attempts()):
+            backend = self.acquire(tried)
+            tried.append(backend)
+            try:
+                result = await backend.async_completions.create(**kwargs)
+            except BaseException as e:
+                self.release(backend, e)
+                if not _is_connection_error(e) or attempt == self._attempts() - 1:
+                    raise
+                logger.warning(f"LLM后端连接失败，换后端重试：{backend.api_base_url}, {e}")
+                continue
+            if kwargs.get("stream"):
+                return _track_async_stream(result, lambda error: self.release(backend, error))
+            self.release(backend)
+            return result
+
+    async def check_health(self):
+        """
+        请求各后端的 /models 接口，连接失败或返回5xx的后端不再分配请求，直到检查恢复
+        """
+
+        async def check(backend: LLMBackend):
+            try:
+                await backend.async_client.with_options(
+                    max_retries=0, timeout=LLM_HEALTH_CHECK_TIMEOUT).models.list()
+                healthy = True
+            except Exception as e:
+                # 返回了非5xx的错误（如未实现 /models 接口）说明服务可达
+                healthy = not _is_backend_failure(e)
+                if backend.healthy and not healthy:
+                    logger.warning(f"LLM后端健康检查失败：{backend.api_base_url}, {e}")
+            backend.healthy = healthy
+
+        await asyncio.gather(*[check(backend) for backend in self.backends])
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"model_name": self.model_name, "backends": [b.stats() for b in self.backends]}
+
+
+def _track_stream(stream, release: Callable[[Optional[BaseException]], None]):
+    """
+    流式响应读取完毕或中断时才释放后端的进行中请求计数
+    """
+    error = None
+    try:
+        for chunk in stream:
+            yield chunk
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        release(error)
+
+
+async def _track_async_stream(stream, release: Callable[[Optional[BaseException]], None]) -> AsyncIterator:
+    error = None
+    try:
+        async for chunk in stream:
+            yield chunk
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        release(error)
+        # 迭代提前结束时关闭响应，释放连接；stream 可能是 openai 的 AsyncStream 或包装后的异步生成器
+        await (stream.aclose() if hasattr(stream, "aclose") else stream.close())
+
+
+class BalancedCompletions:
+    """
+    替代 client.chat.completions 传给 ChatOpenAI，只实现 ChatOpenAI 用到的 create 方法
+    """
+
+    def __init__(self, balancer: LLMBalancer):
+        self.balancer = balancer
+
+    def create(self, **kwargs: Any) -> Any:
+        return self.balancer.create(**kwargs)
+
+
+class AsyncBalancedCompletions:
+    """
+    替代 async_client.chat.completions 传给 ChatOpenAI
+    """
+
+    def __init__(self, balancer: LLMBalancer):
+        self.balancer = balancer
+
+    async def create(self, **kwargs: Any) -> Any:
+        return await self.balancer.acreate(**kwargs)
+
+
+class LLMBalancerRegistry:
+    """
+    按 LLM_MODELS_CONFIG["openai-api"]["backends"] 为每个模型创建负载均衡，未配置多后端的模型返回None
+    """
+
+    def __init__(self, configs: Dict):
+        self._balancers: Dict[str, LLMBalancer] = {}
+        default_key = configs.get("api_key", "EMPTY")
+        for model_name, backends in (configs.get("backends") or {}).items():
+            if backends:
+                self._balancers[model_name] = LLMBalancer(model_name, [
+                    LLMBackend(model_name, b["api_base_url"], b.get("api_key", default_key)) for b in backends
+                ])
+
+    def get(self, model_name: str) -> Optional[LLMBalancer]:
+        return self._balancers.get(model_name)
+
+    async def run_health_checks(self, interval: float = LLM_HEALTH_CHECK_INTERVAL):
+        while True:
+            await asyncio.gather(*[b.check_health() for b in self._balancers.values()])
+            await asyncio.sleep(interval)
+
+    def __bool__(self) -> bool:
+        return bool(self._balancers)
+
+    def stats(self) -> List[Dict]:
+        return [b.stats() for b in self._balancers.values()]
+
+
+llm_balancers = LLMBalancerRegistry(LLM_MODELS_CONFIG.get("openai-api", {}))
@@ -0,0 +1,70 @@
+"""
+精简的LLM执行路径：直接使用渲染好的消息，通过共享的异步客户端调用OpenAI兼容接口，
+不经过LangChain的chain、回调和run manager；与LangChain路径共用客户端池和负载均衡
+
+在 application/settings.py 中通过 LLM_ENGINE 选择执行路径
+"""
+
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional
+
+from .metrics import record_token_usage
+from .utils import get_completions
+
+
+async def acomplete(model_name: str, messages: List[Dict[str, str]], temperature: float, max_tokens: Optional[int]) -> str:
+    """
+    生成完整答案
+    """
+    _, completions = get_completions(model_name)
+    response = await completions.create(
+        model=model_name,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        n=1,
+        stream=False,
+    )
+    if response.usage is not None:
+        record_token_usage(model_name, response.usage.completion_tokens, response.usage.prompt_tokens)
+    return response.choices[0].message.content or ""
+
+
+async def astream(
+        model_name: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: Optional[int],
+        timeout: Optional[float] = None,
+) -> AsyncIterator[str]:
+    """
+    逐个返回生成的token；超过timeout秒仍未生成完毕时抛出 asyncio.TimeoutError，迭代提前结束时关闭上游响应
+    """
+    expires_at = asyncio.get_running_loop().time() + timeout if timeout is not None else None
+    _, completions = get_completions(model_name)
+    async with asyncio.timeout_at(expires_at):
+        stream = await completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            n=1,
+            stream=True,
+        )
+
+    tokens = 0
+    chunks = stream.__aiter__()
+    try:
+        while True:
+            # 每次等待单独计时：调用方可能在不同的task中迭代
+            async with asyncio.timeout_at(expires_at):
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+            if chunk.choices and chunk.choices[0].delta.content:
+                tokens += 1
+                yield chunk.choices[0].delta.content
+        record_token_usage(model_name, tokens)
+    finally:
+        await (stream.aclose() if hasattr(stream, "aclose") else stream.close())
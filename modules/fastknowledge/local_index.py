@@ -0,0 +1,372 @@
+"""
+进程内检索后端：内存映射的向量矩阵 + BM25倒排索引
+
+索引目录结构（每个知识库一个目录）：
+    meta.json           索引元信息（版本、向量维度、文档数、平均文档长度、词数）
+    vocab_bytes.npy     uint8，按UTF-8字节序排序后拼接的全部词
+    vocab_offsets.npy   int64 [词表大小 + 1]，每个词在 vocab_bytes 中的起止位置，词的序号即排序后的位置
+    vocab_prefixes.npy  S8 [词表大小]，每个词的前8个字节，用 np.searchsorted 定位候选范围
+    vectors.npy         float32 [文档数, 维度]，已归一化的文档向量
+    doc_lengths.npy     float32 [文档数]，文档分词后的长度
+    postings_offsets.npy int64 [词表大小 + 1]，每个词在倒排表中的起止位置
+    postings_docs.npy   int32，倒排表中的文档序号
+    postings_tfs.npy    float32，倒排表中的词频
+    docs.jsonl          文档内容，每行一个 {"id", "page_content", "metadata"}
+    docs_offsets.npy    int64 [文档数 + 1]，每个文档在 docs.jsonl 中的字节偏移
+
+数组文件（包括词表）均以 mmap 方式只读加载，多个工作进程共享同一份页缓存
+向量使用特征哈希生成，无需下载模型即可离线构建和检索
+"""
+
+import asyncio
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import typer
+from typer import Typer
+
+from application.settings import LOCAL_INDEX_ROOT, LOCAL_INDEX_BM25_WEIGHT, LOCAL_INDEX_BM25_K1, LOCAL_INDEX_BM25_B
+
+INDEX_VERSION = 2
+DEFAULT_DIM = 512
+VOCAB_PREFIX_BYTES = 8
+
+_WORD_RE = re.compile(r"[a-z0-9]+|[㐀-䶿一-鿿豈-﫿]+")
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    分词：英文数字按单词切分，中文按单字和相邻二元组切分
+    """
+    tokens = []
+    for word in _WORD_RE.findall(unicodedata.normalize("NFKC", text).lower()):
+        if _CJK_RE.match(word):
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def embed_tokens(tokens: Iterable[str], dim: int) -> np.ndarray:
+    """
+    特征哈希向量：词频取对数后按哈希映射到固定维度（带符号），再做L2归一化
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for token, tf in Counter(tokens).items():
+        h = zlib.crc32(token.encode("utf-8"))
+        vector[h % dim] += (1.0 + np.log(tf)) * (1.0 if h & 0x80000000 else -1.0)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def check_chunk_params(chunk_size: int, chunk_overlap: int):
+    """
+    重叠字符数不小于分块大小时窗口无法前进，分块数会随段落长度急剧增长
+    """
+    if chunk_size <= 0:
+        raise ValueError(f"chunk_size 必须大于0，当前为 {chunk_size}")
+    if not 0 <= chunk_overlap < chunk_size:
+        raise ValueError(f"chunk_overlap 必须大于等于0且小于 chunk_size（{chunk_size}），当前为 {chunk_overlap}")
+
+
+def split_text(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """
+    按段落切分文本，段落超过 chunk_size 时按字符窗口切分
+    """
+    check_chunk_params(chunk_size, chunk_overlap)
+    chunks = []
+    current = ""
+    for paragraph in (p.strip() for p in re.split(r"\n\s*\n", text)):
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) + 1 > chunk_size:
+            chunks.append(current)
+            current = ""
+        if len(paragraph) > chunk_size:
+            step = chunk_size - chunk_overlap
+            chunks.extend(paragraph[i:i + chunk_size] for i in range(0, len(paragraph) - chunk_overlap, step))
+            continue
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_index(
+        knowledge_base_name: str,
+        source_dir: str,
+        patterns: Tuple[str, ...] = ("*.txt", "*.md"),
+        chunk_size: int = 500,
+        chunk_overlap: int = 50,
+        dim: int = DEFAULT_DIM,
+        index_root: str = LOCAL_INDEX_ROOT,
+) -> Dict:
+    """
+    从文本文件目录构建知识库索引，先写入临时目录再整体替换，正在运行的服务不会读到半成品
+    """
+    check_chunk_params(chunk_size, chunk_overlap)
+    source = Path(source_dir)
+    files = sorted({f for pattern in patterns for f in source.rglob(pattern) if f.is_file()})
+
+    docs = []
+    for file in files:
+        text = file.read_text(encoding="utf-8", errors="ignore")
+        relative = file.relative_to(source).as_posix()
+        for i, chunk in enumerate(split_text(text, chunk_size, chunk_overlap)):
+            docs.append({"id": f"{relative}#{i}", "page_content": chunk, "metadata": {"source": relative}})
+
+    vocab: Dict[str, int] = {}
+    postings: List[List[Tuple[int, int]]] = []
+    vectors = np.zeros((len(docs), dim), dtype=np.float32)
+    doc_lengths = np.zeros(len(docs), dtype=np.float32)
+    for doc_index, doc in enumerate(docs):
+        tokens = tokenize(doc["page_content"])
+        doc_lengths[doc_index] = len(tokens)
+        vectors[doc_index] = embed_tokens(tokens, dim)
+        for token, tf in Counter(tokens).items():
+            term = vocab.get(token)
+            if term is None:
+                term = vocab[token] = len(postings)
+                postings.append([])
+            postings[term].append((doc_index, tf))
+
+    # 词按UTF-8字节序排序，词的序号为排序后的位置，倒排表按同样的顺序存放
+    terms = sorted((token.encode("utf-8") for token in vocab))
+    postings = [postings[vocab[term.decode("utf-8")]] for term in terms]
+    vocab_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    vocab_offsets[1:] = np.cumsum([len(term) for term in terms])
+    vocab_bytes = np.frombuffer(b"".join(terms), dtype=np.uint8)
+    vocab_prefixes = np.array([term[:VOCAB_PREFIX_BYTES] for term in terms], dtype=f"S{VOCAB_PREFIX_BYTES}")
+
+    offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(p) for p in postings])
+    postings_docs = np.fromiter((d for p in postings for d, _ in p), dtype=np.int32, count=int(offsets[-1]))
+    postings_tfs = np.fromiter((tf for p in postings for _, tf in p), dtype=np.float32, count=int(offsets[-1]))
+
+    index_dir = Path(index_root) / knowledge_base_name
+    tmp_dir = index_dir.with_name(f".{knowledge_base_name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    np.save(tmp_dir / "vectors.npy", vectors)
+    np.save(tmp_dir / "doc_lengths.npy", doc_lengths)
+    np.save(tmp_dir / "postings_offsets.npy", offsets)
+    np.save(tmp_dir / "postings_docs.npy", postings_docs)
+    np.save(tmp_dir / "postings_tfs.npy", postings_tfs)
+    np.save(tmp_dir / "vocab_bytes.npy", vocab_bytes)
+    np.save(tmp_dir / "vocab_offsets.npy", vocab_offsets)
+    np.save(tmp_dir / "vocab_prefixes.npy", vocab_prefixes)
+
+    docs_offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+    with open(tmp_dir / "docs.jsonl", "wb") as f:
+        for i, doc in enumerate(docs):
+            f.write(json.dumps(doc, ensure_ascii=False).encode("utf-8") + b"\n")
+            docs_offsets[i + 1] = f.tell()
+    np.save(tmp_dir / "docs_offsets.npy", docs_offsets)
+
+    meta = {
+        "version": INDEX_VERSION,
+        "dim": dim,
+        "count": len(docs),
+        "avgdl": float(doc_lengths.mean()) if len(docs) else 0.0,
+        "terms": len(terms),
+    }
+    with open(tmp_dir / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    old_dir = index_dir.with_name(f".{knowledge_base_name}.old")
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if index_dir.exists():
+        index_dir.rename(old_dir)
+    tmp_dir.rename(index_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    return {"knowledge_base_name": knowledge_base_name, "files": len(files), "documents": len(docs),
+            "terms": len(terms), "path": str(index_dir)}
+
+
+class LocalIndex:
+    """
+    只读的知识库索引，数组以 mmap 方式加载，检索时向量和BM25得分均为向量化计算
+    """
+
+    def __init__(self, index_dir: Path):
+        self.index_dir = index_dir
+        with open(index_dir / "meta.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            raise ValueError(f"不支持的索引版本：{meta.get('version')}，请重新构建索引 {index_dir}")
+        self.dim: int = meta["dim"]
+        self.count: int = meta["count"]
+        self.avgdl: float = meta["avgdl"] or 1.0
+        self.terms: int = meta["terms"]
+
+        self.vectors = np.load(index_dir / "vectors.npy", mmap_mode="r")
+        self.doc_lengths = np.load(index_dir / "doc_lengths.npy", mmap_mode="r")
+        self.postings_offsets = np.load(index_dir / "postings_offsets.npy", mmap_mode="r")
+        self.postings_docs = np.load(index_dir / "postings_docs.npy", mmap_mode="r")
+        self.postings_tfs = np.load(index_dir / "postings_tfs.npy", mmap_mode="r")
+        self.docs_offsets = np.load(index_dir / "docs_offsets.npy", mmap_mode="r")
+        self.vocab_bytes = np.load(index_dir / "vocab_bytes.npy", mmap_mode="r")
+        self.vocab_offsets = np.load(index_dir / "vocab_offsets.npy", mmap_mode="r")
+        self.vocab_prefixes = np.load(index_dir / "vocab_prefixes.npy", mmap_mode="r")
+
+        with open(index_dir / "docs.jsonl", "rb") as f:
+            self._docs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b""
+
+    def _term_bytes(self, term: int) -> bytes:
+        return self.vocab_bytes[self.vocab_offsets[term]:self.vocab_offsets[term + 1]].tobytes()
+
+    def lookup_term(self, token: str) -> Optional[int]:
+        """
+        返回词的序号，词表中没有时返回None：先按前缀用 np.searchsorted 定位范围，再在范围内二分查找完整的词
+        """
+        key = token.encode("utf-8")
+        prefix = np.bytes_(key[:VOCAB_PREFIX_BYTES])
+        lo = int(np.searchsorted(self.vocab_prefixes, prefix, side="left"))
+        hi = int(np.searchsorted(self.vocab_prefixes, prefix, side="right"))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            term = self._term_bytes(mid)
+            if term == key:
+                return mid
+            if term < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def bm25_scores(self, tokens: List[str], k1: float, b: float) -> np.ndarray:
+        scores = np.zeros(self.count, dtype=np.float32)
+        for token, qtf in Counter(tokens).items():
+            term = self.lookup_term(token)
+            if term is None:
+                continue
+            start, end = self.postings_offsets[term], self.postings_offsets[term + 1]
+            docs = self.postings_docs[start:end]
+            tfs = self.postings_tfs[start:end]
+            idf = np.log(1.0 + (self.count - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = k1 * (1.0 - b + b * self.doc_lengths[docs] / self.avgdl)
+            # 同一个词的倒排表中文档不重复，可直接按下标累加
+            scores[docs] += qtf * idf * tfs * (k1 + 1.0) / (tfs + norm)
+        return scores
+
+    def get_document(self, doc_index: int) -> Dict:
+        start, end = self.docs_offsets[doc_index], self.docs_offsets[doc_index + 1]
+        return json.loads(self._docs[start:end])
+
+    def search(
+            self,
+            query: str,
+            top_k: int,
+            score_threshold: float,
+            bm25_weight: float = LOCAL_INDEX_BM25_WEIGHT,
+            k1: float = LOCAL_INDEX_BM25_K1,
+            b: float = LOCAL_INDEX_BM25_B,
+    ) -> List[Dict]:
+        """
+        混合检索，返回与 fast-search 服务相同结构的文档字典
+        score 为距离（1 - 混合相似度），越小越相关，与 score_threshold 的含义一致
+        """
+        tokens = tokenize(query)
+        if not self.count or not tokens or top_k <= 0:
+            return []
+
+        similarity = self.vectors @ embed_tokens(tokens, self.dim)
+        if bm25_weight > 0:
+            bm25 = self.bm25_scores(tokens, k1, b)
+            peak = bm25.max()
+            if peak > 0:
+                bm25 /= peak
+            similarity = (1.0 - bm25_weight) * similarity + bm25_weight * bm25
+
+        distance = 1.0 - similarity
+        # 与问题没有任何共同特征的文档不返回
+        candidates = np.flatnonzero((distance <= score_threshold) & (similarity > 0))
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(distance[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(distance[candidates], kind="stable")]
+
+        results = []
+        for doc_index in candidates:
+            doc = self.get_document(int(doc_index))
+            doc["score"] = float(distance[doc_index])
+            results.append(doc)
+        return results
+
+
+class LocalIndexRegistry:
+    """
+    按知识库懒加载本地索引；索引目录被重建后（meta.json修改时间变化）自动重新加载
+    """
+
+    def __init__(self, index_root: str = LOCAL_INDEX_ROOT):
+        self.index_root = Path(index_root)
+        self._indexes: Dict[str, Tuple[int, LocalIndex]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, knowledge_base_name: str) -> LocalIndex:
+        index_dir = self.index_root / knowledge_base_name
+        try:
+            mtime = os.stat(index_dir / "meta.json").st_mtime_ns
+        except FileNotFoundError:
+            raise FileNotFoundError(f"知识库 {knowledge_base_name} 的本地索引不存在，请先执行 python manage.py build-index")
+
+        cached = self._indexes.get(knowledge_base_name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with self._lock:
+            cached = self._indexes.get(knowledge_base_name)
+            if cached is None or cached[0] != mtime:
+                cached = self._indexes[knowledge_base_name] = (mtime, LocalIndex(index_dir))
+            return cached[1]
+
+    async def search(self, query: str, knowledge_base_name: str, top_k: int, score_threshold: float) -> List[Dict]:
+        """
+        在线程池中执行检索，避免加载索引和打分阻塞事件循环
+        """
+        return await asyncio.to_thread(
+            lambda: self.get(knowledge_base_name).search(query, top_k, score_threshold))
+
+
+local_index_registry = LocalIndexRegistry()
+
+
+def register_command(shell: Typer):
+
+    @shell.command("build-index")
+    def build_index_command(
+            knowledge_base_name: str = typer.Argument(..., help="知识库名称"),
+            source_dir: str = typer.Argument(..., help="文本文件所在目录，递归读取"),
+            pattern: List[str] = typer.Option(["*.txt", "*.md"], help="文件名匹配模式，可多次指定"),
+            chunk_size: int = typer.Option(500, help="文档分块的最大字符数"),
+            chunk_overlap: int = typer.Option(50, help="超长段落切分时相邻分块的重叠字符数"),
+            dim: int = typer.Option(DEFAULT_DIM, help="哈希向量维度"),
+            index_root: str = typer.Option(LOCAL_INDEX_ROOT, help="索引存放目录"),
+    ):
+        """
+        从文本文件目录构建本地检索索引，在 KNOWLEDGE_BASE_BACKENDS 中将知识库配置为 "local" 后生效
+        """
+        try:
+            check_chunk_params(chunk_size, chunk_overlap)
+        except ValueError as e:
+            raise typer.BadParameter(str(e))
+        start = time.perf_counter()
+        result = build_index(knowledge_base_name, source_dir, tuple(pattern), chunk_size, chunk_overlap, dim, index_root)
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        typer.echo(json.dumps(result, ensure_ascii=False, indent=2))
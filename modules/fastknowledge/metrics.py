@@ -0,0 +1,356 @@
+"""
+指标采集：Prometheus文本格式的计数器/直方图，以及每个请求的 Server-Timing 响应头
+
+指标通过 /metrics 接口导出；Server-Timing 中间件需在 application/settings.py 的 MIDDLEWARES 中注册
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import FastAPI, Request
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from application.settings import LLM_MODELS, LLM_MODELS_CONFIG, KNOWLEDGE_BASE_BACKENDS, \
+    METRICS_MAX_KNOWLEDGE_BASE_LABELS
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+UNKNOWN_LABEL = "unknown"
+MULTIPLE_LABEL = "multiple"
+
+# 配置中的模型，其他模型名称记为unknown
+_known_models = frozenset(LLM_MODELS) | frozenset((LLM_MODELS_CONFIG.get("openai-api", {}).get("backends") or {}))
+
+
+class KnowledgeBaseLabels:
+    """
+    可以作为标签取值的知识库：配置了检索后端的知识库，以及检索返回过文档（确认存在）的知识库，数量有上限
+    """
+
+    def __init__(self, configured: Sequence[str], max_size: int):
+        self.max_size = max_size
+        self._known = set(configured)
+        self._lock = threading.Lock()
+
+    def add(self, knowledge_base_name: str):
+        if knowledge_base_name in self._known:
+            return
+        with self._lock:
+            if len(self._known) < self.max_size:
+                self._known.add(knowledge_base_name)
+
+    def label(self, knowledge_base_name: str) -> str:
+        if knowledge_base_name in self._known or knowledge_base_name in ("", MULTIPLE_LABEL):
+            return knowledge_base_name
+        return UNKNOWN_LABEL
+
+
+knowledge_base_labels = KnowledgeBaseLabels(KNOWLEDGE_BASE_BACKENDS, METRICS_MAX_KNOWLEDGE_BASE_LABELS)
+
+
+def _model_label(model_name: str) -> str:
+    return model_name if model_name in _known_models or model_name == "" else UNKNOWN_LABEL
+
+
+# 取值来自请求参数的标签，记录前先限制为已知的取值
+_LABEL_FILTERS = {
+    "model": _model_label,
+    "knowledge_base": knowledge_base_labels.label,
+}
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        values = []
+        for name in self.labelnames:
+            value = str(labels.get(name, ""))
+            label_filter = _LABEL_FILTERS.get(name)
+            values.append(label_filter(value) if label_filter is not None else value)
+        return tuple(values)
+
+    def collect(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        """
+        返回指标的样本行，不包括 HELP/TYPE 行
+        """
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values: Dict[Tuple[str, ...], List[float]] = {}  # 各桶计数 + [sum, count]
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def mean(self, **labels: str) -> Optional[float]:
+        values = self._values.get(self._key(labels))
+        if not values or not values[-1]:
+            return None
+        return values[-2] / values[-1]
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(values)) for key, values in self._values.items()]
+        lines = []
+        for key, values in items:
+            for bound, count in zip(self.buckets, values):
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{labels} {values[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.register(Counter(
+    "fastknowledge_requests_total", "Chat requests handled.", ("endpoint", "model", "cache")))
+errors_total = registry.register(Counter(
+    "fastknowledge_errors_total", "Chat requests that failed.", ("endpoint", "model", "knowledge_base")))
+retrieval_seconds = registry.register(Histogram(
+    "fastknowledge_retrieval_seconds", "Knowledge base retrieval latency.", ("knowledge_base",)))
+retrieval_documents = registry.register(Histogram(
+    "fastknowledge_retrieval_documents", "Documents returned by retrieval.", ("knowledge_base",), COUNT_BUCKETS))
+search_hedges_total = registry.register(Counter(
+    "fastknowledge_search_hedges_total", "Hedged search requests (sent, won, or skipped for lack of budget).", ("outcome",)))
+rerank_seconds = registry.register(Histogram(
+    "fastknowledge_rerank_seconds", "Retrieval rerank (MMR) time.", ("endpoint",)))
+prompt_build_seconds = registry.register(Histogram(
+    "fastknowledge_prompt_build_seconds", "Prompt build time.", ("endpoint",)))
+history_seconds = registry.register(Histogram(
+    "fastknowledge_history_seconds", "Conversation history load and budgeting (including summarization) time.",
+    ("endpoint",)))
+llm_seconds = registry.register(Histogram(
+    "fastknowledge_llm_seconds", "LLM generation latency.", ("model",)))
+llm_ttft_seconds = registry.register(Histogram(
+    "fastknowledge_llm_ttft_seconds", "LLM time to first token (streaming only).", ("model",)))
+llm_backend_requests_total = registry.register(Counter(
+    "fastknowledge_llm_backend_requests_total", "Requests sent to each LLM backend by outcome.", ("model", "backend", "outcome")))
+llm_client_pool_requests_total = registry.register(Counter(
+    "fastknowledge_llm_client_pool_requests_total", "LLM client pool lookups by result (hit or miss).", ("result",)))
+llm_client_pool_evictions_total = registry.register(Counter(
+    "fastknowledge_llm_client_pool_evictions_total", "LLM clients evicted from the pool."))
+llm_client_pool_size = registry.register(Gauge(
+    "fastknowledge_llm_client_pool_size", "LLM clients cached in the pool."))
+llm_client_pool_retired = registry.register(Gauge(
+    "fastknowledge_llm_client_pool_retired", "Evicted LLM clients waiting for in-flight requests before closing."))
+prompt_tokens_total = registry.register(Counter(
+    "fastknowledge_prompt_tokens_total", "Prompt tokens reported by the LLM.", ("model",)))
+completion_tokens_total = registry.register(Counter(
+    "fastknowledge_completion_tokens_total", "Completion tokens reported (or streamed) by the LLM.", ("model",)))
+llm_completion_tokens = registry.register(Histogram(
+    "fastknowledge_llm_completion_tokens", "Completion tokens per finished LLM generation.", ("model",), TOKEN_BUCKETS))
+cancelled_requests_total = registry.register(Counter(
+    "fastknowledge_cancelled_requests_total", "Chat requests cancelled because the client disconnected.", ("endpoint", "model")))
+cancelled_tokens_saved_total = registry.register(Counter(
+    "fastknowledge_cancelled_tokens_saved_total",
+    "Estimated completion tokens not generated because generation was cancelled (mean completion length minus tokens already generated).",
+    ("model",)))
+
+admission_wait_seconds = registry.register(Histogram(
+    "fastknowledge_admission_wait_seconds", "Time chat requests waited for a concurrency slot.", ("model", "priority")))
+admission_rejected_total = registry.register(Counter(
+    "fastknowledge_admission_rejected_total", "Chat requests rejected by admission control.", ("model", "priority", "reason")))
+admission_queue_depth = registry.register(Gauge(
+    "fastknowledge_admission_queue_depth", "Chat requests waiting for a concurrency slot.", ("model",)))
+admission_in_flight = registry.register(Gauge(
+    "fastknowledge_admission_in_flight", "Chat requests holding a concurrency slot.", ("model",)))
+
+
+class TokenUsageCallbackHandler(AsyncCallbackHandler):
+    """
+    统计LLM的token用量；流式输出时接口不返回用量，按收到的token数统计生成量
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.streamed_tokens = 0
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.streamed_tokens += 1
+
+    async def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage:
+            record_token_usage(self.model_name, usage.get("completion_tokens", 0), usage.get("prompt_tokens", 0))
+        elif self.streamed_tokens:
+            record_token_usage(self.model_name, self.streamed_tokens)
+
+
+def record_token_usage(model_name: str, completion_tokens: int, prompt_tokens: Optional[int] = None):
+    """
+    记录一次完成的LLM生成的token用量，流式输出时接口不返回prompt的用量
+    """
+    if prompt_tokens is not None:
+        prompt_tokens_total.inc(prompt_tokens, model=model_name)
+    completion_tokens_total.inc(completion_tokens, model=model_name)
+    llm_completion_tokens.observe(completion_tokens, model=model_name)
+
+
+def record_cancelled_generation(model_name: str, generated_tokens: int = 0):
+    """
+    LLM生成被取消时，按该模型完成生成的平均token数估算节省的token；还没有完成过的生成时不计
+    """
+    mean = llm_completion_tokens.mean(model=model_name)
+    if mean is not None:
+        cancelled_tokens_saved_total.inc(max(mean - generated_tokens, 0.0), model=model_name)
+
+
+##################
+# Server-Timing #
+##################
+
+_server_timing: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("server_timing", default=None)
+
+
+def record_server_timing(name: str, seconds: float):
+    """
+    记录当前请求某个阶段的耗时，写入 Server-Timing 响应头
+    """
+    timings = _server_timing.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def timed(name: str, histogram: Histogram, **labels: str) -> Iterator[None]:
+    """
+    统计代码块耗时，同时写入直方图和 Server-Timing
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        cost = time.perf_counter() - start
+        histogram.observe(cost, **labels)
+        record_server_timing(name, cost)
+
+
+def format_server_timing(timings: List[Tuple[str, float]]) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings)
+
+
+def register_server_timing_middleware(app: FastAPI):
+    """
+    Server-Timing响应头中间件，流式响应只包含响应头发送前已完成的阶段
+    """
+
+    @app.middleware("http")
+    async def server_timing_middleware(request: Request, call_next):
+        timings: List[Tuple[str, float]] = []
+        token = _server_timing.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            _server_timing.reset(token)
+        timings.append(("total", time.perf_counter() - start))
+        response.headers["Server-Timing"] = format_server_timing(timings)
+        return response
@@ -0,0 +1,88 @@
+"""
+prompt模板注册表
+
+PROMPT_TEMPLATES 只在 application/settings.py 文件修改后重新加载，加载时预编译全部模板并整体替换，
+稳定状态下获取模板只是一次字典查找。
+"""
+
+import importlib.util
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Optional
+
+from jinja2 import Template
+from jinja2.sandbox import SandboxedEnvironment
+
+from application import settings
+from application.settings import PROMPT_TEMPLATES_CHECK_INTERVAL
+from xiaoapi.core import logger
+
+jinja2_env = SandboxedEnvironment()
+
+
+@lru_cache(maxsize=1024)
+def compile_template(source: str) -> Template:
+    """
+    编译jinja2模板，按模板文本缓存
+    """
+    return jinja2_env.from_string(source)
+
+
+class PromptTemplateRegistry:
+    """
+    监视配置文件修改时间的prompt模板注册表
+    """
+
+    def __init__(self, settings_file: str = settings.__file__, check_interval: float = PROMPT_TEMPLATES_CHECK_INTERVAL):
+        self.settings_file = settings_file
+        self.check_interval = check_interval
+        # 启动时导入的模板作为初始版本，配置文件首次加载失败时继续使用
+        self._templates: Dict[str, Dict[str, str]] = {
+            type: dict(names) for type, names in settings.PROMPT_TEMPLATES.items()
+        }
+        self._mtime: Optional[int] = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _read_templates(self) -> Dict[str, Dict[str, str]]:
+        # 加载为独立模块，不影响已导入的 application.settings
+        spec = importlib.util.spec_from_file_location("_fastknowledge_prompt_settings", self.settings_file)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        templates = {type: dict(names) for type, names in module.PROMPT_TEMPLATES.items()}
+        for names in templates.values():
+            for source in names.values():
+                compile_template(source)
+        return templates
+
+    def reload(self):
+        """
+        检查配置文件修改时间，发生变化时重新加载并整体替换模板
+        """
+        with self._lock:
+            try:
+                mtime = os.stat(self.settings_file).st_mtime_ns
+            except OSError as e:
+                logger.error(f"读取prompt模板配置失败：{e}")
+                return
+            finally:
+                self._last_check = time.monotonic()
+            if mtime == self._mtime:
+                return
+
+            try:
+                self._templates = self._read_templates()
+            except Exception as e:
+                # 配置文件编辑中途出错时保留上一版模板
+                logger.error(f"加载prompt模板失败，继续使用上一版模板：{e}")
+            self._mtime = mtime
+
+    def get(self, type: str, name: str) -> Optional[str]:
+        if self._mtime is None or time.monotonic() - self._last_check >= self.check_interval:
+            self.reload()
+        return self._templates[type].get(name)
+
+
+prompt_template_registry = PromptTemplateRegistry()
@@ -0,0 +1,97 @@
+"""
+检索结果重排：对过采样的候选文档按 检索得分 + 词重叠得分 计算相关度，再用MMR（最大边际相关）去除冗余
+
+文本按字符二元组哈希为二值向量（一次性对所有候选文档向量化计算），词重叠、文档间相似度和MMR迭代均为矩阵运算
+"""
+
+from typing import List
+
+import numpy as np
+
+from application.settings import RERANK_MMR_LAMBDA, RERANK_LEXICAL_WEIGHT
+from .utils import DocumentWithVSId
+
+FEATURE_DIM = 4096
+
+_SPACE = np.uint32(32)
+_HASH_A = np.uint32(0x9E3779B1)
+_HASH_B = np.uint32(0x85EBCA6B)
+_HASH_SHIFT = np.uint32(12)
+_FEATURE_MASK = np.uint32(FEATURE_DIM - 1)
+
+
+def _bigram_matrix(texts: List[str]) -> np.ndarray:
+    """
+    每行为一个文本的字符二元组集合哈希后的二值向量
+    """
+    texts = [text.lower() for text in texts]
+    codes = np.frombuffer("\0".join(texts).encode("utf-32-le"), dtype=np.uint32)
+    rows = np.repeat(np.arange(len(texts)), [len(text) + 1 for text in texts])[:len(codes) - 1]
+
+    left, right = codes[:-1], codes[1:]
+    valid = (left > _SPACE) & (right > _SPACE)  # 跳过分隔符和空白
+    hashes = ((left * _HASH_A + right) * _HASH_B) >> _HASH_SHIFT
+    columns = rows[valid] * FEATURE_DIM + (hashes[valid] & _FEATURE_MASK)
+    matrix = np.zeros((len(texts), FEATURE_DIM), dtype=np.float32)
+    matrix.ravel()[columns] = 1.0
+    return matrix
+
+
+def relevance_scores(
+        docs: List[DocumentWithVSId],
+        query_vector: np.ndarray,
+        doc_matrix: np.ndarray,
+        lexical_weight: float,
+) -> np.ndarray:
+    """
+    相关度 = (1 - lexical_weight) * 归一化的检索得分 + lexical_weight * 问题词在文档中的覆盖率，越大越相关
+    """
+    distance = np.array([doc.score for doc in docs], dtype=np.float32)
+    spread = distance.max() - distance.min()
+    retrieval = 1.0 - (distance - distance.min()) / spread if spread > 0 else np.ones_like(distance)
+    overlap = doc_matrix @ query_vector / max(query_vector.sum(), 1.0)
+    return (1.0 - lexical_weight) * retrieval + lexical_weight * overlap
+
+
+def mmr_select(relevance: np.ndarray, doc_matrix: np.ndarray, top_k: int, mmr_lambda: float) -> List[int]:
+    """
+    MMR贪心选择：每轮选 mmr_lambda * 相关度 - (1 - mmr_lambda) * 与已选文档的最大相似度 最大的文档
+    doc_matrix 的行需已归一化，每轮只计算新选中文档与其余文档的余弦相似度
+    """
+    count = len(relevance)
+    selected: List[int] = []
+    max_similarity = np.zeros(count, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    for _ in range(min(top_k, count)):
+        gain = np.where(available, mmr_lambda * relevance - (1.0 - mmr_lambda) * max_similarity, -np.inf)
+        best = int(np.argmax(gain))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, doc_matrix @ doc_matrix[best], out=max_similarity)
+    return selected
+
+
+def rerank_docs(
+        query: str,
+        docs: List[DocumentWithVSId],
+        top_k: int,
+        mmr_lambda: float = RERANK_MMR_LAMBDA,
+        lexical_weight: float = RERANK_LEXICAL_WEIGHT,
+) -> List[DocumentWithVSId]:
+    """
+    从候选文档中选出top_k个，按选中顺序返回；文档的score保持检索服务返回的值
+    mmr_lambda为1时只按相关度排序，越小越倾向于多样性
+    """
+    if len(docs) <= 1 or top_k <= 0:
+        return docs[:top_k]
+
+    matrix = _bigram_matrix([query] + [doc.page_content for doc in docs])
+    query_vector, doc_matrix = matrix[0], matrix[1:]
+    relevance = relevance_scores(docs, query_vector, doc_matrix, lexical_weight)
+    if mmr_lambda >= 1:
+        order = np.argsort(-relevance, kind="stable")[:top_k]
+        return [docs[i] for i in order]
+
+    # 二值向量的L2范数为非零元素个数的平方根
+    doc_matrix /= np.sqrt(np.maximum(doc_matrix.sum(axis=1, keepdims=True), 1.0))
+    return [docs[i] for i in mmr_select(relevance, doc_matrix, top_k, mmr_lambda)]
@@ -1,26 +1,42 @@
+import asyncio
 import time
-from typing import List, Optional
+from typing import List, Literal, Optional, Dict, Tuple, Union
 from urllib.parse import urlencode
 
-from fastapi import APIRouter, Depends, Body, Request
-from langchain.chains import LLMChain
-from langchain_core.prompts import ChatPromptTemplate
-from pydantic import BaseModel, Field
-from starlette.responses import JSONResponse
+import orjson
+from fastapi import APIRouter, Depends, Body, Request, Header, status
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, field_validator
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse
 
 from application.settings import VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD, TEMPERATURE, LLM_MODELS, SEARCH_SERVER_URL, \
-    MAX_TOKENS
+    MAX_TOKENS, BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY, BATCH_MAX_ITEMS, CONTEXT_TOKEN_BUDGET, MAX_KNOWLEDGE_BASES, \
+    RERANK_ENABLE, RERANK_OVERSAMPLE, RERANK_MAX_CANDIDATES, RERANK_MMR_LAMBDA, RERANK_LEXICAL_WEIGHT
 from xiaoapi.core import logger
 from xiaoapi.response import ErrorResponse
-from .history import History
-from .utils import search_docs, get_prompt_template, get_ChatOpenAI
+from .admission import admit, hold_permit, AdmissionRejected, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from .chat import ainvoke_answer, astream_answer, budget_history
+from .conversation import load_history, save_turn
+from .context import pack_context
+from .deadline import Deadline, DeadlineExceeded, TIMEOUT_HEADER
+from .disconnect import cancel_on_disconnect, stream_until_disconnect, ClientDisconnected, CLIENT_CLOSED_REQUEST
+from .history import ChatPrompt, History
+from .metrics import timed, prompt_build_seconds, history_seconds, rerank_seconds, requests_total, errors_total, \
+    MULTIPLE_LABEL
+from .rerank import rerank_docs
+from .utils import search_knowledge_bases, get_prompt_template, format_sse, DocumentWithVSId
 
 router = APIRouter()
 
 
 class KnowledgeBaseChatRequest(BaseModel):
     query: str = Field(..., description="用户输入", examples=["你好"])
-    knowledge_base_name: str = Field(..., description="知识库名称", examples=["samples"])
+    knowledge_base_name: Union[str, List[str]] = Field(
+        ...,
+        description="知识库名称，传入列表时并发检索多个知识库，按相关度合并后取top_k",
+        examples=["samples", ["samples", "faq"]],
+    )
     top_k: int = Field(VECTOR_SEARCH_TOP_K, description="匹配向量数")
     score_threshold: float = Field(
         SCORE_THRESHOLD,
@@ -28,19 +44,64 @@ class KnowledgeBaseChatRequest(BaseModel):
         ge=0,
         le=2
     )
+    rerank: bool = Field(RERANK_ENABLE, description="是否对检索结果重排：多取候选文档，按相关度和多样性（MMR）选出top_k")
+    rerank_oversample: int = Field(RERANK_OVERSAMPLE, description="重排时候选文档数相对top_k的倍数", ge=1)
+    mmr_lambda: float = Field(RERANK_MMR_LAMBDA, description="MMR中相关度的权重，1表示只按相关度排序，越小越倾向于多样性", ge=0.0, le=1.0)
+    lexical_weight: float = Field(RERANK_LEXICAL_WEIGHT, description="重排相关度中词重叠得分的权重", ge=0.0, le=1.0)
 
+    conversation_id: Optional[str] = Field(
+        None,
+        description="会话ID，传入时由服务端读取最近的历史对话并在回答完成后保存本轮问答，无需传入history",
+        max_length=128,
+    )
     history: List[History] = Field(
         [],
-        description="历史对话",
+        description="历史对话，传入conversation_id时忽略",
         examples=[[
             {"role": "user", "content": "我们来玩成语接龙，我先来，生龙活虎"},
             {"role": "assistant", "content": "虎头虎脑"}]
         ]
     )
+    stream: bool = Field(False, description="流式输出，为True时以 text/event-stream 逐个返回token，知识库匹配结果以 docs 事件返回")
     model_name: str = Field(LLM_MODELS[0], description="LLM 模型名称。")
     temperature: float = Field(TEMPERATURE, description="LLM 采样温度", ge=0.0, le=1.0)
     max_tokens: int = Field(MAX_TOKENS, description="限制LLM生成Token数量，默认None代表模型最大值")
     prompt_name: str = Field("default", description="使用的prompt模板名称(在configs/prompt_config.py中配置)")
+    context_token_budget: int = Field(CONTEXT_TOKEN_BUDGET, description="知识库上下文的token预算，0表示不限制", ge=0)
+    citation_format: Literal["markdown", "compact"] = Field(
+        "markdown",
+        description="出处格式：markdown为带链接和文档内容的Markdown文本；compact为结构化出处（id、source、score、url），同一文件只返回一条",
+    )
+    citation_content: bool = Field(False, description="compact格式时是否返回文档内容，同一文件的多个分块内容合并返回")
+    cache: Optional[bool] = Field(
+        None,
+        description="答案缓存：不传时仅在temperature为0时使用缓存，true为强制使用，false为跳过缓存",
+    )
+    priority: Literal["interactive", "batch"] = Field(
+        PRIORITY_INTERACTIVE,
+        description="请求优先级，模型繁忙排队时interactive优先于batch；批量接口中固定为batch",
+    )
+    timeout: Optional[float] = Field(
+        None,
+        description="请求的时间预算（秒），不传时使用请求头 X-Request-Timeout 或服务端默认值；检索超时后不使用知识库内容继续回答",
+        gt=0,
+    )
+
+    @field_validator("knowledge_base_name")
+    @classmethod
+    def check_knowledge_base_name(cls, value: Union[str, List[str]]) -> Union[str, List[str]]:
+        if isinstance(value, list):
+            value = list(dict.fromkeys(value))
+            if not value:
+                raise ValueError("知识库列表不能为空")
+            if len(value) > MAX_KNOWLEDGE_BASES:
+                raise ValueError(f"最多同时检索 {MAX_KNOWLEDGE_BASES} 个知识库")
+        return value
+
+    @property
+    def knowledge_base_names(self) -> List[str]:
+        name = self.knowledge_base_name
+        return [name] if isinstance(name, str) else name
 
     class Config:
         title = "Knowledge Base Chat Request"
@@ -48,13 +109,97 @@ class KnowledgeBaseChatRequest(BaseModel):
         protected_namespaces = ()  # 添加这一行来忽略'模型_'前缀的保护性警告
 
 
-@router.post("/knowledge_base_chat", summary="与知识库对话")
-async def knowledge_base_chat(request_data: KnowledgeBaseChatRequest):
+def get_download_url(knowledge_base_name: str, filename: str) -> str:
+    parameters = urlencode({"knowledge_base_name": knowledge_base_name, "file_name": filename})
+    return f"{SEARCH_SERVER_URL}/knowledge_base/download_doc?" + parameters
+
+
+def format_source_documents(docs: List[DocumentWithVSId]) -> List[str]:
+    """
+    将匹配到的文档格式化为带出处链接的Markdown，出处标注文档所属的知识库
+    """
+    source_documents = []
+    for inum, doc in enumerate(docs):
+        filename = doc.metadata.get("source")
+        knowledge_base_name = doc.metadata.get("knowledge_base_name")
+        url = get_download_url(knowledge_base_name, filename)
+        text = f"""出处 [{inum + 1}] [{knowledge_base_name}/{filename}]({url}) \n\n{doc.page_content}\n\n"""
+        source_documents.append(text)
+
+    if len(source_documents) == 0:  # 没有找到相关文档
+        source_documents.append(f"<span style='color:red'>未找到相关文档,该回答为大模型自身能力解答！</span>")
+
+    return source_documents
+
+
+def compact_source_documents(docs: List[DocumentWithVSId], include_content: bool = False) -> List[Dict]:
+    """
+    将匹配到的文档格式化为结构化出处，同一知识库的同一文件只保留一条（取最相关分块的id和score），按首次出现的顺序返回
+    """
+    citations: Dict[Tuple[str, str], Dict] = {}
+    contents: Dict[Tuple[str, str], List[str]] = {}
+    for doc in docs:
+        filename = doc.metadata.get("source")
+        knowledge_base_name = doc.metadata.get("knowledge_base_name")
+        key = (knowledge_base_name, filename)
+        citation = citations.get(key)
+        if citation is None:
+            citations[key] = {
+                "id": doc.id,
+                "knowledge_base_name": knowledge_base_name,
+                "source": filename,
+                "score": doc.score,
+                "url": get_download_url(knowledge_base_name, filename),
+            }
+            contents[key] = [doc.page_content]
+        else:
+            if doc.score < citation["score"]:
+                citation["id"], citation["score"] = doc.id, doc.score
+            contents[key].append(doc.page_content)
+
+    if include_content:
+        for key, citation in citations.items():
+            citation["content"] = "\n\n".join(contents[key])
+    return list(citations.values())
+
+
+def count_error(endpoint: str, request_data: KnowledgeBaseChatRequest):
+    names = request_data.knowledge_base_names
+    knowledge_base = names[0] if len(names) == 1 else MULTIPLE_LABEL
+    errors_total.inc(endpoint=endpoint, model=request_data.model_name, knowledge_base=knowledge_base)
+
+
+async def build_knowledge_base_chat(
+        request_data: KnowledgeBaseChatRequest,
+        deadline: Deadline,
+) -> Tuple[ChatPrompt, Dict, Dict]:
+    """
+    检索知识库并构建prompt，返回 (chat_prompt, 模板变量, 检索结果信息)
+    检索结果信息包括格式化后的出处、未放入上下文的文档、检索失败的知识库，以及是否因检索超时降级
+    """
+    top_k = request_data.top_k
+    if request_data.rerank:
+        top_k = max(min(top_k * request_data.rerank_oversample, RERANK_MAX_CANDIDATES), top_k)
+    start_time = time.time()
     try:
-        start_time = time.time()
-        docs = await search_docs(request_data.query, request_data.knowledge_base_name, request_data.top_k, request_data.score_threshold)
-        end_time = time.time()
-        logger.debug(f"search_docs:{docs}, time:{end_time-start_time}")
+        docs, search_errors = await search_knowledge_bases(
+            request_data.query, request_data.knowledge_base_names, top_k, request_data.score_threshold,
+            timeout=deadline.retrieval_timeout())
+    except asyncio.TimeoutError:
+        # 所有知识库都检索超时，不使用知识库内容继续回答
+        docs = []
+        search_errors = [{"knowledge_base_name": name, "reason": "timeout"} for name in request_data.knowledge_base_names]
+    degraded = any(error["reason"] == "timeout" for error in search_errors)
+    end_time = time.time()
+    logger.debug(f"search_docs:{docs}, errors:{search_errors}, degraded:{degraded}, time:{end_time-start_time}")
+
+    if request_data.rerank:
+        with timed("rerank", rerank_seconds, endpoint="knowledge_base_chat"):
+            docs = rerank_docs(request_data.query, docs, request_data.top_k, request_data.mmr_lambda,
+                               request_data.lexical_weight)
+
+    with timed("prompt", prompt_build_seconds, endpoint="knowledge_base_chat"):
+        docs, dropped_docs = pack_context(docs, request_data.model_name, request_data.context_token_budget)
         context = "\n".join([doc.page_content for doc in docs])
 
         if len(docs) == 0:  # 如果没有找到相关文档，使用empty模板
@@ -62,34 +207,192 @@ async def knowledge_base_chat(request_data: KnowledgeBaseChatRequest):
         else:
             prompt_template = get_prompt_template("knowledge_base_chat", request_data.prompt_name)
 
-        history = [History.from_data(h) for h in request_data.history]
-        input_msg = History(role="user", content=prompt_template).to_msg_template(False)
-        chat_prompt = ChatPromptTemplate.from_messages(
-            [i.to_msg_template() for i in history] + [input_msg])
-
-        start_time = time.time()
-        model = get_ChatOpenAI(
-            model_name=request_data.model_name,
-            temperature=request_data.temperature,
-            max_tokens=request_data.max_tokens
-        )
-        chain = LLMChain(prompt=chat_prompt, llm=model)
-        answer = await chain.ainvoke({"context": context, "question": request_data.query})
-        end_time = time.time()
-        logger.debug(f"llm response:{answer['text']}, time:{end_time-start_time}")
-
-        source_documents = []
-        for inum, doc in enumerate(docs):
-            filename = doc.metadata.get("source")
-            parameters = urlencode({"knowledge_base_name": request_data.knowledge_base_name, "file_name": filename})
-            url = f"{SEARCH_SERVER_URL}/knowledge_base/download_doc?" + parameters
-            text = f"""出处 [{inum + 1}] [{filename}]({url}) \n\n{doc.page_content}\n\n"""
-            source_documents.append(text)
-
-        if len(source_documents) == 0:  # 没有找到相关文档
-            source_documents.append(f"<span style='color:red'>未找到相关文档,该回答为大模型自身能力解答！</span>")
-
-        return JSONResponse({"code": 200, "answer": answer["text"], "docs": source_documents})
+    # 历史对话的加载和摘要可能访问数据库和LLM，单独计时，不计入prompt构建
+    with timed("history", history_seconds, endpoint="knowledge_base_chat"):
+        history = await load_history(request_data)
+        history = await budget_history(history, request_data.model_name, deadline)
+    chat_prompt = ChatPrompt(history, prompt_template)
+
+    if request_data.citation_format == "compact":
+        source_documents = compact_source_documents(docs, request_data.citation_content)
+    else:
+        source_documents = format_source_documents(docs)
+    docs_info = {
+        "docs": source_documents,
+        "dropped_docs": dropped_docs,
+        "failed_knowledge_bases": search_errors,
+        "degraded": degraded,
+    }
+    return chat_prompt, {"context": context, "question": request_data.query}, docs_info
+
+
+async def knowledge_base_chat_answer(request_data: KnowledgeBaseChatRequest, deadline: Optional[Deadline] = None) -> Dict:
+    """
+    非流式对话，返回响应内容
+    """
+    deadline = deadline or Deadline.from_request(request_data.timeout)
+    chat_prompt, inputs, docs_info = await build_knowledge_base_chat(request_data, deadline)
+
+    start_time = time.time()
+    answer, cache_status = await ainvoke_answer(request_data, chat_prompt, inputs, deadline)
+    end_time = time.time()
+    logger.debug(f"llm response:{answer}, cache:{cache_status}, time:{end_time-start_time}")
+    requests_total.inc(endpoint="knowledge_base_chat", model=request_data.model_name, cache=cache_status)
+    await save_turn(request_data, answer)
 
+    return {"code": 200, "answer": answer, **docs_info, "cache": cache_status}
+
+
+async def knowledge_base_chat_iterator(
+        request_data: KnowledgeBaseChatRequest,
+        chat_prompt: ChatPrompt,
+        inputs: Dict,
+        docs_info: Dict,
+        deadline: Deadline,
+):
+    """
+    流式输出：先发送 docs 事件和缓存状态，再每个token一条 data 消息，出错时发送 error 事件
+    """
+    try:
+        yield format_sse(docs_info, event="docs")
+
+        answer = []
+        async for data in astream_answer(request_data, chat_prompt, inputs, deadline):
+            if "cache" in data:
+                requests_total.inc(endpoint="knowledge_base_chat", model=request_data.model_name, cache=data["cache"])
+            else:
+                answer.append(data["answer"])
+            yield format_sse(data)
+        await save_turn(request_data, "".join(answer))
+    except DeadlineExceeded as e:
+        count_error("knowledge_base_chat", request_data)
+        yield format_sse({"code": status.HTTP_504_GATEWAY_TIMEOUT, "message": str(e)}, event="error")
+    except Exception as e:
+        logger.exception(e)
+        count_error("knowledge_base_chat", request_data)
+        yield format_sse({"code": 500, "message": f"查询知识库失败：{e}"}, event="error")
+
+
+@router.post("/knowledge_base_chat", summary="与知识库对话")
+async def knowledge_base_chat(
+        request: Request,
+        request_data: KnowledgeBaseChatRequest,
+        x_request_timeout: Optional[float] = Header(None, alias=TIMEOUT_HEADER, description="请求的时间预算（秒）"),
+):
+    deadline = Deadline.from_request(request_data.timeout, x_request_timeout)
+    try:
+        permit = await cancel_on_disconnect(
+            request, admit(request_data.model_name, request_data.priority), "knowledge_base_chat", request_data.model_name)
+    except AdmissionRejected as e:
+        return e.to_response()
+    except ClientDisconnected as e:
+        logger.info(str(e))
+        return ErrorResponse(str(e), code=CLIENT_CLOSED_REQUEST, status=CLIENT_CLOSED_REQUEST)
+
+    streaming = False
+    try:
+        if request_data.stream:
+            chat_prompt, inputs, docs_info = await cancel_on_disconnect(
+                request, build_knowledge_base_chat(request_data, deadline), "knowledge_base_chat", request_data.model_name)
+            # 许可在流式输出结束时释放
+            streaming = True
+            iterator = knowledge_base_chat_iterator(request_data, chat_prompt, inputs, docs_info, deadline)
+            return StreamingResponse(
+                stream_until_disconnect(request, hold_permit(iterator, permit), "knowledge_base_chat", request_data.model_name),
+                media_type="text/event-stream",
+                background=BackgroundTask(permit.release),
+            )
+
+        return ORJSONResponse(await cancel_on_disconnect(
+            request, knowledge_base_chat_answer(request_data, deadline), "knowledge_base_chat", request_data.model_name))
+
+    except ClientDisconnected as e:
+        logger.info(str(e))
+        return ErrorResponse(str(e), code=CLIENT_CLOSED_REQUEST, status=CLIENT_CLOSED_REQUEST)
+    except DeadlineExceeded as e:
+        count_error("knowledge_base_chat", request_data)
+        return ErrorResponse(str(e), code=status.HTTP_504_GATEWAY_TIMEOUT, status=status.HTTP_504_GATEWAY_TIMEOUT)
     except Exception as e:
+        count_error("knowledge_base_chat", request_data)
         return ErrorResponse(f"查询知识库失败：{e}")
+    finally:
+        if not streaming:
+            permit.release()
+
+
+class KnowledgeBaseChatBatchRequest(BaseModel):
+    items: List[KnowledgeBaseChatRequest] = Field(
+        ...,
+        description="批量对话请求，忽略其中的stream和priority参数",
+        min_length=1,
+        max_length=BATCH_MAX_ITEMS,
+    )
+    concurrency: int = Field(BATCH_CONCURRENCY, description="并发执行的请求数", ge=1, le=BATCH_MAX_CONCURRENCY)
+
+
+async def admitted_answer(request_data: KnowledgeBaseChatRequest) -> Dict:
+    """
+    以batch优先级获取准入许可后执行对话，未获准入时按 Retry-After 等待后重试；
+    排队和执行都受该条请求的时间预算限制，剩余时间不够再次重试时抛出最后一次的 AdmissionRejected
+    """
+    deadline = Deadline.from_request(request_data.timeout)
+    while True:
+        try:
+            permit = await deadline.run(admit(request_data.model_name, PRIORITY_BATCH), "排队等待")
+            break
+        except AdmissionRejected as e:
+            if deadline.remaining() <= e.retry_after:
+                raise
+            await asyncio.sleep(e.retry_after)
+    try:
+        return await knowledge_base_chat_answer(request_data, deadline)
+    finally:
+        permit.release()
+
+
+async def knowledge_base_chat_batch_iterator(request_data: KnowledgeBaseChatBatchRequest):
+    """
+    按完成顺序逐条输出NDJSON，每条带有对应请求的index，相同的请求只执行一次
+    """
+    groups: Dict[str, List[int]] = {}
+    for index, item in enumerate(request_data.items):
+        groups.setdefault(item.model_dump_json(exclude={"stream", "priority"}), []).append(index)
+    jobs = asyncio.Queue()
+    for indexes in groups.values():
+        jobs.put_nowait(indexes)
+    results = asyncio.Queue(maxsize=request_data.concurrency)
+
+    async def worker():
+        while not jobs.empty():
+            indexes = jobs.get_nowait()
+            item = request_data.items[indexes[0]]
+            try:
+                result = await admitted_answer(item)
+            except AdmissionRejected as e:
+                result = {"code": status.HTTP_503_SERVICE_UNAVAILABLE, "message": str(e), "retry_after": e.retry_after}
+            except DeadlineExceeded as e:
+                count_error("knowledge_base_chat_batch", item)
+                result = {"code": status.HTTP_504_GATEWAY_TIMEOUT, "message": str(e)}
+            except Exception as e:
+                logger.exception(e)
+                count_error("knowledge_base_chat_batch", item)
+                result = {"code": 500, "message": f"查询知识库失败：{e}"}
+            await results.put((indexes, result))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(request_data.concurrency, len(groups)))]
+    try:
+        for _ in range(len(groups)):
+            indexes, result = await results.get()
+            for index in indexes:
+                yield orjson.dumps({"index": index, **result}) + b"\n"
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+@router.post("/knowledge_base_chat/batch", summary="批量与知识库对话")
+async def knowledge_base_chat_batch(request: Request, request_data: KnowledgeBaseChatBatchRequest):
+    return StreamingResponse(
+        stream_until_disconnect(request, knowledge_base_chat_batch_iterator(request_data), "knowledge_base_chat_batch"),
+        media_type="application/x-ndjson",
+    )
@@ -1,34 +1,59 @@
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from fastapi import APIRouter, Depends, Body, Request
-from langchain.chains import LLMChain
-from langchain_core.prompts import ChatPromptTemplate
+from fastapi import APIRouter, Depends, Body, Request, Header, status
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
-from starlette.responses import JSONResponse
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse
 
 from application.settings import TEMPERATURE, LLM_MODELS, MAX_TOKENS
 from xiaoapi.core import logger
 from xiaoapi.response import ErrorResponse
-from .history import History
-from .utils import get_prompt_template, get_ChatOpenAI
+from .admission import admit, hold_permit, AdmissionRejected, PRIORITY_INTERACTIVE
+from .chat import ainvoke_answer, astream_answer, budget_history
+from .conversation import load_history, save_turn
+from .deadline import Deadline, DeadlineExceeded, TIMEOUT_HEADER
+from .disconnect import cancel_on_disconnect, stream_until_disconnect, ClientDisconnected, CLIENT_CLOSED_REQUEST
+from .history import ChatPrompt, History
+from .metrics import timed, prompt_build_seconds, history_seconds, requests_total, errors_total
+from .utils import get_prompt_template, format_sse
 
 router = APIRouter()
 
 
 class LLMChatRequest(BaseModel):
     query: str = Field(..., description="用户输入", examples=["恼羞成怒"])
+    conversation_id: Optional[str] = Field(
+        None,
+        description="会话ID，传入时由服务端读取最近的历史对话并在回答完成后保存本轮问答，无需传入history",
+        max_length=128,
+    )
     history: List[History] = Field(
         [],
-        description="历史对话，设为一个整数可以从数据库中读取历史消息",
+        description="历史对话，传入conversation_id时忽略",
         examples=[[
             {"role": "user", "content": "我们来玩成语接龙，我先来，生龙活虎"},
             {"role": "assistant", "content": "虎头虎脑"}]
         ]
     )
+    stream: bool = Field(False, description="流式输出，为True时以 text/event-stream 逐个返回token")
     model_name: str = Field(LLM_MODELS[0], description="LLM 模型名称。")
     temperature: float = Field(TEMPERATURE, description="LLM 采样温度", ge=0.0, le=1.0)
     max_tokens: int = Field(MAX_TOKENS, description="限制LLM生成Token数量，默认None代表模型最大值")
     prompt_name: str = Field("default", description="使用的prompt模板名称(在configs/prompt_config.py中配置)")
+    cache: Optional[bool] = Field(
+        None,
+        description="答案缓存：不传时仅在temperature为0时使用缓存，true为强制使用，false为跳过缓存",
+    )
+    priority: Literal["interactive", "batch"] = Field(
+        PRIORITY_INTERACTIVE,
+        description="请求优先级，模型繁忙排队时interactive优先于batch",
+    )
+    timeout: Optional[float] = Field(
+        None,
+        description="请求的时间预算（秒），不传时使用请求头 X-Request-Timeout 或服务端默认值",
+        gt=0,
+    )
 
     class Config:
         title = "LLM Chat Request"
@@ -36,24 +61,82 @@ class LLMChatRequest(BaseModel):
         protected_namespaces = ()  # 添加这一行来忽略'模型_'前缀的保护性警告
 
 
+async def llm_chat_iterator(request_data: LLMChatRequest, chat_prompt: ChatPrompt, deadline: Deadline):
+    """
+    流式输出：先发送缓存状态，再每个token一条 data 消息，出错时发送 error 事件
+    """
+    try:
+        answer = []
+        async for data in astream_answer(request_data, chat_prompt, {"input": request_data.query}, deadline):
+            if "cache" in data:
+                requests_total.inc(endpoint="llm_chat", model=request_data.model_name, cache=data["cache"])
+            else:
+                answer.append(data["answer"])
+            yield format_sse(data)
+        await save_turn(request_data, "".join(answer))
+    except DeadlineExceeded as e:
+        errors_total.inc(endpoint="llm_chat", model=request_data.model_name)
+        yield format_sse({"code": status.HTTP_504_GATEWAY_TIMEOUT, "message": str(e)}, event="error")
+    except Exception as e:
+        logger.exception(e)
+        errors_total.inc(endpoint="llm_chat", model=request_data.model_name)
+        yield format_sse({"code": 500, "message": f"LLM对话失败：{e}"}, event="error")
+
+
 @router.post("/llm_chat", summary="与llm模型对话")
-async def llm_chat(request_data: LLMChatRequest):
+async def llm_chat(
+        request: Request,
+        request_data: LLMChatRequest,
+        x_request_timeout: Optional[float] = Header(None, alias=TIMEOUT_HEADER, description="请求的时间预算（秒）"),
+):
+    deadline = Deadline.from_request(request_data.timeout, x_request_timeout)
+    try:
+        permit = await cancel_on_disconnect(
+            request, admit(request_data.model_name, request_data.priority), "llm_chat", request_data.model_name)
+    except AdmissionRejected as e:
+        return e.to_response()
+    except ClientDisconnected as e:
+        logger.info(str(e))
+        return ErrorResponse(str(e), code=CLIENT_CLOSED_REQUEST, status=CLIENT_CLOSED_REQUEST)
+
+    streaming = False
     try:
-        history = [History.from_data(h) for h in request_data.history]
-        prompt_template = get_prompt_template("llm_chat", request_data.prompt_name)
-        input_msg = History(role="user", content=prompt_template).to_msg_template(False)
-        chat_prompt = ChatPromptTemplate.from_messages(
-            [i.to_msg_template() for i in history] + [input_msg])
-
-        model = get_ChatOpenAI(
-            model_name=request_data.model_name,
-            temperature=request_data.temperature,
-            max_tokens=request_data.max_tokens
-        )
-        chain = LLMChain(prompt=chat_prompt, llm=model)
-        answer = await chain.ainvoke({"input": request_data.query})
-
-        return JSONResponse({"answer": answer["text"]})
+        with timed("history", history_seconds, endpoint="llm_chat"):
+            history = await load_history(request_data)
+            history = await cancel_on_disconnect(
+                request, budget_history(history, request_data.model_name, deadline), "llm_chat", request_data.model_name)
+        with timed("prompt", prompt_build_seconds, endpoint="llm_chat"):
+            prompt_template = get_prompt_template("llm_chat", request_data.prompt_name)
+            chat_prompt = ChatPrompt(history, prompt_template)
+
+        if request_data.stream:
+            # 许可在流式输出结束时释放
+            streaming = True
+            return StreamingResponse(
+                stream_until_disconnect(
+                    request, hold_permit(llm_chat_iterator(request_data, chat_prompt, deadline), permit),
+                    "llm_chat", request_data.model_name),
+                media_type="text/event-stream",
+                background=BackgroundTask(permit.release),
+            )
+
+        answer, cache_status = await cancel_on_disconnect(
+            request, ainvoke_answer(request_data, chat_prompt, {"input": request_data.query}, deadline),
+            "llm_chat", request_data.model_name)
+        requests_total.inc(endpoint="llm_chat", model=request_data.model_name, cache=cache_status)
+        await save_turn(request_data, answer)
+
+        return ORJSONResponse({"answer": answer, "cache": cache_status})
 
+    except ClientDisconnected as e:
+        logger.info(str(e))
+        return ErrorResponse(str(e), code=CLIENT_CLOSED_REQUEST, status=CLIENT_CLOSED_REQUEST)
+    except DeadlineExceeded as e:
+        errors_total.inc(endpoint="llm_chat", model=request_data.model_name)
+        return ErrorResponse(str(e), code=status.HTTP_504_GATEWAY_TIMEOUT, status=status.HTTP_504_GATEWAY_TIMEOUT)
     except Exception as e:
+        errors_total.inc(endpoint="llm_chat", model=request_data.model_name)
         return ErrorResponse(f"查询知识库失败：{e}")
+    finally:
+        if not streaming:
+            permit.release()
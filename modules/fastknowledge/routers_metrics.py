@@ -0,0 +1,29 @@
+from fastapi import APIRouter
+from starlette.responses import PlainTextResponse
+
+from xiaoapi.response import SuccessResponse
+from .admission import admission_controller
+from .llm_clients import llm_balancers, llm_client_pool
+from .metrics import registry
+
+router = APIRouter()
+
+
+@router.get("/metrics", summary="Prometheus指标")
+async def metrics():
+    return PlainTextResponse(registry.exposition(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/metrics/llm_backends", summary="LLM后端负载均衡状态")
+async def llm_backends():
+    return SuccessResponse(llm_balancers.stats())
+
+
+@router.get("/metrics/llm_clients", summary="LLM客户端池状态")
+async def llm_clients():
+    return SuccessResponse(llm_client_pool.stats())
+
+
+@router.get("/metrics/admission", summary="准入控制排队状态")
+async def admission():
+    return SuccessResponse(admission_controller.stats())
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Body
+
+from xiaoapi.response import SuccessResponse
+from .utils import search_cache, search_hedger, invalidate_search_cache
+
+router = APIRouter()
+
+
+@router.post("/search_cache/invalidate", summary="删除知识库的检索缓存")
+async def invalidate(
+        knowledge_base_name: str = Body(..., embed=True, description="知识库名称", examples=["samples"]),
+):
+    count = invalidate_search_cache(knowledge_base_name)
+    return SuccessResponse({"knowledge_base_name": knowledge_base_name, "invalidated": count})
+
+
+@router.get("/search_cache/stats", summary="检索缓存统计")
+async def stats():
+    return SuccessResponse(search_cache.stats())
+
+
+@router.get("/search_hedge/stats", summary="检索请求对冲统计")
+async def hedge_stats():
+    return SuccessResponse(search_hedger.stats())
@@ -0,0 +1,56 @@
+"""
+token计数
+
+优先使用tiktoken按模型选择编码；模型未知时使用 cl100k_base，
+编码文件无法加载（如离线部署）时退化为按字符估算：中日韩字符每字1个token，其余约4个字符1个token。
+"""
+
+import re
+from functools import lru_cache
+from typing import Optional
+
+from xiaoapi.core import logger
+
+_CJK_PATTERN = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+
+@lru_cache(maxsize=None)
+def _load_encoding(encoding_name: str) -> Optional["tiktoken.Encoding"]:
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning(f"加载tiktoken编码 {encoding_name} 失败，使用字符数估算token：{e}")
+        return None
+
+
+@lru_cache(maxsize=64)
+def get_encoding(model_name: str) -> Optional["tiktoken.Encoding"]:
+    """
+    获取模型对应的tiktoken编码，加载失败时返回None（结果会被缓存，不会重复尝试）
+    """
+    try:
+        from tiktoken.model import encoding_name_for_model
+        encoding_name = encoding_name_for_model(model_name)
+    except ImportError:
+        return None
+    except KeyError:
+        encoding_name = "cl100k_base"
+    return _load_encoding(encoding_name)
+
+
+def estimate_tokens(text: str) -> int:
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    """
+    计算文本在指定模型下的token数
+    """
+    if not text:
+        return 0
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -1,10 +1,43 @@
-from typing import List, Optional, Callable, Any
+import asyncio
+import time
+import unicodedata
+from typing import List, Optional, Callable, Any, Awaitable, Dict, AsyncIterator, Tuple
 
 import aiohttp
+import orjson
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.chains import LLMChain
 from langchain_core.documents import Document
 from langchain_openai import ChatOpenAI
 
-from application.settings import VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD, SEARCH_SERVER_URL, LLM_MODELS_CONFIG
+from application.settings import VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD, SEARCH_SERVER_URL, LLM_MODELS_CONFIG, \
+    SEARCH_CLIENT_LIMIT, SEARCH_CLIENT_LIMIT_PER_HOST, SEARCH_CLIENT_KEEPALIVE_TIMEOUT, SEARCH_CLIENT_DNS_CACHE_TTL, \
+    SEARCH_CLIENT_TIMEOUT, SEARCH_CLIENT_CONNECT_TIMEOUT, SEARCH_CACHE_ENABLE, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES, \
+    SEARCH_CACHE_MAX_BYTES, SINGLE_FLIGHT_ENABLE, KNOWLEDGE_BASE_BACKENDS, SEARCH_BACKEND_TIMEOUT, \
+    SEARCH_HEDGE_ENABLE, SEARCH_REPLICA_URLS, SEARCH_HEDGE_PERCENTILE, SEARCH_HEDGE_BUDGET_PERCENT, SEARCH_HEDGE_INITIAL_DELAY, \
+    SEARCH_HEDGE_MIN_DELAY, SEARCH_HEDGE_SAME_URL
+from xiaoapi.core import logger
+from .cache import TTLCache
+from .hedging import Hedger
+from .llm_clients import llm_client_pool, llm_balancers, BalancedCompletions, AsyncBalancedCompletions
+from .local_index import local_index_registry
+from .metrics import retrieval_seconds, retrieval_documents, record_server_timing, knowledge_base_labels
+from .prompt import prompt_template_registry
+from .singleflight import SingleFlight
+
+_search_session: Optional[aiohttp.ClientSession] = None
+
+search_cache = TTLCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_BYTES)
+search_flight = SingleFlight()
+search_hedger = Hedger(
+    SEARCH_SERVER_URL,
+    SEARCH_REPLICA_URLS,
+    SEARCH_HEDGE_PERCENTILE,
+    SEARCH_HEDGE_BUDGET_PERCENT,
+    initial_delay=SEARCH_HEDGE_INITIAL_DELAY,
+    min_delay=SEARCH_HEDGE_MIN_DELAY,
+    same_url=SEARCH_HEDGE_SAME_URL,
+)
 
 
 class DocumentWithVSId(Document):
@@ -19,12 +52,76 @@ def dict_to_document(doc_dict):
     return DocumentWithVSId(page_content=doc_dict["page_content"], metadata=doc_dict["metadata"], id=doc_dict["id"], score=doc_dict["score"])
 
 
-async def search_docs(
-        query: str = "",
-        knowledge_base_name: str = "",
-        top_k: int = VECTOR_SEARCH_TOP_K,
-        score_threshold: float = SCORE_THRESHOLD,
-) -> List[DocumentWithVSId]:
+def get_search_session() -> aiohttp.ClientSession:
+    """
+    获取访问fast-search服务的共享会话
+    会话在服务启动时创建，关闭时释放；未通过生命周期事件创建时在首次调用时懒加载
+    """
+    global _search_session
+    if _search_session is None or _search_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=SEARCH_CLIENT_LIMIT,
+            limit_per_host=SEARCH_CLIENT_LIMIT_PER_HOST,
+            keepalive_timeout=SEARCH_CLIENT_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=SEARCH_CLIENT_DNS_CACHE_TTL,
+            use_dns_cache=True,
+        )
+        timeout = aiohttp.ClientTimeout(total=SEARCH_CLIENT_TIMEOUT, connect=SEARCH_CLIENT_CONNECT_TIMEOUT)
+        _search_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _search_session
+
+
+async def close_search_session():
+    """
+    关闭访问fast-search服务的共享会话
+    """
+    global _search_session
+    if _search_session is not None and not _search_session.closed:
+        await _search_session.close()
+    _search_session = None
+
+
+def normalize_query(query: str) -> str:
+    """
+    规范化问题文本：统一全角/半角字符并合并空白
+    """
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+
+def _pack_docs(docs: List[DocumentWithVSId]) -> Tuple[Tuple, int]:
+    """
+    将文档压缩为元组用于缓存，同时估算占用字节数
+    """
+    packed = tuple((doc.page_content, doc.metadata, doc.id, doc.score) for doc in docs)
+    size = sum(len(doc.page_content.encode("utf-8")) + len(str(doc.metadata)) + 64 for doc in docs)
+    return packed, size
+
+
+def _unpack_docs(packed: Tuple) -> List[DocumentWithVSId]:
+    return [
+        DocumentWithVSId(page_content=page_content, metadata=dict(metadata), id=id, score=score)
+        for page_content, metadata, id, score in packed
+    ]
+
+
+def invalidate_search_cache(knowledge_base_name: str) -> int:
+    """
+    删除某个知识库的检索缓存，知识库重建索引后调用，返回删除的条目数
+    """
+    return search_cache.invalidate(knowledge_base_name)
+
+
+def get_search_backend(knowledge_base_name: str) -> str:
+    return KNOWLEDGE_BASE_BACKENDS.get(knowledge_base_name, "remote")
+
+
+async def _fetch_docs(query: str, knowledge_base_name: str, top_k: int, score_threshold: float) -> Tuple[Tuple, int]:
+    """
+    按知识库配置的后端检索（本地索引或fast-search服务），返回压缩后的文档及估算字节数
+    """
+    if get_search_backend(knowledge_base_name) == "local":
+        res = await local_index_registry.search(query, knowledge_base_name, top_k, score_threshold)
+        return _pack_docs([dict_to_document(d) for d in res])
 
     data = {
         "query": query,
@@ -33,19 +130,115 @@ async def search_docs(
         "score_threshold": score_threshold,
     }
 
-    url = f"{SEARCH_SERVER_URL}/knowledge_base/search_docs"
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=data) as response:
-            res = await response.json()
-            result = [dict_to_document(d) for d in res]
-            return result
+    async def post(server_url: str) -> List[Dict]:
+        async with get_search_session().post(f"{server_url}/knowledge_base/search_docs", json=data) as response:
+            return await response.json(loads=orjson.loads)
+
+    if SEARCH_HEDGE_ENABLE:
+        res = await search_hedger.run(post)
+    else:
+        res = await post(SEARCH_SERVER_URL)
+    return _pack_docs([dict_to_document(d) for d in res])
+
+
+async def search_docs(
+        query: str = "",
+        knowledge_base_name: str = "",
+        top_k: int = VECTOR_SEARCH_TOP_K,
+        score_threshold: float = SCORE_THRESHOLD,
+) -> List[DocumentWithVSId]:
+
+    key = (knowledge_base_name, normalize_query(query), top_k, score_threshold)
+    if SEARCH_CACHE_ENABLE:
+        packed = search_cache.get(key)
+        if packed is not None:
+            return _unpack_docs(packed)
+
+    async def fetch():
+        # 在真正发起请求时记录版本号，请求期间知识库缓存被失效则不写入旧结果
+        generation = search_cache.generation(knowledge_base_name)
+        packed, size = await _fetch_docs(query, knowledge_base_name, top_k, score_threshold)
+        if SEARCH_CACHE_ENABLE:
+            search_cache.set(key, packed, size, tag=knowledge_base_name, generation=generation)
+        return packed
+
+    if SINGLE_FLIGHT_ENABLE:
+        # 相同检索并发时只请求一次，每个调用方各自还原文档对象
+        packed = await search_flight.do(key, fetch)
+    else:
+        packed = await fetch()
+    return _unpack_docs(packed)
+
+
+async def search_knowledge_bases(
+        query: str,
+        knowledge_base_names: List[str],
+        top_k: int = VECTOR_SEARCH_TOP_K,
+        score_threshold: float = SCORE_THRESHOLD,
+        timeout: Optional[float] = None,
+) -> Tuple[List[DocumentWithVSId], List[Dict]]:
+    """
+    并发检索多个知识库，按score合并后取top_k，返回 (文档, 检索失败的知识库)
+    每个知识库按其后端的超时时间（不超过timeout）检索，超时或出错的知识库被跳过；全部失败时抛出第一个异常
+    文档的 metadata["knowledge_base_name"] 为其所属知识库
+    """
+
+    async def search(knowledge_base_name: str) -> List[DocumentWithVSId]:
+        backend_timeout = SEARCH_BACKEND_TIMEOUT.get(get_search_backend(knowledge_base_name))
+        limits = [t for t in (backend_timeout, timeout) if t is not None]
+        search_timeout = min(limits) if limits else None
+        start = time.perf_counter()
+        try:
+            docs = await asyncio.wait_for(search_docs(query, knowledge_base_name, top_k, score_threshold), search_timeout)
+            if docs:
+                # 返回过文档的知识库确认存在，可以作为指标标签
+                knowledge_base_labels.add(knowledge_base_name)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError(f"知识库 {knowledge_base_name} 检索超时（{search_timeout:g}秒）")
+        finally:
+            retrieval_seconds.observe(time.perf_counter() - start, knowledge_base=knowledge_base_name)
+        retrieval_documents.observe(len(docs), knowledge_base=knowledge_base_name)
+        for doc in docs:
+            doc.metadata["knowledge_base_name"] = knowledge_base_name
+        return docs
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[search(name) for name in knowledge_base_names], return_exceptions=True)
+    record_server_timing("retrieval", time.perf_counter() - start)
+
+    docs, errors = [], []
+    for knowledge_base_name, result in zip(knowledge_base_names, results):
+        if isinstance(result, BaseException):
+            reason = "timeout" if isinstance(result, asyncio.TimeoutError) else str(result) or type(result).__name__
+            logger.warning(f"search_docs failed, knowledge_base:{knowledge_base_name}, reason:{reason}")
+            errors.append({"knowledge_base_name": knowledge_base_name, "reason": reason})
+        else:
+            docs.extend(result)
+    if errors and len(errors) == len(results):
+        raise next(r for r in results if isinstance(r, BaseException))
+
+    # sorted 为稳定排序，同分时保持知识库的请求顺序
+    return sorted(docs, key=lambda doc: doc.score)[:top_k], errors
 
 
 def get_prompt_template(type: str, name: str) -> Optional[str]:
-    from application import settings
-    import importlib
-    importlib.reload(settings)
-    return settings.PROMPT_TEMPLATES[type].get(name)
+    """
+    从模板注册表获取prompt模板，配置文件修改后自动重新加载
+    """
+    return prompt_template_registry.get(type, name)
+
+
+def get_completions(model_name: str) -> Tuple[Any, Any]:
+    """
+    获取模型的同步/异步 chat.completions 对象：配置了多个后端时为负载均衡对象，否则为客户端池中的共享客户端
+    """
+    balancer = llm_balancers.get(model_name)
+    if balancer is not None:
+        # 模型配置了多个后端，由负载均衡选择每次请求的接口地址
+        return BalancedCompletions(balancer), AsyncBalancedCompletions(balancer)
+    configs = LLM_MODELS_CONFIG.get("openai-api")
+    clients = llm_client_pool.get(configs["api_base_url"], configs["api_key"])
+    return llm_client_pool.completions(clients)
 
 
 def get_ChatOpenAI(
@@ -59,7 +252,10 @@ def get_ChatOpenAI(
 ) -> ChatOpenAI:
 
     configs = LLM_MODELS_CONFIG.get("openai-api")
+    client, async_client = get_completions(model_name)
     model = ChatOpenAI(
+        client=client,
+        async_client=async_client,
         streaming=streaming,
         verbose=verbose,
         callbacks=callbacks,
@@ -72,3 +268,58 @@ def get_ChatOpenAI(
     )
 
     return model
+
+
+async def wrap_done(fn: Awaitable, event: asyncio.Event):
+    """
+    等待任务完成，结束或抛出异常时设置事件
+    """
+    try:
+        return await fn
+    finally:
+        event.set()
+
+
+def format_sse(data: Dict, event: Optional[str] = None) -> str:
+    """
+    格式化为一条 text/event-stream 消息
+    """
+    message = f"data: {orjson.dumps(data).decode()}\n\n"
+    if event:
+        message = f"event: {event}\n" + message
+    return message
+
+
+async def iter_chain_tokens(
+        chain: LLMChain,
+        inputs: Dict,
+        callback: AsyncIteratorCallbackHandler,
+        timeout: Optional[float] = None,
+) -> AsyncIterator[str]:
+    """
+    执行chain并逐个返回LLM生成的token，chain需使用 streaming=True 且挂载了callback的模型
+    迭代提前结束（如客户端断开）时取消生成任务；超过timeout秒仍未生成完毕时取消生成并抛出 asyncio.TimeoutError
+    """
+    task = asyncio.create_task(wrap_done(chain.ainvoke(inputs), callback.done))
+    expired = []
+
+    def expire():
+        expired.append(True)
+        task.cancel()
+
+    timer = asyncio.get_running_loop().call_later(timeout, expire) if timeout is not None else None
+    try:
+        async for token in callback.aiter():
+            yield token
+        try:
+            await task
+        except asyncio.CancelledError:
+            # 生成任务被定时器取消时转为超时异常
+            if expired:
+                raise asyncio.TimeoutError()
+            raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if not task.done():
+            task.cancel()
@@ -0,0 +1,160 @@
+"""
+准入控制测试：队列已满时拒绝并带 retry_after，高优先级请求先出队，排队中取消的请求不占用许可，释放许可时按优先级唤醒
+"""
+
+import asyncio
+
+import pytest
+
+from modules.fastknowledge.admission import ConcurrencyLimiter, AdmissionRejected, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+
+
+def make_limiter(max_concurrency=1, max_queue=2, queue_timeout=5.0) -> ConcurrencyLimiter:
+    return ConcurrencyLimiter("m", max_concurrency, max_queue, queue_timeout)
+
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_full_queue_rejects_with_retry_after():
+    async def run():
+        limiter = make_limiter(max_queue=1)
+        permit = await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await settle()
+        with pytest.raises(AdmissionRejected) as e:
+            await limiter.acquire()
+        assert e.value.status_code == 429
+        assert e.value.reason == "queue_full"
+        assert e.value.retry_after >= 1
+        assert e.value.to_response().headers["Retry-After"] == str(e.value.retry_after)
+        permit.release()
+        (await waiter).release()
+        assert limiter.active == 0
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_rejects():
+    async def run():
+        limiter = make_limiter(queue_timeout=0.02)
+        permit = await limiter.acquire()
+        with pytest.raises(AdmissionRejected) as e:
+            await limiter.acquire()
+        assert e.value.status_code == 503
+        assert e.value.reason == "timeout"
+        assert limiter.stats()["queued"] == 0
+        permit.release()
+        assert limiter.active == 0
+
+    asyncio.run(run())
+
+
+def test_higher_priority_jumps_queue():
+    async def run():
+        limiter = make_limiter(max_queue=3)
+        permit = await limiter.acquire()
+        order = []
+
+        async def request(name, priority):
+            p = await limiter.acquire(priority)
+            order.append(name)
+            await asyncio.sleep(0)
+            p.release()
+
+        tasks = [asyncio.ensure_future(request("batch1", PRIORITY_BATCH))]
+        await settle()
+        tasks.append(asyncio.ensure_future(request("batch2", PRIORITY_BATCH)))
+        await settle()
+        tasks.append(asyncio.ensure_future(request("interactive", PRIORITY_INTERACTIVE)))
+        await settle()
+        permit.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["interactive", "batch1", "batch2"]
+
+
+def test_high_priority_preempts_batch_when_queue_full():
+    async def run():
+        limiter = make_limiter(max_queue=1)
+        permit = await limiter.acquire()
+        batch = asyncio.ensure_future(limiter.acquire(PRIORITY_BATCH))
+        await settle()
+        interactive = asyncio.ensure_future(limiter.acquire(PRIORITY_INTERACTIVE))
+        await settle()
+        with pytest.raises(AdmissionRejected) as e:
+            await batch
+        assert e.value.reason == "preempted"
+        permit.release()
+        (await interactive).release()
+        assert limiter.active == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def run():
+        limiter = make_limiter(max_queue=2)
+        permit = await limiter.acquire()
+        cancelled = asyncio.ensure_future(limiter.acquire())
+        await settle()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await settle()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert limiter.stats()["queued"] == 1
+
+        permit.release()
+        second = await waiting
+        assert limiter.active == 1
+        second.release()
+        assert limiter.active == 0
+        assert limiter.stats()["queued"] == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_after_grant_returns_permit():
+    async def run():
+        limiter = make_limiter()
+        permit = await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await settle()
+        # 许可已交给等待者，但等待者在恢复执行前被取消
+        permit.release()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.active == 0
+        (await limiter.acquire()).release()
+
+    asyncio.run(run())
+
+
+def test_release_wakes_waiters_in_priority_order():
+    async def run():
+        limiter = make_limiter(max_concurrency=2, max_queue=4)
+        permits = [await limiter.acquire(), await limiter.acquire()]
+        batch = asyncio.ensure_future(limiter.acquire(PRIORITY_BATCH))
+        await settle()
+        interactive = [asyncio.ensure_future(limiter.acquire(PRIORITY_INTERACTIVE)) for _ in range(2)]
+        await settle()
+
+        permits[0].release()
+        await settle()
+        assert interactive[0].done() and not interactive[1].done() and not batch.done()
+        permits[1].release()
+        await settle()
+        assert interactive[1].done() and not batch.done()
+        assert limiter.active == 2
+
+        (await interactive[0]).release()
+        (await batch).release()
+        (await interactive[1]).release()
+        assert limiter.active == 0
+
+    asyncio.run(run())
@@ -0,0 +1,99 @@
+"""
+检索缓存测试：过期、按条目数和内存占用淘汰、按知识库失效，以及取数期间失效后不写入旧结果
+"""
+
+import asyncio
+import time
+
+from modules.fastknowledge import utils
+from modules.fastknowledge.cache import TTLCache
+
+
+def test_entry_expires_after_ttl():
+    cache = TTLCache(ttl=0.05, max_entries=10, max_bytes=1000)
+    cache.set("a", 1, 10)
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    assert cache.bytes == 0
+    assert cache.stats()["entries"] == 0
+
+
+def test_evicts_least_recently_used_when_entries_exceeded():
+    cache = TTLCache(ttl=60, max_entries=2, max_bytes=1000)
+    cache.set("a", 1, 10)
+    cache.set("b", 2, 10)
+    assert cache.get("a") == 1
+    cache.set("c", 3, 10)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.evictions == 1
+
+
+def test_evicts_when_bytes_exceeded():
+    cache = TTLCache(ttl=60, max_entries=10, max_bytes=100)
+    cache.set("a", 1, 60)
+    cache.set("b", 2, 60)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.bytes == 60
+    # 单个条目超过上限时不缓存
+    cache.set("c", 3, 101)
+    assert cache.get("c") is None
+    assert cache.get("b") == 2
+
+
+def test_invalidate_by_tag():
+    cache = TTLCache(ttl=60, max_entries=10, max_bytes=1000)
+    cache.set("a", 1, 10, tag="kb1")
+    cache.set("b", 2, 10, tag="kb1")
+    cache.set("c", 3, 10, tag="kb2")
+    assert cache.invalidate("kb1") == 2
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.bytes == 10
+    assert cache.invalidate("kb1") == 0
+
+
+def test_set_skipped_when_invalidated_after_generation():
+    cache = TTLCache(ttl=60, max_entries=10, max_bytes=1000)
+    generation = cache.generation("kb1")
+    other = cache.generation("kb2")
+    cache.invalidate("kb1")
+    cache.set("a", 1, 10, tag="kb1", generation=generation)
+    assert cache.get("a") is None
+    cache.set("b", 2, 10, tag="kb2", generation=other)
+    assert cache.get("b") == 2
+
+    generation = cache.generation("kb2")
+    cache.clear()
+    cache.set("b", 2, 10, tag="kb2", generation=generation)
+    assert cache.get("b") is None
+
+
+def test_search_docs_does_not_cache_result_fetched_before_invalidation(monkeypatch):
+    cache = TTLCache(ttl=60, max_entries=10, max_bytes=10000)
+    monkeypatch.setattr(utils, "search_cache", cache)
+    monkeypatch.setattr(utils, "SEARCH_CACHE_ENABLE", True)
+    calls = []
+
+    async def fetch_docs(query, knowledge_base_name, top_k, score_threshold):
+        calls.append(query)
+        await asyncio.sleep(0.02)
+        return utils._pack_docs([])
+
+    monkeypatch.setattr(utils, "_fetch_docs", fetch_docs)
+
+    async def run():
+        task = asyncio.ensure_future(utils.search_docs("q", "kb1", 3, 1.0))
+        await asyncio.sleep(0.01)
+        utils.invalidate_search_cache("kb1")
+        await task
+        # 失效前发起的结果没有写入缓存，再次检索重新请求
+        await utils.search_docs("q", "kb1", 3, 1.0)
+        await utils.search_docs("q", "kb1", 3, 1.0)
+
+    asyncio.run(run())
+    assert len(calls) == 2
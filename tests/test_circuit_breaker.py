@@ -0,0 +1,116 @@
+"""
+LLM后端熔断测试：半开状态下的试探请求无论以何种方式结束，后端都不能一直不可用
+"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from modules.fastknowledge.llm_clients import CircuitBreaker, LLMBackend, LLMBalancer, CIRCUIT_CLOSED, CIRCUIT_OPEN, \
+    CIRCUIT_HALF_OPEN
+
+RESET_TIMEOUT = 0.05
+
+
+class FakeBackend(LLMBackend):
+    """
+    不发起网络请求，由 create 模拟后端的响应
+    """
+
+    def __init__(self, create):
+        super().__init__("m", "http://backend/v1", "EMPTY")
+        self.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=RESET_TIMEOUT)
+        self._create = create
+
+    @property
+    def async_completions(self):
+        return SimpleNamespace(create=self._create)
+
+
+def status_error(status_code: int) -> openai.APIStatusError:
+    response = httpx.Response(status_code, request=httpx.Request("POST", "http://backend/v1/chat/completions"))
+    return openai.APIStatusError("error", response=response, body=None)
+
+
+def open_circuit(backend: FakeBackend):
+    backend.breaker.record_failure()
+    assert backend.breaker.state == CIRCUIT_OPEN
+    time.sleep(RESET_TIMEOUT * 1.5)
+    assert backend.breaker.available()
+    assert backend.breaker.state == CIRCUIT_HALF_OPEN
+
+
+def test_cancelled_half_open_probe_releases_backend():
+    started = asyncio.Event()
+
+    async def hang(**kwargs):
+        started.set()
+        await asyncio.sleep(10)
+
+    backend = FakeBackend(hang)
+    balancer = LLMBalancer("m", [backend], max_retries=0)
+    open_circuit(backend)
+
+    async def probe_and_cancel():
+        task = asyncio.ensure_future(balancer.acreate(model="m", messages=[]))
+        await started.wait()
+        # 试探进行中，其他请求不能再选中该后端
+        assert not backend.breaker.available()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(probe_and_cancel())
+    assert backend.outstanding == 0
+    assert backend.breaker.state == CIRCUIT_HALF_OPEN
+    assert backend.breaker.available()
+
+
+def test_half_open_probe_timeout_releases_backend():
+    async def hang(**kwargs):
+        await asyncio.sleep(10)
+
+    backend = FakeBackend(hang)
+    balancer = LLMBalancer("m", [backend], max_retries=0)
+    open_circuit(backend)
+
+    async def probe():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(balancer.acreate(model="m", messages=[]), 0.01)
+
+    asyncio.run(probe())
+    assert backend.breaker.available()
+
+
+def test_half_open_probe_client_error_closes_circuit():
+    async def bad_request(**kwargs):
+        raise status_error(400)
+
+    backend = FakeBackend(bad_request)
+    balancer = LLMBalancer("m", [backend], max_retries=0)
+    open_circuit(backend)
+
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(balancer.acreate(model="m", messages=[]))
+    assert backend.breaker.state == CIRCUIT_CLOSED
+    assert backend.breaker.available()
+
+
+def test_half_open_probe_server_error_reopens_circuit():
+    async def server_error(**kwargs):
+        raise status_error(503)
+
+    backend = FakeBackend(server_error)
+    balancer = LLMBalancer("m", [backend], max_retries=0)
+    open_circuit(backend)
+
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(balancer.acreate(model="m", messages=[]))
+    assert backend.breaker.state == CIRCUIT_OPEN
+    assert not backend.breaker.available()
+    time.sleep(RESET_TIMEOUT * 1.5)
+    assert backend.breaker.available()
@@ -0,0 +1,41 @@
+"""
+结构化出处测试：同一知识库的同一文件只保留一条（取最相关分块），按首次出现的顺序返回，可选附带分块内容
+"""
+
+from modules.fastknowledge.routers_knowledge_base_chat import compact_source_documents, get_download_url
+from modules.fastknowledge.utils import DocumentWithVSId
+
+
+def make_doc(id: str, knowledge_base_name: str, source: str, score: float, content: str) -> DocumentWithVSId:
+    return DocumentWithVSId(page_content=content, metadata={"knowledge_base_name": knowledge_base_name, "source": source},
+                            id=id, score=score)
+
+
+def docs():
+    return [
+        make_doc("a#1", "kb1", "a.md", 0.3, "a第1段"),
+        make_doc("b#0", "kb1", "b.md", 0.4, "b第0段"),
+        make_doc("a#0", "kb1", "a.md", 0.1, "a第0段"),
+        make_doc("a#0", "kb2", "a.md", 0.2, "kb2的a"),
+    ]
+
+
+def test_dedup_by_knowledge_base_and_file():
+    citations = compact_source_documents(docs())
+    assert [(c["knowledge_base_name"], c["source"]) for c in citations] == [("kb1", "a.md"), ("kb1", "b.md"),
+                                                                          ("kb2", "a.md")]
+    first = citations[0]
+    assert first["id"] == "a#0"
+    assert first["score"] == 0.1
+    assert first["url"] == get_download_url("kb1", "a.md")
+    assert all("content" not in c for c in citations)
+
+
+def test_include_content_joins_chunks_in_order():
+    citations = compact_source_documents(docs(), include_content=True)
+    assert [c["content"] for c in citations] == ["a第1段\n\na第0段", "b第0段", "kb2的a"]
+    assert citations[0]["id"] == "a#0"
+
+
+def test_empty_docs():
+    assert compact_source_documents([]) == []
@@ -0,0 +1,112 @@
+"""
+响应压缩测试：按 Accept-Encoding 协商 br/gzip，小于最小长度的响应不压缩，流式和没有 Content-Length 的响应立即透传
+"""
+
+import asyncio
+import gzip
+
+import brotli
+import pytest
+
+from modules.fastknowledge.compression import CompressionMiddleware, choose_encoding
+
+BODY = b'{"answer": "' + "缓存过期时间通过配置项设置。".encode("utf-8") * 50 + b'"}'
+
+
+def make_app(body: bytes, headers):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+def json_headers(body: bytes):
+    return [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+
+
+def run_middleware(app, accept_encoding: str, minimum_size: int = 500):
+    middleware = CompressionMiddleware(app, minimum_size=minimum_size, gzip_level=6, brotli_quality=4)
+    scope = {"type": "http", "method": "POST", "path": "/", "headers": [(b"accept-encoding", accept_encoding.encode())]}
+    messages = []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(middleware(scope, receive, send))
+    start, body = messages
+    return {k.decode(): v.decode() for k, v in start["headers"]}, body["body"]
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("gzip, deflate, br", "br"),
+    ("gzip", "gzip"),
+    ("br;q=0, gzip;q=0.5", "gzip"),
+    ("*", "br"),
+    ("identity", None),
+    ("gzip;q=0", None),
+    ("", None),
+])
+def test_choose_encoding(accept_encoding, expected):
+    assert choose_encoding(accept_encoding) == expected
+
+
+@pytest.mark.parametrize("accept_encoding, encoding, decompress", [
+    ("gzip, br", "br", brotli.decompress),
+    ("gzip", "gzip", gzip.decompress),
+])
+def test_compresses_large_response(accept_encoding, encoding, decompress):
+    headers, body = run_middleware(make_app(BODY, json_headers(BODY)), accept_encoding)
+    assert headers["content-encoding"] == encoding
+    assert headers["content-length"] == str(len(body))
+    assert "Accept-Encoding" in headers["vary"]
+    assert decompress(body) == BODY
+
+
+def test_small_response_not_compressed():
+    headers, body = run_middleware(make_app(BODY, json_headers(BODY)), "gzip, br", minimum_size=len(BODY) + 1)
+    assert "content-encoding" not in headers
+    assert body == BODY
+
+
+def test_no_accept_encoding_passthrough():
+    headers, body = run_middleware(make_app(BODY, json_headers(BODY)), "")
+    assert "content-encoding" not in headers
+    assert body == BODY
+
+
+@pytest.mark.parametrize("headers", [
+    [(b"content-type", b"text/event-stream; charset=utf-8")],
+    [(b"content-type", b"application/x-ndjson")],
+    # 没有 Content-Length 的响应可能是分块发送的
+    [(b"content-type", b"application/json")],
+])
+def test_streaming_response_headers_sent_immediately(headers):
+    sent = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        # 第一段响应体发送之前，响应头已经发给客户端
+        assert [m["type"] for m in sent] == ["http.response.start"]
+        await send({"type": "http.response.body", "body": BODY, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def run():
+        middleware = CompressionMiddleware(app, minimum_size=1, gzip_level=6, brotli_quality=4)
+        scope = {"type": "http", "method": "POST", "path": "/", "headers": [(b"accept-encoding", b"gzip, br")]}
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        await middleware(scope, receive, send)
+
+    asyncio.run(run())
+    assert [m["type"] for m in sent] == ["http.response.start", "http.response.body", "http.response.body"]
+    assert all(name != b"content-encoding" for name, _ in sent[0]["headers"])
+    assert sent[1]["body"] == BODY
@@ -0,0 +1,67 @@
+"""
+pack_context 测试：去除重复和近似重复的文档，在token预算内优先装入相关度最高的文档
+"""
+
+from modules.fastknowledge.context import pack_context, DROPPED_DUPLICATE, DROPPED_NEAR_DUPLICATE, DROPPED_BUDGET
+from modules.fastknowledge.tokenizer import count_tokens
+from modules.fastknowledge.utils import DocumentWithVSId
+
+MODEL = "gpt-3.5-turbo"
+
+
+def make_doc(id: str, content: str, score: float) -> DocumentWithVSId:
+    return DocumentWithVSId(page_content=content, metadata={"knowledge_base_name": "kb", "source": f"{id}.txt"},
+                            id=id, score=score)
+
+
+def tokens(doc: DocumentWithVSId) -> int:
+    return count_tokens(doc.page_content, MODEL) + 1
+
+
+def test_duplicate_and_near_duplicate_dropped():
+    text = "缓存过期时间通过 SEARCH_CACHE_TTL 配置，单位为秒，默认缓存五分钟，知识库重建索引后需要手动失效。"
+    docs = [
+        make_doc("a", text, 0.1),
+        make_doc("b", "  " + text.upper() + " ", 0.2),
+        make_doc("c", text.replace("五分钟", "五分钟。"), 0.3),
+        make_doc("d", "连接池大小由 LLM_CLIENT_MAX_CONNECTIONS 控制。", 0.4),
+    ]
+    kept, dropped = pack_context(docs, MODEL, None)
+    assert [doc.id for doc in kept] == ["a", "d"]
+    assert [(d["id"], d["reason"]) for d in dropped] == [("b", DROPPED_DUPLICATE), ("c", DROPPED_NEAR_DUPLICATE)]
+
+
+def test_budget_keeps_highest_ranked():
+    docs = [
+        make_doc("low", "第三相关的文档，内容比较长。" * 8, 0.9),
+        make_doc("top", "最相关的文档内容。" * 8, 0.1),
+        make_doc("mid", "第二相关的文档内容。" * 8, 0.5),
+    ]
+    by_id = {doc.id: doc for doc in docs}
+    budget = tokens(by_id["top"]) + tokens(by_id["mid"])
+    kept, dropped = pack_context(docs, MODEL, budget)
+    assert [doc.id for doc in kept] == ["top", "mid"]
+    assert sum(tokens(doc) for doc in kept) <= budget
+    assert [(d["id"], d["reason"]) for d in dropped] == [("low", DROPPED_BUDGET)]
+
+
+def test_shorter_doc_fills_remaining_budget():
+    docs = [
+        make_doc("top", "最相关的文档内容。" * 8, 0.1),
+        make_doc("long", "较长的第二个文档。" * 20, 0.2),
+        make_doc("short", "短文档。", 0.3),
+    ]
+    budget = tokens(docs[0]) + tokens(docs[2])
+    kept, dropped = pack_context(docs, MODEL, budget)
+    assert [doc.id for doc in kept] == ["top", "short"]
+    assert len(dropped) == 1
+    assert dropped[0]["id"] == "long"
+    assert dropped[0]["reason"] == DROPPED_BUDGET
+
+
+def test_no_budget_keeps_everything():
+    docs = [make_doc(str(i), f"第{i}个互不相同的文档，主题编号{i * 7919}。", i) for i in range(5)]
+    for budget in (None, 0):
+        kept, dropped = pack_context(docs, MODEL, budget)
+        assert len(kept) == 5
+        assert dropped == []
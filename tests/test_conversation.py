@@ -0,0 +1,75 @@
+"""
+SQLite会话存储测试：读取最近的limit条消息并保持顺序，追加消息更新会话时间，清理过期会话及其消息
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from modules.fastknowledge.conversation import ConversationStore, SQLiteConversationStore
+from modules.fastknowledge.history import History
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.db"))
+    yield store
+    asyncio.run(store.close())
+
+
+def messages(start: int, count: int):
+    return [History(role="user" if i % 2 == 0 else "assistant", content=f"消息{i}") for i in range(start, start + count)]
+
+
+def updated_at(store: SQLiteConversationStore, conversation_id: str) -> float:
+    row = store._conn.execute("SELECT updated_at FROM conversations WHERE conversation_id = ?",
+                              (conversation_id,)).fetchone()
+    return row[0] if row else None
+
+
+def test_store_interface_is_abstract():
+    with pytest.raises(TypeError):
+        ConversationStore()
+
+
+def test_load_returns_newest_in_order(store):
+    async def run():
+        await store.append("c1", messages(0, 4))
+        await store.append("c1", messages(4, 2))
+        await store.append("c2", messages(100, 2))
+        return await store.load("c1", 3), await store.load("c1", 100), await store.load("missing", 3)
+
+    newest, everything, missing = asyncio.run(run())
+    assert [h.content for h in newest] == ["消息3", "消息4", "消息5"]
+    assert [h.role for h in newest] == ["assistant", "user", "assistant"]
+    assert [h.content for h in everything] == [f"消息{i}" for i in range(6)]
+    assert missing == []
+
+
+def test_append_updates_timestamp(store):
+    asyncio.run(store.append("c1", messages(0, 2)))
+    first = updated_at(store, "c1")
+    time.sleep(0.01)
+    asyncio.run(store.append("c1", messages(2, 2)))
+    assert updated_at(store, "c1") > first
+    assert store._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] == 1
+
+
+def test_cleanup_removes_expired_conversations_and_messages(store):
+    async def run():
+        await store.append("old", messages(0, 2))
+        await asyncio.sleep(0.01)
+        cutoff = time.time()
+        await asyncio.sleep(0.01)
+        await store.append("new", messages(0, 2))
+        removed = await store.cleanup(cutoff)
+        return removed, await store.load("old", 10), await store.load("new", 10)
+
+    removed, old, new = asyncio.run(run())
+    assert removed == 1
+    assert old == []
+    assert len(new) == 2
+    assert updated_at(store, "old") is None
+    count = store._conn.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = 'old'").fetchone()[0]
+    assert count == 0
@@ -0,0 +1,84 @@
+"""
+客户端断开测试：receive 收到 http.disconnect 后，进行中的处理过程和流式生成被取消
+"""
+
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+from modules.fastknowledge import disconnect
+from modules.fastknowledge.disconnect import cancel_on_disconnect, stream_until_disconnect, ClientDisconnected
+
+
+def make_request(disconnect_after: float) -> Request:
+    async def receive():
+        await asyncio.sleep(disconnect_after)
+        return {"type": "http.disconnect"}
+
+    return Request({"type": "http", "method": "POST", "path": "/", "headers": []}, receive)
+
+
+@pytest.fixture(autouse=True)
+def enable_cancel(monkeypatch):
+    monkeypatch.setattr(disconnect, "CANCEL_ON_DISCONNECT", True)
+
+
+def test_cancel_on_disconnect_cancels_task():
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def run():
+        with pytest.raises(ClientDisconnected):
+            await cancel_on_disconnect(make_request(0.01), work(), "llm_chat", "m")
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert cancelled == [1]
+
+
+def test_cancel_on_disconnect_returns_result():
+    async def work():
+        return "answer"
+
+    assert asyncio.run(cancel_on_disconnect(make_request(10), work(), "llm_chat", "m")) == "answer"
+
+
+def test_stream_until_disconnect_cancels_generator():
+    events = []
+
+    async def generate():
+        try:
+            yield "first"
+            await asyncio.sleep(10)
+            yield "second"
+        except asyncio.CancelledError:
+            events.append("cancelled")
+            raise
+        finally:
+            events.append("closed")
+
+    async def run():
+        items = [item async for item in stream_until_disconnect(make_request(0.01), generate(), "llm_chat", "m")]
+        await asyncio.sleep(0)
+        return items
+
+    assert asyncio.run(run()) == ["first"]
+    assert events == ["cancelled", "closed"]
+
+
+def test_stream_until_disconnect_finishes_normally():
+    async def generate():
+        for i in range(3):
+            yield i
+
+    async def run():
+        return [item async for item in stream_until_disconnect(make_request(10), generate(), "llm_chat", "m")]
+
+    assert asyncio.run(run()) == [0, 1, 2]
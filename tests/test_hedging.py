@@ -0,0 +1,150 @@
+"""
+对冲请求测试：超过阈值才对冲，预算不足时跳过，先返回的结果胜出并取消另一个，被取消的首个请求耗时计入延迟样本
+"""
+
+import asyncio
+
+import pytest
+
+from modules.fastknowledge.hedging import Hedger, HedgeBudget, LatencyTracker
+
+PRIMARY = "http://primary"
+REPLICA = "http://replica"
+
+
+def make_hedger(replica_urls=(), same_url=True, budget_percent=100, initial_delay=0.02) -> Hedger:
+    hedger = Hedger(PRIMARY, list(replica_urls), percentile=95, budget_percent=budget_percent,
+                    min_samples=1000, initial_delay=initial_delay, same_url=same_url)
+    hedger.budget.tokens = hedger.budget.max_tokens
+    return hedger
+
+
+class FakeBackend:
+    """
+    按地址返回预设的延迟，记录每次调用及其是否被取消
+    """
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.calls = []
+        self.cancelled = []
+
+    async def __call__(self, url: str) -> str:
+        delay = self.delays[url][len([u for u in self.calls if u == url])]
+        self.calls.append(url)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(url)
+            raise
+        return url
+
+
+def test_latency_tracker_threshold():
+    tracker = LatencyTracker(percentile=50, window=100, min_samples=3, initial_delay=0.5, min_delay=0.01)
+    tracker.observe(0.1)
+    tracker.observe(0.2)
+    assert tracker.threshold() == 0.5
+    tracker.observe(0.3)
+    assert tracker.threshold() == pytest.approx(0.2)
+    for _ in range(100):
+        tracker.observe(0.001)
+    assert tracker.threshold() == 0.01
+
+
+def test_budget_withdraw():
+    budget = HedgeBudget(percent=50, max_tokens=2)
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    for _ in range(10):
+        budget.deposit()
+    assert budget.tokens == 2
+    assert budget.withdraw() and budget.withdraw() and not budget.withdraw()
+
+
+def test_fast_primary_not_hedged():
+    hedger = make_hedger()
+    backend = FakeBackend({PRIMARY: [0.0]})
+    assert asyncio.run(hedger.run(backend)) == PRIMARY
+    assert backend.calls == [PRIMARY]
+    assert len(hedger.tracker) == 1
+
+
+def test_slow_primary_hedged_to_replica_and_cancelled():
+    hedger = make_hedger([REPLICA])
+    backend = FakeBackend({PRIMARY: [1.0], REPLICA: [0.0]})
+    assert asyncio.run(hedger.run(backend)) == REPLICA
+    assert backend.calls == [PRIMARY, REPLICA]
+    assert backend.cancelled == [PRIMARY]
+    # 被取消的首个请求按到取消为止的耗时计入样本，不小于阈值
+    assert len(hedger.tracker) == 1
+    assert hedger.tracker._samples[0] >= 0.02
+
+
+def test_same_url_hedging_without_replicas():
+    hedger = make_hedger()
+    backend = FakeBackend({PRIMARY: [1.0, 0.0]})
+    assert asyncio.run(hedger.run(backend)) == PRIMARY
+    assert backend.calls == [PRIMARY, PRIMARY]
+    assert backend.cancelled == [PRIMARY]
+
+
+def test_no_hedging_without_replicas_when_same_url_disabled():
+    hedger = make_hedger(same_url=False)
+    backend = FakeBackend({PRIMARY: [0.05]})
+    assert asyncio.run(hedger.run(backend)) == PRIMARY
+    assert backend.calls == [PRIMARY]
+    assert not hedger.stats()["enabled"]
+
+
+def test_hedge_skipped_without_budget():
+    hedger = make_hedger([REPLICA])
+    hedger.budget.tokens = 0
+    backend = FakeBackend({PRIMARY: [0.05]})
+    assert asyncio.run(hedger.run(backend)) == PRIMARY
+    assert backend.calls == [PRIMARY]
+    assert len(hedger.tracker) == 1
+
+
+def test_first_success_wins_when_other_fails():
+    hedger = make_hedger([REPLICA])
+
+    async def call(url):
+        if url == REPLICA:
+            raise RuntimeError("replica down")
+        await asyncio.sleep(0.05)
+        return url
+
+    assert asyncio.run(hedger.run(call)) == PRIMARY
+
+
+def test_both_failures_raise_last():
+    hedger = make_hedger([REPLICA])
+
+    async def call(url):
+        await asyncio.sleep(0.05 if url == PRIMARY else 0.0)
+        raise RuntimeError(url)
+
+    with pytest.raises(RuntimeError, match=PRIMARY):
+        asyncio.run(hedger.run(call))
+
+
+def test_caller_cancel_cancels_both_and_records_primary():
+    hedger = make_hedger([REPLICA])
+    backend = FakeBackend({PRIMARY: [1.0], REPLICA: [1.0]})
+
+    async def run():
+        task = asyncio.ensure_future(hedger.run(backend))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert sorted(backend.cancelled) == [PRIMARY, REPLICA]
+    assert len(hedger.tracker) == 1
+    assert hedger.tracker._samples[0] >= 0.05
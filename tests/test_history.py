@@ -0,0 +1,89 @@
+"""
+历史对话裁剪测试：按token预算保留最近的消息，开启摘要时较早的消息压缩为摘要，摘要失败或超时时只保留最近的消息
+"""
+
+import asyncio
+
+from modules.fastknowledge import chat
+from modules.fastknowledge.deadline import Deadline
+from modules.fastknowledge.history import History, split_history, MESSAGE_TOKEN_OVERHEAD
+from modules.fastknowledge.tokenizer import count_tokens
+
+MODEL = "gpt-3.5-turbo"
+
+
+def make_history(turns: int):
+    return [History(role="user" if i % 2 == 0 else "assistant", content=f"第{i}条消息，" + "内容" * 20)
+            for i in range(turns)]
+
+
+def message_tokens(history) -> int:
+    return sum(count_tokens(h.content, MODEL) + MESSAGE_TOKEN_OVERHEAD for h in history)
+
+
+def test_split_keeps_newest_within_budget():
+    history = make_history(6)
+    budget = message_tokens(history[-3:])
+    older, recent = split_history(history, MODEL, budget)
+    assert recent == history[-3:]
+    assert older == history[:3]
+
+    older, recent = split_history(history, MODEL, budget - 1)
+    assert recent == history[-2:]
+    assert split_history(history, MODEL, 0) == (history, [])
+    assert split_history(history, MODEL, message_tokens(history)) == ([], history)
+
+
+def configure(monkeypatch, budget: int, summarize):
+    monkeypatch.setattr(chat, "HISTORY_TOKEN_BUDGET", {"default": budget})
+    monkeypatch.setattr(chat, "HISTORY_SUMMARY_ENABLE", True)
+    monkeypatch.setattr(chat, "HISTORY_SUMMARY_MAX_TOKENS", 0)
+    monkeypatch.setattr(chat, "summarize_history", summarize)
+
+
+def test_budget_history_without_summary(monkeypatch):
+    history = make_history(6)
+    monkeypatch.setattr(chat, "HISTORY_TOKEN_BUDGET", {"default": message_tokens(history[-2:])})
+    monkeypatch.setattr(chat, "HISTORY_SUMMARY_ENABLE", False)
+    assert asyncio.run(chat.budget_history(history, MODEL)) == history[-2:]
+
+
+def test_budget_history_prepends_summary(monkeypatch):
+    history = make_history(6)
+    summarized = []
+
+    async def summarize(older, model_name):
+        summarized.append(older)
+        return "摘要"
+
+    configure(monkeypatch, message_tokens(history[-2:]), summarize)
+    result = asyncio.run(chat.budget_history(history, MODEL))
+    assert summarized == [history[:4]]
+    assert result[0].role == "system"
+    assert "摘要" in result[0].content
+    assert result[1:] == history[-2:]
+
+
+def test_budget_history_summary_failure_falls_back(monkeypatch):
+    history = make_history(6)
+
+    async def summarize(older, model_name):
+        raise RuntimeError("llm unavailable")
+
+    configure(monkeypatch, message_tokens(history[-2:]), summarize)
+    assert asyncio.run(chat.budget_history(history, MODEL)) == history[-2:]
+
+
+def test_budget_history_summary_timeout_falls_back(monkeypatch):
+    history = make_history(6)
+
+    async def summarize(older, model_name):
+        await asyncio.sleep(10)
+
+    configure(monkeypatch, message_tokens(history[-2:]), summarize)
+    monkeypatch.setattr(chat, "HISTORY_SUMMARY_TIMEOUT", 0.02)
+    assert asyncio.run(chat.budget_history(history, MODEL)) == history[-2:]
+
+    # 请求剩余时间短于摘要超时时按剩余时间降级，不抛出 DeadlineExceeded
+    monkeypatch.setattr(chat, "HISTORY_SUMMARY_TIMEOUT", 10)
+    assert asyncio.run(chat.budget_history(history, MODEL, Deadline(0.02))) == history[-2:]
@@ -0,0 +1,80 @@
+"""
+本地索引测试：构建后重新加载，按词查找（包括共享前缀的长词和多字节的中文词）、BM25排序和分块参数校验
+"""
+
+import pytest
+
+from modules.fastknowledge.local_index import LocalIndex, build_index, check_chunk_params, split_text, tokenize, \
+    VOCAB_PREFIX_BYTES
+
+DOCS = {
+    "config.md": "configuration configuration configured 缓存过期时间",
+    "pool.md": "configure the connection pool 连接池大小",
+    "cache.txt": "缓存缓存 缓存过期 expire configuration",
+    "other.txt": "unrelated words only",
+}
+
+
+@pytest.fixture
+def index(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    for name, text in DOCS.items():
+        (source / name).write_text(text, encoding="utf-8")
+    result = build_index("kb", str(source), index_root=str(tmp_path / "index"))
+    assert result["documents"] == len(DOCS)
+    return LocalIndex(tmp_path / "index" / "kb")
+
+
+def test_lookup_all_terms_round_trip(index):
+    tokens = sorted({token for text in DOCS.values() for token in tokenize(text)})
+    assert index.terms == len(tokens)
+    found = {index.lookup_term(token) for token in tokens}
+    assert None not in found
+    assert found == set(range(index.terms))
+    for token in tokens:
+        assert index._term_bytes(index.lookup_term(token)) == token.encode("utf-8")
+
+
+def test_lookup_terms_sharing_prefix(index):
+    shared = ["configuration", "configured", "configure"]
+    assert len({token.encode("utf-8")[:VOCAB_PREFIX_BYTES] for token in shared}) == 1
+    terms = [index.lookup_term(token) for token in shared]
+    assert None not in terms
+    assert len(set(terms)) == len(shared)
+    # 前缀相同但不在词表中的词
+    assert index.lookup_term("configur") is None
+    assert index.lookup_term("configurations") is None
+
+
+def test_lookup_multibyte_terms(index):
+    for token in ["缓存", "过期", "连接", "池大", "缓"]:
+        term = index.lookup_term(token)
+        assert term is not None
+        assert index._term_bytes(term).decode("utf-8") == token
+    assert index.lookup_term("缓冲") is None
+    assert index.lookup_term("") is None
+    assert index.lookup_term("zzz") is None
+
+
+def test_bm25_ordering(index):
+    scores = index.bm25_scores(tokenize("缓存"), k1=1.5, b=0.75)
+    by_source = {index.get_document(i)["metadata"]["source"]: float(score) for i, score in enumerate(scores)}
+    assert by_source["cache.txt"] > by_source["config.md"] > 0
+    assert by_source["pool.md"] == 0
+    assert by_source["other.txt"] == 0
+
+    results = index.search("缓存过期", top_k=2, score_threshold=2.0)
+    assert [doc["metadata"]["source"] for doc in results] == ["cache.txt", "config.md"]
+    assert results[0]["score"] <= results[1]["score"]
+
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap", [(10, 10), (10, 20), (0, 0), (10, -1)])
+def test_invalid_chunk_params(tmp_path, chunk_size, chunk_overlap):
+    with pytest.raises(ValueError):
+        check_chunk_params(chunk_size, chunk_overlap)
+    with pytest.raises(ValueError):
+        split_text("a" * 100, chunk_size, chunk_overlap)
+    with pytest.raises(ValueError):
+        build_index("kb", str(tmp_path), chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                    index_root=str(tmp_path / "index"))
@@ -0,0 +1,47 @@
+"""
+rerank_docs 测试：MMR在mmr_lambda较小时把重复文档排到不同文档之后，结果按top_k截断
+"""
+
+from modules.fastknowledge.rerank import rerank_docs
+from modules.fastknowledge.utils import DocumentWithVSId
+
+QUERY = "缓存过期时间如何设置"
+
+
+def make_doc(id: str, content: str, score: float) -> DocumentWithVSId:
+    return DocumentWithVSId(page_content=content, metadata={}, id=id, score=score)
+
+
+def candidates():
+    text = "缓存过期时间通过 SEARCH_CACHE_TTL 设置，单位为秒。"
+    return [
+        make_doc("best", text, 0.10),
+        make_doc("copy", text + " ", 0.11),
+        make_doc("distinct", "连接池大小和重试次数在模型配置中设置，与缓存无关。", 0.40),
+    ]
+
+
+def test_relevance_only_keeps_duplicate():
+    docs = rerank_docs(QUERY, candidates(), top_k=3, mmr_lambda=1.0, lexical_weight=0.3)
+    assert [doc.id for doc in docs] == ["best", "copy", "distinct"]
+
+
+def test_low_lambda_pushes_duplicate_below_distinct():
+    docs = rerank_docs(QUERY, candidates(), top_k=3, mmr_lambda=0.3, lexical_weight=0.3)
+    ids = [doc.id for doc in docs]
+    assert ids[0] == "best"
+    assert ids.index("distinct") < ids.index("copy")
+
+
+def test_top_k_truncation():
+    for mmr_lambda in (1.0, 0.5):
+        docs = rerank_docs(QUERY, candidates(), top_k=2, mmr_lambda=mmr_lambda, lexical_weight=0.3)
+        assert len(docs) == 2
+        assert docs[0].id == "best"
+    assert rerank_docs(QUERY, candidates(), top_k=0) == []
+    assert [doc.id for doc in rerank_docs(QUERY, candidates()[:1], top_k=5)] == ["best"]
+
+
+def test_scores_unchanged():
+    docs = rerank_docs(QUERY, candidates(), top_k=3, mmr_lambda=0.3, lexical_weight=0.3)
+    assert {doc.id: doc.score for doc in docs} == {"best": 0.10, "copy": 0.11, "distinct": 0.40}
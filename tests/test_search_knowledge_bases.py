@@ -0,0 +1,81 @@
+"""
+多知识库检索测试：按后端使用各自的超时时间，部分失败时跳过并记录失败的知识库，全部失败时抛出第一个异常
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from modules.fastknowledge import utils
+from modules.fastknowledge.utils import DocumentWithVSId
+
+
+def make_doc(id: str, score: float) -> DocumentWithVSId:
+    return DocumentWithVSId(page_content=id, metadata={}, id=id, score=score)
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    """
+    slow 为本地索引后端（超时0.05秒），其余为远程后端（超时1秒）
+    """
+    monkeypatch.setattr(utils, "SEARCH_BACKEND_TIMEOUT", {"remote": 1, "local": 0.05})
+    monkeypatch.setattr(utils, "get_search_backend", lambda name: "local" if name.startswith("slow") else "remote")
+
+
+def stub_search_docs(monkeypatch, behaviours):
+    async def search_docs(query, knowledge_base_name, top_k, score_threshold):
+        behaviour = behaviours[knowledge_base_name]
+        if isinstance(behaviour, float):
+            await asyncio.sleep(behaviour)
+            return [make_doc(knowledge_base_name, 0.5)]
+        if isinstance(behaviour, Exception):
+            raise behaviour
+        return [make_doc(f"{knowledge_base_name}-{score}", score) for score in behaviour]
+
+    monkeypatch.setattr(utils, "search_docs", search_docs)
+
+
+def test_merges_results_by_score(monkeypatch, backends):
+    stub_search_docs(monkeypatch, {"a": [0.3, 0.9], "b": [0.1, 0.5]})
+    docs, errors = asyncio.run(utils.search_knowledge_bases("q", ["a", "b"], top_k=3))
+    assert [doc.id for doc in docs] == ["b-0.1", "a-0.3", "b-0.5"]
+    assert [doc.metadata["knowledge_base_name"] for doc in docs] == ["b", "a", "b"]
+    assert errors == []
+
+
+def test_backend_timeout_applies_per_knowledge_base(monkeypatch, backends):
+    # slow 的检索时间超过本地后端的超时，但远远小于远程后端的超时
+    stub_search_docs(monkeypatch, {"slow": 0.3, "fast": 0.1})
+    start = time.perf_counter()
+    docs, errors = asyncio.run(utils.search_knowledge_bases("q", ["slow", "fast"], top_k=3))
+    assert time.perf_counter() - start < 0.3
+    assert [doc.id for doc in docs] == ["fast"]
+    assert errors == [{"knowledge_base_name": "slow", "reason": "timeout"}]
+
+
+def test_request_timeout_caps_backend_timeout(monkeypatch, backends):
+    stub_search_docs(monkeypatch, {"a": 0.3, "b": [0.1]})
+    docs, errors = asyncio.run(utils.search_knowledge_bases("q", ["a", "b"], top_k=3, timeout=0.05))
+    assert [doc.id for doc in docs] == ["b-0.1"]
+    assert errors == [{"knowledge_base_name": "a", "reason": "timeout"}]
+
+
+def test_partial_failure_reports_failed_knowledge_bases(monkeypatch, backends):
+    stub_search_docs(monkeypatch, {"a": [0.2], "b": RuntimeError("connection refused")})
+    docs, errors = asyncio.run(utils.search_knowledge_bases("q", ["a", "b"], top_k=3))
+    assert [doc.id for doc in docs] == ["a-0.2"]
+    assert errors == [{"knowledge_base_name": "b", "reason": "connection refused"}]
+
+
+def test_all_failures_raise_first(monkeypatch, backends):
+    stub_search_docs(monkeypatch, {"a": ValueError("first"), "b": RuntimeError("second")})
+    with pytest.raises(ValueError, match="first"):
+        asyncio.run(utils.search_knowledge_bases("q", ["a", "b"], top_k=3))
+
+
+def test_all_timeouts_raise_timeout(monkeypatch, backends):
+    stub_search_docs(monkeypatch, {"slow-a": 0.3, "slow-b": 0.3})
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(utils.search_knowledge_bases("q", ["slow-a", "slow-b"], top_k=3))
@@ -0,0 +1,106 @@
+"""
+SingleFlight 测试：并发相同key只执行一次，异常分发给所有等待者，单个等待者取消不影响共享调用，结束后释放key
+"""
+
+import asyncio
+
+import pytest
+
+from modules.fastknowledge.singleflight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", fn) for _ in range(10)))
+
+    assert asyncio.run(run()) == ["result"] * 10
+    assert len(calls) == 1
+    assert flight.executions == 1
+    assert flight.shared == 9
+
+
+def test_error_propagates_to_every_waiter():
+    flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", fn) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert len(results) == 3
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_cancelling_one_waiter_keeps_shared_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return "result"
+
+    async def run():
+        first = asyncio.ensure_future(flight.do("k", fn))
+        second = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "result"
+    assert len(calls) == 1
+
+
+def test_cancelling_all_waiters_cancels_call():
+    flight = SingleFlight()
+    cancelled = []
+
+    async def fn():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def run():
+        task = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0.005)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+        return flight.stats()["in_flight"]
+
+    assert asyncio.run(run()) == 0
+    assert cancelled == [1]
+
+
+def test_key_released_after_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        first = await flight.do("k", fn)
+        assert flight.stats()["in_flight"] == 0
+        second = await flight.do("k", fn)
+        return first, second
+
+    assert asyncio.run(run()) == (1, 2)
+    assert flight.executions == 2
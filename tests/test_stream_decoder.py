@@ -0,0 +1,143 @@
+"""
+StreamDecoder 测试：本地模拟服务把SSE/NDJSON输出拆成1~7字节的小片段逐段发送，
+检查 ApiRequest 和 AsyncApiRequest 能还原出完整且顺序一致的事件
+"""
+
+import asyncio
+import json
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from webui_pages.api_request import ApiRequest, AsyncApiRequest, StreamDecoder
+
+TOKENS = ["你好", "，", "这是", " streamed ", "答案", "🙂", "\n换行", "end"]
+DOCS = ["出处1", "出处2"]
+ERROR = {"code": 504, "message": "请求超时：LLM生成未能在 1 秒的时间预算内完成"}
+
+
+def sse_body() -> bytes:
+    parts = [": ping\r\n\r\n", f"data: {json.dumps({'docs': DOCS}, ensure_ascii=False)}\r\n\r\n"]
+    for i, token in enumerate(TOKENS):
+        data = json.dumps({"answer": token}, ensure_ascii=False)
+        if i % 3 == 0:
+            parts.append(f"data: {data}\n\n")
+        elif i % 3 == 1:
+            parts.append(f"id: {i}\r\ndata: {data}\r\n\r\n")
+        else:
+            # 多行data：按SSE规范以换行拼接后再解析，在json的键值之间拆分
+            head, tail = data.split(":", 1)
+            parts.append(f"data: {head}:\r\ndata:{tail}\r\n\r\n")
+    parts.append(f"event: error\r\ndata: {json.dumps(ERROR, ensure_ascii=False)}\r\n\r\n")
+    parts.append("data: [DONE]\n\n")
+    return "".join(parts).encode("utf-8")
+
+
+def ndjson_body() -> bytes:
+    lines = [json.dumps({"index": i, "answer": token}, ensure_ascii=False) for i, token in enumerate(TOKENS)]
+    lines.append(json.dumps(ERROR, ensure_ascii=False))
+    # 最后一行没有换行符，由 flush 解析
+    return ("\r\n".join(lines[:-1]) + "\n" + lines[-1]).encode("utf-8")
+
+
+def expected_sse():
+    return [{"docs": DOCS}] + [{"answer": token} for token in TOKENS] + [ERROR]
+
+
+def expected_ndjson():
+    return [{"index": i, "answer": token} for i, token in enumerate(TOKENS)] + [ERROR]
+
+
+class FragmentingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/batch"):
+            body, content_type = ndjson_body(), "application/x-ndjson"
+        else:
+            body, content_type = sse_body(), "text/event-stream"
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.end_headers()
+        self.wfile.flush()
+        rng = random.Random(self.server.seed)
+        pos = 0
+        while pos < len(body):
+            size = rng.randint(1, 7)
+            self.wfile.write(body[pos:pos + size])
+            self.wfile.flush()
+            pos += size
+            time.sleep(0.0005)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FragmentingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().server_bind()
+
+
+@pytest.fixture(params=[0, 1, 2])
+def server_url(request):
+    server = FragmentingServer(("127.0.0.1", 0), FragmentingHandler)
+    server.seed = request.param
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_api_request_sse(server_url):
+    api = ApiRequest(base_url=server_url)
+    assert list(api.llm_chat("hi", stream=True)) == expected_sse()
+
+
+def test_api_request_ndjson(server_url):
+    api = ApiRequest(base_url=server_url)
+    assert list(api.knowledge_base_chat_batch([{"query": "hi"}])) == expected_ndjson()
+
+
+def test_async_api_request_sse(server_url):
+    async def collect():
+        api = AsyncApiRequest(base_url=server_url)
+        return [data async for data in api.llm_chat("hi", stream=True)]
+
+    assert asyncio.run(collect()) == expected_sse()
+
+
+def test_async_api_request_ndjson(server_url):
+    async def collect():
+        api = AsyncApiRequest(base_url=server_url)
+        return [data async for data in api.knowledge_base_chat_batch([{"query": "hi"}])]
+
+    assert asyncio.run(collect()) == expected_ndjson()
+
+
+@pytest.mark.parametrize("body", [sse_body(), ndjson_body()])
+def test_decoder_split_at_every_position(body):
+    text = body.decode("utf-8")
+    expected = expected_sse() if text.startswith(":") else expected_ndjson()
+    for pos in range(len(text) + 1):
+        decoder = StreamDecoder()
+        assert decoder.feed(text[:pos]) + decoder.feed(text[pos:]) + decoder.flush() == expected
+
+
+def test_stream_error_on_connect_failure():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    api = ApiRequest(base_url=f"http://127.0.0.1:{port}")
+    events = list(api.llm_chat("hi", stream=True))
+    assert len(events) == 1
+    assert events[0]["code"] == 500
+    assert "无法连接API服务器" in events[0]["msg"]
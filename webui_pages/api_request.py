@@ -10,7 +10,8 @@ import json
 
 
 from application.settings import HOST, PORT
-from application.settings import VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD, LLM_MODELS, TEMPERATURE, MAX_TOKENS
+from application.settings import VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD, LLM_MODELS, TEMPERATURE, MAX_TOKENS, \
+    BATCH_CONCURRENCY
 
 import logging
 
@@ -25,6 +26,85 @@ if HOST == "0.0.0.0":
 DEFAULT_BASE_URL = f"http://{host}:{PORT}"
 
 
+class StreamDecoder:
+    """
+    增量解析 text/event-stream 和 NDJSON 流
+    输入可以在任意位置被拆分，也可以一次包含多个事件；支持多行data、注释行以及 [DONE] 结束标记
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._data_lines = []
+
+    def feed(self, chunk: str) -> List[Any]:
+        """
+        输入一段文本，返回其中已完整的事件
+        """
+        self._buffer += chunk
+        lines = self._buffer.split("\n")
+        self._buffer = lines.pop()  # 最后一段可能是不完整的行
+        events = []
+        for line in lines:
+            self._feed_line(line.rstrip("\r"), events)
+        return events
+
+    def flush(self) -> List[Any]:
+        """
+        流结束时调用，返回缓冲区中剩余的事件
+        """
+        events = []
+        if self._buffer:
+            self._feed_line(self._buffer.rstrip("\r"), events)
+            self._buffer = ""
+        self._dispatch(events)
+        return events
+
+    def _feed_line(self, line: str, events: List[Any]):
+        if not line:  # 空行表示一个SSE事件结束
+            self._dispatch(events)
+        elif line.startswith(":"):  # skip sse comment line
+            return
+        elif line.startswith("data:"):
+            value = line[5:]
+            self._data_lines.append(value[1:] if value.startswith(" ") else value)
+        elif line.startswith(("event:", "id:", "retry:")):
+            return
+        else:  # NDJSON，每行一个json
+            self._loads(line, events)
+
+    def _dispatch(self, events: List[Any]):
+        if not self._data_lines:
+            return
+        data = "\n".join(self._data_lines)
+        self._data_lines = []
+        if data != "[DONE]":
+            self._loads(data, events)
+
+    @staticmethod
+    def _loads(text: str, events: List[Any]):
+        try:
+            events.append(json.loads(text))
+        except Exception as e:
+            msg = f"接口返回json错误： ‘{text}’。错误信息是：{e}。"
+            logger.error(f'{e.__class__.__name__}: {msg}')
+
+
+def _stream_error(e: Exception) -> Dict:
+    """
+    将流式请求中的异常转换为错误消息
+    """
+    if isinstance(e, httpx.ConnectError):
+        msg = f"无法连接API服务器，请确认 ‘api.py’ 已正常启动。({e})"
+        logger.error(msg)
+    elif isinstance(e, httpx.ReadTimeout):
+        msg = f"API通信超时，请确认已启动FastChat与API服务（详见Wiki '5. 启动 API 服务或 Web UI'）。（{e}）"
+        logger.error(msg)
+    else:
+        msg = f"API通信遇到错误：{e}"
+        logger.error(f'{e.__class__.__name__}: {msg}')
+    return {"code": 500, "msg": msg}
+
+
 class ApiRequest:
     """
     api.py调用的封装（同步模式）,简化api调用方式
@@ -115,74 +195,42 @@ class ApiRequest:
     ):
         """
         将httpx.stream返回的GeneratorContextManager转化为普通生成器
+        as_json为True时使用StreamDecoder增量解析SSE/NDJSON，事件可以被任意拆分或合并在多次读取中
         """
 
         async def ret_async(response, as_json):
+            decoder = StreamDecoder()
             try:
                 async with response as r:
                     async for chunk in r.aiter_text(None):
                         if not chunk:  # fastchat api yield empty bytes on start and end
                             continue
                         if as_json:
-                            try:
-                                if chunk.startswith("data: "):
-                                    data = json.loads(chunk[6:-2])
-                                elif chunk.startswith(":"):  # skip sse comment line
-                                    continue
-                                else:
-                                    data = json.loads(chunk)
+                            for data in decoder.feed(chunk):
                                 yield data
-                            except Exception as e:
-                                msg = f"接口返回json错误： ‘{chunk}’。错误信息是：{e}。"
-                                logger.error(f'{e.__class__.__name__}: {msg}')
                         else:
-                            # print(chunk, end="", flush=True)
                             yield chunk
-            except httpx.ConnectError as e:
-                msg = f"无法连接API服务器，请确认 ‘api.py’ 已正常启动。({e})"
-                logger.error(msg)
-                yield {"code": 500, "msg": msg}
-            except httpx.ReadTimeout as e:
-                msg = f"API通信超时，请确认已启动FastChat与API服务（详见Wiki '5. 启动 API 服务或 Web UI'）。（{e}）"
-                logger.error(msg)
-                yield {"code": 500, "msg": msg}
+                if as_json:
+                    for data in decoder.flush():
+                        yield data
             except Exception as e:
-                msg = f"API通信遇到错误：{e}"
-                logger.error(f'{e.__class__.__name__}: {msg}')
-                yield {"code": 500, "msg": msg}
+                yield _stream_error(e)
 
         def ret_sync(response, as_json):
+            decoder = StreamDecoder()
             try:
                 with response as r:
                     for chunk in r.iter_text(None):
                         if not chunk:  # fastchat api yield empty bytes on start and end
                             continue
                         if as_json:
-                            try:
-                                if chunk.startswith("data: "):
-                                    data = json.loads(chunk[6:-2])
-                                elif chunk.startswith(":"):  # skip sse comment line
-                                    continue
-                                else:
-                                    data = json.loads(chunk)
-                                yield data
-                            except Exception as e:
-                                msg = f"接口返回json错误： ‘{chunk}’。错误信息是：{e}。"
-                                logger.error(f'{e.__class__.__name__}: {msg}')
+                            yield from decoder.feed(chunk)
                         else:
                             yield chunk
-            except httpx.ConnectError as e:
-                msg = f"无法连接API服务器，请确认 ‘api.py’ 已正常启动。({e})"
-                logger.error(msg)
-                yield {"code": 500, "msg": msg}
-            except httpx.ReadTimeout as e:
-                msg = f"API通信超时，请确认已启动FastChat与API服务（详见Wiki '5. 启动 API 服务或 Web UI'）。（{e}）"
-                logger.error(msg)
-                yield {"code": 500, "msg": msg}
+                if as_json:
+                    yield from decoder.flush()
             except Exception as e:
-                msg = f"API通信遇到错误：{e}"
-                logger.error(f'{e.__class__.__name__}: {msg}')
-                yield {"code": 500, "msg": msg}
+                yield _stream_error(e)
 
         if self._use_async:
             return ret_async(response, as_json)
@@ -237,7 +285,7 @@ class ApiRequest:
     def knowledge_base_chat(
             self,
             query: str,
-            knowledge_base_name: str,
+            knowledge_base_name: Union[str, List[str]],
             top_k: int = VECTOR_SEARCH_TOP_K,
             score_threshold: float = SCORE_THRESHOLD,
             history: List[Dict] = [],
@@ -245,9 +293,11 @@ class ApiRequest:
             temperature: float = TEMPERATURE,
             max_tokens: int = MAX_TOKENS,
             prompt_name: str = "default",
+            stream: bool = False,
     ):
         """
         对应api.py/chat/knowledge_base_chat接口
+        stream为True时返回生成器，依次产出 {"docs": [...]} 和 {"answer": token}
         """
         data = {
             "query": query,
@@ -259,14 +309,39 @@ class ApiRequest:
             "temperature": temperature,
             "max_tokens": max_tokens,
             "prompt_name": prompt_name,
+            "stream": stream,
         }
 
         response = self.post(
             "/chat/knowledge_base_chat",
             json=data,
+            stream=stream,
         )
+        if stream:
+            return self._httpx_stream2generator(response, as_json=True)
         return self._get_response_value(response, as_json=True)
 
+    def knowledge_base_chat_batch(
+            self,
+            items: List[Dict],
+            concurrency: int = BATCH_CONCURRENCY,
+    ):
+        """
+        对应api.py/chat/knowledge_base_chat/batch接口
+        items中每一项为knowledge_base_chat接口的请求参数，返回生成器，按完成顺序产出带index的结果
+        """
+        data = {
+            "items": items,
+            "concurrency": concurrency,
+        }
+
+        response = self.post(
+            "/chat/knowledge_base_chat/batch",
+            json=data,
+            stream=True,
+        )
+        return self._httpx_stream2generator(response, as_json=True)
+
     def llm_chat(
             self,
             query: str,
@@ -275,9 +350,11 @@ class ApiRequest:
             temperature: float = TEMPERATURE,
             max_tokens: int = MAX_TOKENS,
             prompt_name: str = "default",
+            stream: bool = False,
     ):
         """
         对应api.py/chat/llm_chat接口
+        stream为True时返回生成器，依次产出 {"answer": token}
         """
         data = {
             "query": query,
@@ -286,12 +363,16 @@ class ApiRequest:
             "temperature": temperature,
             "max_tokens": max_tokens,
             "prompt_name": prompt_name,
+            "stream": stream,
         }
 
         response = self.post(
             "/chat/llm_chat",
             json=data,
+            stream=stream,
         )
+        if stream:
+            return self._httpx_stream2generator(response, as_json=True)
         return self._get_response_value(response, as_json=True)
 
 
@@ -309,7 +390,7 @@ def check_error_msg(data: Union[str, dict, list], key: str = "errorMsg") -> str:
         if key in data:
             return data[key]
         if "code" in data and data["code"] != 200:
-            return data["msg"]
+            return data.get("msg") or data.get("message", "")
     return ""
 
 
@@ -147,14 +147,21 @@ def dialogue_page(api: ApiRequest, api_search: ApiRequest):
         chat_box.user_say(prompt)
         if dialogue_mode == "LLM 对话":
             chat_box.ai_say("正在思考...")
-            ret = api.llm_chat(
+            text = ""
+            for d in api.llm_chat(
                 prompt,
                 history=history,
                 model=llm_model,
                 prompt_name=prompt_template_name,
-                temperature=temperature
-            )
-            chat_box.update_msg(ret["answer"], streaming=False)  # 更新最终的字符串，去除光标
+                temperature=temperature,
+                stream=True,
+            ):
+                if error_msg := check_error_msg(d):  # check whether error occured
+                    st.error(error_msg)
+                    break
+                text += d.get("answer", "")
+                chat_box.update_msg(text)
+            chat_box.update_msg(text, streaming=False)  # 更新最终的字符串，去除光标
 
         elif dialogue_mode == "知识库问答":
             chat_box.ai_say([
@@ -162,7 +169,8 @@ def dialogue_page(api: ApiRequest, api_search: ApiRequest):
                 Markdown("...", in_expander=True, title="知识库匹配结果", state="complete"),
             ])
 
-            ret = api.knowledge_base_chat(
+            text = ""
+            for d in api.knowledge_base_chat(
                 prompt,
                 knowledge_base_name=selected_kb,
                 top_k=kb_top_k,
@@ -170,11 +178,18 @@ def dialogue_page(api: ApiRequest, api_search: ApiRequest):
                 history=history,
                 model=llm_model,
                 prompt_name=prompt_template_name,
-                temperature=temperature
-            )
-
-            chat_box.update_msg(ret["answer"], element_index=0, streaming=False)
-            chat_box.update_msg("\n\n".join(ret["docs"]), element_index=1, streaming=False)
+                temperature=temperature,
+                stream=True,
+            ):
+                if error_msg := check_error_msg(d):  # check whether error occured
+                    st.error(error_msg)
+                    break
+                if "docs" in d:
+                    chat_box.update_msg("\n\n".join(d["docs"]), element_index=1, streaming=False)
+                elif "answer" in d:
+                    text += d["answer"]
+                    chat_box.update_msg(text, element_index=0)
+            chat_box.update_msg(text, element_index=0, streaming=False)
 
     if st.session_state.get("need_rerun"):
         st.session_state["need_rerun"] = False